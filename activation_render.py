@@ -0,0 +1,116 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import instrument
+
+# Layers visualized in activation mode
+LAYERS = ['enc1', 'enc2', 'enc3', 'enc4', 'btnk']
+CHANNELS = 10
+
+def layer_modules(generator: torch.nn.Module) -> dict:
+    return {
+        'enc1': generator.encoder1[2],
+        'enc2': generator.encoder2[2],
+        'enc3': generator.encoder3[2],
+        'enc4': generator.encoder4[2],
+        'btnk': generator.bottleneck[2]
+    }
+
+# Registers hooks that copy only the first n channels of each layer's output into store
+def register_slice_hooks(generator: torch.nn.Module, store: dict, n: int = CHANNELS) -> list:
+    def get_activation(layer):
+        def hook(model, input, output):
+            store[layer] = output[:, :n].detach().cpu()
+        return hook
+    return [module.register_forward_hook(get_activation(layer)) for layer, module in layer_modules(generator).items()]
+
+# Runs a batch and returns the first n channels of every layer as numpy arrays (batch, n, H, W)
+def compute_activations(generator: torch.nn.Module, images: torch.Tensor, device: str, n: int = CHANNELS) -> dict:
+    store = {}
+    handles = register_slice_hooks(generator, store, n)
+    try:
+        with torch.no_grad():
+            generator(images.to(device))
+    finally:
+        for handle in handles:
+            handle.remove()
+    return {layer: store[layer].numpy() for layer in LAYERS}
+
+# Draws one image's activation grid onto fig
+def draw_feature_maps(fig: Figure, activations: dict, title: str, n: int = CHANNELS) -> None:
+    num_layers = len(activations)
+    for i, (_, fmaps) in enumerate(activations.items()):
+        for j in range(min(n, fmaps.shape[0])):
+            ax = fig.add_subplot(num_layers, n, i * n + j + 1)
+            ax.imshow(fmaps[j], cmap='viridis')
+            ax.axis('off')
+            ax.set_title(f'L{i+1}, Ch{j+1}', fontsize=10)
+    fig.suptitle(title)
+    fig.tight_layout()
+
+# Renders one image's activation grid off screen and returns it as an RGBA array
+def render_feature_maps(activations: dict, title: str, n: int = CHANNELS, figsize=(15, 9), dpi: int = 100) -> np.ndarray:
+    fig = Figure(figsize=figsize, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    draw_feature_maps(fig, activations, title, n)
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba()).copy()
+
+# Computes and renders activation pages on demand, keeping an LRU cache of rendered pages
+# Rendering happens on one background thread, which also pre-renders the neighbours of the page shown
+class ActivationPager:
+    def __init__(self, generator: torch.nn.Module, paths: list[str], device: str, n: int = CHANNELS,
+                 cache_size: int = 8, prefetch: int = 1, subtitle: str = ''):
+        self.generator = generator
+        self.paths = paths
+        self.device = device
+        self.n = n
+        self.cache_size = max(cache_size, 2 * prefetch + 1)
+        self.prefetch = prefetch
+        self.subtitle = subtitle
+        self.pages = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def _render(self, index: int) -> np.ndarray:
+        from lightshed_xai import load_image
+        with instrument.stage('decode', 1):
+            image = load_image(self.paths[index])
+        with instrument.stage('forward', 1):
+            activations = compute_activations(self.generator, image, self.device, self.n)
+        activations = {layer: fmaps[0] for layer, fmaps in activations.items()}
+        title = f'Activations per Layer for {os.path.basename(self.paths[index])}\n{self.subtitle}'
+        with instrument.stage('render', 1):
+            return render_feature_maps(activations, title, self.n)
+
+    def _request(self, index: int):
+        if index in self.pages:
+            self.pages.move_to_end(index)
+        else:
+            self.pages[index] = self.executor.submit(self._render, index)
+        return self.pages[index]
+
+    # Rendered page for index; blocks only if it has not been rendered yet
+    def page(self, index: int) -> np.ndarray:
+        future = self._request(index)
+        neighbours = [(index + k) % len(self) for d in range(1, self.prefetch + 1) for k in (d, -d)]
+        for i in neighbours:
+            self._request(i)
+        # Keep the requested page most recent so prefetches are evicted first
+        self.pages.move_to_end(index)
+        keep = set(neighbours) | {index}
+        while len(self.pages) > self.cache_size:
+            oldest = next((i for i in self.pages if i not in keep), None)
+            if oldest is None:
+                break
+            self.pages.pop(oldest).cancel()
+        return future.result()
+
+    def close(self) -> None:
+        self.executor.shutdown(cancel_futures=True)
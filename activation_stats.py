@@ -0,0 +1,230 @@
+import argparse
+import csv
+import os
+from functools import partial
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+import image_store
+import instrument
+from activation_render import LAYERS, layer_modules
+from occlusion import VARIANTS, find_groups
+
+# Per-image summaries of each channel's activation map; their running statistics are kept per variant
+SUMMARIES = ['mean', 'energy', 'max']
+
+# Running count, mean and sum of squared deviations of per-image values, (variants, channels) each.
+# Batches are folded in with Chan et al.'s parallel form of Welford's update, so nothing per image is kept
+class RunningStats:
+    def __init__(self, variants: int, channels: int):
+        self.n = np.zeros((variants, 1))
+        self.mean = np.zeros((variants, channels))
+        self.m2 = np.zeros((variants, channels))
+        self.max = np.full((variants, channels), -np.inf)
+
+    # Folds values (images, channels) of one variant into its statistics
+    def update(self, variant: int, values: np.ndarray) -> None:
+        n_b = len(values)
+        if n_b == 0:
+            return
+        mean_b = values.mean(axis=0)
+        m2_b = ((values - mean_b) ** 2).sum(axis=0)
+        n_a = self.n[variant, 0]
+        n = n_a + n_b
+        delta = mean_b - self.mean[variant]
+        self.mean[variant] += delta * n_b / n
+        self.m2[variant] += m2_b + delta ** 2 * n_a * n_b / n
+        self.n[variant, 0] = n
+        self.max[variant] = np.maximum(self.max[variant], values.max(axis=0))
+
+    # Statistics of several variants combined into one, with the same parallel update
+    def merged(self, variants: list[int]) -> 'RunningStats':
+        out = RunningStats(1, self.mean.shape[1])
+        for v in variants:
+            n_a, n_b = out.n[0, 0], self.n[v, 0]
+            if n_b == 0:
+                continue
+            n = n_a + n_b
+            delta = self.mean[v] - out.mean[0]
+            out.mean[0] += delta * n_b / n
+            out.m2[0] += self.m2[v] + delta ** 2 * n_a * n_b / n
+            out.n[0, 0] = n
+            out.max[0] = np.maximum(out.max[0], self.max[v])
+        return out
+
+    def var(self) -> np.ndarray:
+        return self.m2 / np.maximum(self.n - 1, 1)
+
+# Registers hooks that reduce each layer's output to per-image, per-channel summaries as the batch runs,
+# so full activation maps are dropped as soon as the layer is done: spatial mean, spatial energy (mean square) and max
+def register_summary_hooks(generator: torch.nn.Module, store: dict) -> list:
+    def get_summary(layer):
+        def hook(model, input, output):
+            x = output.detach().float()
+            store[layer] = torch.stack([x.mean(dim=(2, 3)), x.pow(2).mean(dim=(2, 3)), x.amax(dim=(2, 3))]).cpu().double().numpy()
+        return hook
+    return [module.register_forward_hook(get_summary(layer)) for layer, module in layer_modules(generator).items()]
+
+# (path, variant index) items for the DataLoader; decoding happens in collate_variants inside the worker processes
+class VariantImages(Dataset):
+    def __init__(self, items: list[tuple[str, int]]):
+        self.items = items
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __getitem__(self, index: int) -> tuple[str, int]:
+        return self.items[index]
+
+def collate_variants(items: list[tuple[str, int]]) -> tuple[torch.Tensor, np.ndarray]:
+    from lightshed_xai import load_image
+    images, variants = [], []
+    for path, variant in items:
+        img = load_image(path, unsqueeze=False)
+        if img is not None:
+            images.append(img)
+            variants.append(variant)
+    if not images:
+        return torch.empty((0, 3, 512, 512)), np.zeros(0, dtype=np.int64)
+    return torch.stack(images), np.array(variants)
+
+# Every image of groups as (path, index into VARIANTS), clean images first
+def group_items(groups: dict) -> list[tuple[str, int]]:
+    return [(paths[variant], v) for v, variant in enumerate(VARIANTS) for _, paths in sorted(groups.items()) if variant in paths]
+
+# Streams every image through the generator and returns {layer: {summary: RunningStats}}
+# Memory depends on the batch size and the number of channels, not on the number of images
+def activation_stats(generator: torch.nn.Module, items: list[tuple[str, int]], device: str,
+                     batch_size: int = 16, workers: int = 4) -> dict:
+    store = {}
+    stats = {}
+    handles = register_summary_hooks(generator, store)
+    # Workers started with spawn do not inherit the image store, so reopen it in each
+    image_store_root = image_store.active_store().root if image_store.active_store() is not None else None
+    worker_init = partial(image_store.use_image_store, image_store_root) if image_store_root and workers > 0 else None
+    loader = DataLoader(VariantImages(items), batch_size=batch_size, num_workers=workers, collate_fn=collate_variants,
+                        pin_memory=device == 'cuda', worker_init_fn=worker_init)
+    batches = iter(loader)
+    seen = 0
+    done = 0
+    try:
+        while True:
+            with instrument.stage('load_wait'):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            images, variants = batch
+            if len(variants) == 0:
+                continue
+            with instrument.stage('forward', len(variants)):
+                with torch.inference_mode():
+                    generator(images.to(device))
+            with instrument.stage('reduce', len(variants)):
+                for layer in LAYERS:
+                    summaries = store.pop(layer)
+                    if layer not in stats:
+                        stats[layer] = {s: RunningStats(len(VARIANTS), summaries.shape[2]) for s in SUMMARIES}
+                    for v in np.unique(variants):
+                        for s, values in zip(SUMMARIES, summaries[:, variants == v]):
+                            stats[layer][s].update(v, values)
+            seen += len(variants)
+            done += 1
+            instrument.count('images', len(variants))
+            instrument.step()
+            if done % 20 == 0:
+                print(f'{seen}/{len(items)} images')
+    finally:
+        for handle in handles:
+            handle.remove()
+    return stats
+
+# Standardized mean difference (Cohen's d) between two variants' statistics, per channel; NaN if either has no images
+def cohens_d(a: RunningStats, b: RunningStats, i: int = 0, j: int = 0) -> np.ndarray:
+    n_a, n_b = a.n[i, 0], b.n[j, 0]
+    if n_a == 0 or n_b == 0:
+        return np.full(a.mean.shape[1], np.nan)
+    pooled = (a.m2[i] + b.m2[j]) / max(n_a + n_b - 2, 1)
+    return (b.mean[j] - a.mean[i]) / np.sqrt(np.maximum(pooled, 1e-12))
+
+# One row per (layer, channel): clean and poisoned (all perturbed variants) statistics, the separation of
+# each perturbed variant from clean, ranked by the absolute separation of clean and poisoned mean responses
+def rank_channels(stats: dict) -> list[dict]:
+    rows = []
+    for layer, by_summary in stats.items():
+        mean, energy, peak = by_summary['mean'], by_summary['energy'], by_summary['max']
+        poisoned = {s: by_summary[s].merged(list(range(1, len(VARIANTS)))) for s in SUMMARIES}
+        d_poisoned = cohens_d(mean, poisoned['mean'])
+        d_energy = cohens_d(energy, poisoned['energy'])
+        d_variants = {variant: cohens_d(mean, mean, 0, v) for v, variant in enumerate(VARIANTS) if v > 0}
+        for c in range(mean.mean.shape[1]):
+            rows.append({
+                'layer': layer, 'channel': c,
+                'd_poisoned': d_poisoned[c], 'd_energy': d_energy[c],
+                **{f'd_{variant}': d[c] for variant, d in d_variants.items()},
+                'clean_mean': mean.mean[0, c], 'clean_std': np.sqrt(mean.var()[0, c]),
+                'poisoned_mean': poisoned['mean'].mean[0, c], 'poisoned_std': np.sqrt(poisoned['mean'].var()[0, c]),
+                'clean_energy': energy.mean[0, c], 'poisoned_energy': poisoned['energy'].mean[0, c],
+                'clean_max': peak.max[0, c], 'poisoned_max': poisoned['max'].max[0, c]
+            })
+    return sorted(rows, key=lambda row: -abs(row['d_poisoned']))
+
+# Saves every running statistic as (variants, channels) arrays named <layer>_<summary>_<n|mean|m2|max>
+def save_stats(path: str, stats: dict) -> None:
+    arrays = {'variants': np.array(VARIANTS)}
+    for layer, by_summary in stats.items():
+        for s, st in by_summary.items():
+            arrays.update({f'{layer}_{s}_n': st.n, f'{layer}_{s}_mean': st.mean, f'{layer}_{s}_m2': st.m2, f'{layer}_{s}_max': st.max})
+    np.savez_compressed(path, **arrays)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pth', required=True, help='The path to the checkpoint file')
+    parser.add_argument('--training-data', default=os.path.join(os.getcwd(), 'training_data'), help='Folder containing style_variant/train folders')
+    parser.add_argument('--catalogue', help='Take the image groups from this catalogue.py database instead of --training-data')
+    parser.add_argument('--style', help="Only groups of this style, e.g. 'materials' (with --catalogue)")
+    parser.add_argument('--output', default='activation_stats.npz', help='File the running statistics are saved to')
+    parser.add_argument('--csv', default='activation_channels.csv', help='CSV with one row per channel, most separating first')
+    parser.add_argument('--top', type=int, default=20, help='Channels to list')
+    parser.add_argument('--batch-size', type=int, default=16, help='Images per forward pass')
+    parser.add_argument('--workers', type=int, default=4, help='DataLoader processes decoding images')
+    parser.add_argument('--image-store', help='Read images from this image_store.py store when they are in it')
+    parser.add_argument('--model-module', default='lightshed_model', help='Module providing setup_generator and load_checkpoint')
+    instrument.add_arguments(parser)
+    arg_list = parser.parse_args()
+    instrument.from_arguments(arg_list)
+
+    if arg_list.image_store:
+        image_store.use_image_store(arg_list.image_store)
+    if arg_list.catalogue:
+        from catalogue import Catalogue
+        with Catalogue(arg_list.catalogue) as catalogue:
+            groups = catalogue.groups(arg_list.style)
+    else:
+        if not os.path.isdir(arg_list.training_data):
+            raise FileNotFoundError(f'{arg_list.training_data} not found or is not directory')
+        groups = find_groups(arg_list.training_data)
+    items = group_items(groups)
+    if not any(v == 0 for _, v in items) or all(v == 0 for _, v in items):
+        raise ValueError('Both clean and perturbed images are needed to compare them')
+
+    import xai_utils as xu
+    device = xu.get_device()
+    print(f'Device: {device}')
+    generator = xu.load_generator(arg_list.pth, device, arg_list.model_module)
+    counts = np.bincount([v for _, v in items], minlength=len(VARIANTS))
+    print(', '.join(f'{n} {variant}' for variant, n in zip(VARIANTS, counts)) + ' images')
+
+    stats = activation_stats(generator, items, device, arg_list.batch_size, arg_list.workers)
+    save_stats(arg_list.output, stats)
+    rows = rank_channels(stats)
+    with open(arg_list.csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: f'{v:.6g}' if isinstance(v, float) else v for k, v in row.items()})
+    print(f'Statistics saved to {arg_list.output}; {len(rows)} channels ranked in {arg_list.csv}')
+    print(f'{"layer":<6} {"channel":>7} {"d poisoned":>11} {"d energy":>9} ' + ' '.join(f'{"d " + v:>16}' for v in VARIANTS[1:]))
+    for row in rows[:arg_list.top]:
+        print(f'{row["layer"]:<6} {row["channel"]:>7} {row["d_poisoned"]:>11.3f} {row["d_energy"]:>9.3f} '
+              + ' '.join(f'{row[f"d_{v}"]:>16.3f}' for v in VARIANTS[1:]))
@@ -0,0 +1,280 @@
+import argparse
+import csv
+import os
+import numpy as np
+from sklearn.ensemble import ExtraTreesRegressor
+from xai_utils import load_image
+from poison_util import TARGETS, load_stack, gamma_masks, lightness_suffix
+from lightshed_detect import score_batch, to_tensor_batch, CSV_HEADER, threshold, use_threshold, add_threshold_argument
+
+# Every (noise, procedural, lightness target, alpha) combination of the perturbation space
+def build_space(noise_names: list[str], proc_names: list[str], targets: list[float], alphas: list[float]) -> list[dict]:
+    return [{'noise': n, 'procedural': p, 'target': t, 'alpha': a, 'mask': f'{p}_{lightness_suffix(t)}'}
+            for a in alphas for n in noise_names for p in proc_names for t in targets]
+
+# Surrogate inputs: one-hot noise and procedural, target, alpha, and the perturbation energy on the first base
+def space_features(space: list[dict], noise_names: list[str], proc_names: list[str], energy: np.ndarray) -> np.ndarray:
+    X = np.zeros((len(space), len(noise_names) + len(proc_names) + 3))
+    for i, c in enumerate(space):
+        X[i, noise_names.index(c['noise'])] = 1
+        X[i, len(noise_names) + proc_names.index(c['procedural'])] = 1
+        X[i, -3:] = c['target'], c['alpha'], energy[i]
+    return X
+
+# Output file name of a configuration on a base, the same as poison_util.py writes
+def composite_name(base: str, config: dict) -> str:
+    return f'{base}_{config["noise"]}_{config["mask"]}.png'
+
+# Builds composites in memory and scores them with LightShed, or with entropies recorded in a results CSV
+# (replay) to try the search against a finished grid without a checkpoint. Every composite scored counts as a detector call
+class Evaluator:
+    def __init__(self, b_dir: str, n_dir: str, p_dir: str, targets: list[float], generator=None,
+                 device: str = 'cpu', replay: dict = None):
+        self.generator = generator
+        self.device = device
+        self.replay = replay
+        self.calls = 0
+        self.base_names = []
+        bases = []
+        for f in sorted(os.listdir(b_dir)):
+            img, name = load_image(os.path.join(b_dir, f), 'RGB')
+            if img is not None:
+                self.base_names.append(name)
+                bases.append(np.asarray(img, dtype=np.float32))
+        self.bases = np.stack(bases)
+        self.noise_names, self.noises = load_stack(n_dir, 'RGB')
+        # Masks come straight from the procedurals, so no masks folder is needed
+        self.masks = {}
+        self.proc_names = []
+        for f in sorted(os.listdir(p_dir)):
+            img, name = load_image(os.path.join(p_dir, f), 'I;16')
+            if img is not None:
+                self.proc_names.append(name)
+                for t, mask in zip(targets, gamma_masks(img, targets)):
+                    self.masks[f'{name}_{lightness_suffix(t)}'] = mask
+
+    # uint8 composite of one configuration on one base
+    def composite(self, config: dict, base: int) -> np.ndarray:
+        noise = self.noises[self.noise_names.index(config['noise'])]
+        mask = self.masks[config['mask']].astype(np.float32)[:, :, None] * (config['alpha'] / 255)
+        return np.clip(self.bases[base] + noise * mask, 0, 255).astype(np.uint8)
+
+    # Mean absolute change of the base in [0, 1]; the perturbation strength the search maximizes
+    def energy(self, composite: np.ndarray, base: int) -> float:
+        return float(np.abs(composite - self.bases[base]).mean() / 255)
+
+    # Entropy and energy of every (config, base) pair, scored in one batch
+    def evaluate(self, pairs: list[tuple[dict, int]]) -> tuple[np.ndarray, np.ndarray]:
+        composites = [self.composite(c, b) for c, b in pairs]
+        energy = np.array([self.energy(comp, b) for comp, (_, b) in zip(composites, pairs)])
+        self.calls += len(pairs)
+        if self.replay is not None:
+            entropy = np.array([self.replay[composite_name(self.base_names[b], c).lower()] for c, b in pairs])
+        else:
+            entropy, _ = score_batch(self.generator, to_tensor_batch(np.stack(composites)), self.device)
+            entropy = entropy.numpy()
+        return entropy, energy
+
+# Bootstrapped extra-trees over configurations predicting log entropy; the share of trees below the threshold
+# is the estimated chance a configuration goes undetected
+class Surrogate:
+    def __init__(self, seed: int = 0):
+        self.model = ExtraTreesRegressor(n_estimators=100, bootstrap=True, random_state=seed)
+
+    def fit(self, X: np.ndarray, entropy: np.ndarray) -> None:
+        self.model.fit(X, np.log(np.maximum(entropy, 1e-6)))
+
+    # Whether each tree predicts the configurations go undetected, (trees, configurations)
+    def tree_undetected(self, X: np.ndarray) -> np.ndarray:
+        return np.stack([tree.predict(X) for tree in self.model.estimators_]) <= np.log(threshold())
+
+    def p_undetected(self, X: np.ndarray) -> np.ndarray:
+        return self.tree_undetected(X).mean(axis=0)
+
+# Bases each rung of successive halving evaluates a configuration on: 1, eta, eta^2, ... up to every base
+def rung_sizes(n_bases: int, eta: int) -> list[int]:
+    sizes = [1]
+    while sizes[-1] < n_bases:
+        sizes.append(min(n_bases, sizes[-1] * eta))
+    return sizes
+
+# Per-configuration results: undetected share and mean entropy/energy over the bases evaluated so far
+def config_stats(results: dict) -> dict:
+    stats = {}
+    for (i, _), (entropy, energy) in results.items():
+        stats.setdefault(i, []).append((entropy, energy))
+    return {i: {'bases': len(v),
+                'undetected': float(np.mean([e <= threshold() for e, _ in v])),
+                'entropy': float(np.mean([e for e, _ in v])),
+                'energy': float(np.mean([en for _, en in v]))}
+            for i, v in stats.items()}
+
+# Configurations rank by how often they went undetected, then by how strong the perturbation is
+def rank_key(stat: dict) -> tuple[float, float]:
+    return stat['undetected'], stat['energy']
+
+# Asynchronous successive halving with bases as the resource and a surrogate choosing new configurations.
+# Each step fills a batch with promotions first: a configuration in the top 1/eta of its rung is evaluated on the
+# next rung's bases. The rest of the batch is new configurations on one base, picked after `initial` random ones
+# by how far their energy on the first base (known without a detector call) would beat the top-th strongest
+# undetected configuration, if the surrogate expects them to go undetected. A share `explore` is kept random.
+# Stops once budget detector calls are used or the space is exhausted.
+# The last column of X must be that energy. Returns {(config, base): (entropy, energy)}
+def adaptive_search(evaluator: Evaluator, space: list[dict], X: np.ndarray, budget: int, eta: int = 3,
+                    batch_size: int = 16, initial: int = 16, explore: float = 0.1, seed: int = 0, top: int = 10,
+                    verbose: bool = True) -> dict:
+    rng = np.random.default_rng(seed)
+    sizes = rung_sizes(len(evaluator.bases), eta)
+    results = {}
+    rung = {}
+    surrogate = Surrogate(seed)
+    first_energy = X[:, -1]
+
+    while evaluator.calls < budget:
+        room = min(batch_size, budget - evaluator.calls)
+        pairs = []
+        stats = config_stats(results)
+        for k in reversed(range(len(sizes) - 1)):
+            # Ranked against every configuration that reached rung k, including those already promoted
+            reached = sorted((i for i, r in rung.items() if r >= k), key=lambda i: rank_key(stats[i]), reverse=True)
+            for i in reached[:len(reached) // eta]:
+                if rung[i] == k and len(pairs) + sizes[k + 1] - sizes[k] <= room:
+                    rung[i] = k + 1
+                    pairs += [(i, b) for b in range(sizes[k], sizes[k + 1])]
+
+        unseen = np.array([i for i in range(len(space)) if i not in rung])
+        n_new = min(room - len(pairs), len(unseen))
+        if len(results) < initial:
+            n_new = min(n_new, initial - len(results))
+        if n_new > 0:
+            if len(results) < initial:
+                chosen = rng.choice(unseen, n_new, replace=False)
+            else:
+                entropy = np.array([e for e, _ in results.values()])
+                surrogate.fit(X[[i for i, _ in results]], entropy)
+                # Expected improvement over the top-th strongest undetected configuration found so far
+                strongest = [stats[i]['energy'] for i in evasive(stats)]
+                incumbent = strongest[top - 1] if len(strongest) >= top else 0.0
+                gain = np.maximum(first_energy[unseen] - incumbent, 0)
+                if not gain.any():
+                    gain = first_energy[unseen]
+                # Thompson sampling: every pick trusts one random tree, so a batch spreads over plausible regions
+                trees = surrogate.tree_undetected(X[unseen])
+                # The forest's mean only breaks ties, e.g. when the sampled tree expects everything to be detected
+                tie_break = 1e-3 * trees.mean(axis=0) * gain
+                n_random = int(rng.binomial(n_new, explore))
+                picks = []
+                for t in rng.integers(len(trees), size=n_new - n_random):
+                    acquisition = trees[t] * gain + tie_break
+                    acquisition[picks] = -1
+                    picks.append(int(np.argmax(acquisition)))
+                greedy = unseen[picks]
+                rest = np.setdiff1d(unseen, greedy)
+                chosen = np.concatenate([greedy, rng.choice(rest, min(n_random, len(rest)), replace=False)])
+            for i in chosen:
+                rung[int(i)] = 0
+                pairs.append((int(i), 0))
+        if not pairs:
+            break
+
+        entropy, energy = evaluator.evaluate([(space[i], b) for i, b in pairs])
+        for pair, e, en in zip(pairs, entropy, energy):
+            results[pair] = (float(e), float(en))
+        if verbose:
+            found = sum(s['undetected'] == 1 for s in config_stats(results).values())
+            print(f'{evaluator.calls}/{budget} detector calls, {found} undetected configurations so far')
+    return results
+
+# Undetected configurations ordered by perturbation energy, strongest first
+def evasive(stats: dict, min_bases: int = 1) -> list[int]:
+    keep = [i for i, s in stats.items() if s['undetected'] == 1 and s['bases'] >= min_bases]
+    return sorted(keep, key=lambda i: stats[i]['energy'], reverse=True)
+
+# Entropy of every file in a results CSV, for replay; names are lowercased since older runs lowercased them
+def read_replay(csv_path: str) -> dict:
+    from lightshed_analysis import read_results
+    df = next(read_results(csv_path))
+    return dict(zip(df[df.columns[0]].str.lower(), df[df.columns[1]].astype(float)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bases', default=os.path.join(os.getcwd(), 'noise_data', 'bases'), help='Folder containing base images')
+    parser.add_argument('--procedurals', default=os.path.join(os.getcwd(), 'noise_data', 'procedurals'), help='Folder containing procedural noises')
+    parser.add_argument('--noises', default=os.path.join(os.getcwd(), 'noise_data', 'noises'), help='Folder containing noisy images')
+    parser.add_argument('--targets', type=float, nargs='+', default=TARGETS, help='Mask lightness targets (default: TARGETS)')
+    parser.add_argument('--alphas', type=float, nargs='+', default=[0.15], help='Master opacities to search over')
+    parser.add_argument('--budget', type=int, default=64, help='Maximum number of composites scored by LightShed')
+    parser.add_argument('--eta', type=int, default=3, help='Successive halving rate: the top 1/eta of a rung is promoted')
+    parser.add_argument('--batch-size', type=int, default=16, help='Composites per LightShed batch')
+    parser.add_argument('--initial', type=int, default=16, help='Random configurations evaluated before the surrogate is used')
+    parser.add_argument('--explore', type=float, default=0.1, help='Share of new configurations picked at random')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for random choices')
+    parser.add_argument('--top', type=int, default=10, help='Undetected configurations to list')
+    parser.add_argument('--csv', default='adaptive_search.csv', help='CSV every scored composite is written to')
+    parser.add_argument('--pth', help='LightShed checkpoint')
+    parser.add_argument('--replay', help='Score with the entropies in this results CSV instead of LightShed, and compare with its full grid')
+    parser.add_argument('--model-module', default='lightshed_model', help='Module providing setup_generator and load_checkpoint')
+    add_threshold_argument(parser)
+    arg_list = parser.parse_args()
+    use_threshold(arg_list.threshold)
+
+    for directory in (arg_list.bases, arg_list.procedurals, arg_list.noises):
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f'{directory} not found or is not directory')
+    if not all(0 <= a <= 1 for a in arg_list.alphas):
+        raise ValueError('alpha must be between 0.0 and 1.0 inclusive')
+    if not arg_list.pth and not arg_list.replay:
+        raise ValueError('--pth or --replay is required')
+
+    generator = None
+    device = 'cpu'
+    replay = None
+    if arg_list.replay:
+        if len(arg_list.alphas) != 1:
+            raise ValueError('--replay results hold a single alpha')
+        replay = read_replay(arg_list.replay)
+    else:
+        from xai_utils import get_device, load_generator
+        device = get_device()
+        generator = load_generator(arg_list.pth, device, arg_list.model_module)
+
+    evaluator = Evaluator(arg_list.bases, arg_list.noises, arg_list.procedurals, arg_list.targets, generator, device, replay)
+    space = build_space(evaluator.noise_names, evaluator.proc_names, arg_list.targets, arg_list.alphas)
+    if replay is not None:
+        # Only configurations the replayed grid covers on every base can be scored
+        space = [c for c in space if all(composite_name(b, c).lower() in replay for b in evaluator.base_names)]
+    energy = np.array([evaluator.energy(evaluator.composite(c, 0), 0) for c in space])
+    X = space_features(space, evaluator.noise_names, evaluator.proc_names, energy)
+    print(f'{len(space)} configurations x {len(evaluator.bases)} bases')
+
+    results = adaptive_search(evaluator, space, X, arg_list.budget, arg_list.eta, arg_list.batch_size,
+                              arg_list.initial, arg_list.explore, arg_list.seed, arg_list.top)
+
+    with open(arg_list.csv, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER + ['alpha', 'energy'])
+        for (i, b), (entropy, energy) in sorted(results.items()):
+            writer.writerow([composite_name(evaluator.base_names[b], space[i]), f'{entropy:.6f}',
+                             entropy > threshold(), f'{space[i]["alpha"]:g}', f'{energy:.6f}'])
+
+    stats = config_stats(results)
+    found = evasive(stats, min_bases=len(evaluator.bases))
+    print(f'{evaluator.calls} detector calls; {len(found)} configurations undetected on every base')
+    for i in found[:arg_list.top]:
+        c = space[i]
+        print(f'  {c["noise"]:<16} {c["mask"]:<18} alpha {c["alpha"]:<5g} energy {stats[i]["energy"]:.4f} '
+              f'entropy {stats[i]["entropy"]:.4f}')
+
+    if replay is not None:
+        # Same evaluation over the whole grid, to see how much of it the search recovered
+        full = {}
+        for i, c in enumerate(space):
+            for b in range(len(evaluator.bases)):
+                entropy = replay[composite_name(evaluator.base_names[b], c).lower()]
+                full[(i, b)] = (entropy, evaluator.energy(evaluator.composite(c, b), b))
+        truth = evasive(config_stats(full), min_bases=len(evaluator.bases))
+        top = set(truth[:arg_list.top])
+        print(f'Full grid: {len(truth)} undetected configurations in {len(full)} detector calls')
+        print(f'Recovered {len(top & set(found))}/{len(top)} of the grid\'s top {len(top)} undetected configurations '
+              f'and {len(set(truth) & set(found))}/{len(truth)} overall')
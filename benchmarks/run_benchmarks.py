@@ -0,0 +1,353 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import psutil
+import torch
+from PIL import Image
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import xai_utils as xu
+from benchmarks import synthetic
+from benchmarks.standin_lightshed import write_checkpoint, WIDTH
+from poison_util import PNGWriter, TARGETS, gamma_masks, lightness_suffix, iter_sweep, permute_noises_masks
+from lightshed_detect import collate_images, score_batch, run_detection
+from activation_render import compute_activations
+from feature_reduction import REDUCTIONS, reduced_features
+from occlusion import find_groups, occlusion_groups
+from lightshed_analysis import summarize
+
+RESULTS_DIR = os.path.join(REPO_DIR, 'benchmarks', 'results')
+# Stages that need the generator
+MODEL_STAGES = {'forward', 'detect', 'tsne_features', 'activation_hooks'}
+
+# Peak resident memory of this process and its children (e.g. PNG encoders and occlusion workers),
+# sampled by a background thread while the block runs
+class MemorySampler:
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.stop = threading.Event()
+        self.start_rss = 0
+        self.peak_rss = 0
+
+    def rss(self) -> int:
+        total = self.process.memory_info().rss
+        for child in self.process.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error:
+                # Child exited between listing and reading
+                pass
+        return total
+
+    def sample(self) -> None:
+        while not self.stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self.rss())
+
+    def __enter__(self):
+        self.start_rss = self.peak_rss = self.rss()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop.set()
+        self.thread.join()
+        self.peak_rss = max(self.peak_rss, self.rss())
+
+# Fresh empty folder under the work directory, so repeats of a stage never resume earlier output
+def scratch_dir(ctx: dict, stage: str) -> str:
+    ctx['scratch'] += 1
+    path = os.path.join(ctx['workdir'], 'scratch', f'{stage}_{ctx["scratch"]}')
+    os.makedirs(path)
+    return path
+
+# Each stage runs once and returns the number of items it processed
+# Decoding and resizing images to the generator's 512x512 input, as lightshed_detect.py does
+def bench_load_images(ctx: dict) -> int:
+    _, names = collate_images(ctx['images'])
+    return len(names)
+
+# Gamma search and LUT masks for every procedural and target (the work behind gamma_bin_search and generate_masks)
+def bench_gamma_masks(ctx: dict) -> int:
+    return sum(len(gamma_masks(img, ctx['targets'])) for img in ctx['procedural_images'])
+
+# Compositing every base x noise x mask in memory, without encoding
+def bench_composite(ctx: dict) -> int:
+    dirs = ctx['noise_dirs']
+    return sum(1 for _ in iter_sweep(dirs['bases'], dirs['noises'], ctx['masks_dir'], ctx['alpha'], ctx['block']))
+
+# The production sweep: compositing plus PNG encoding in the writer's process pool
+def bench_permute(ctx: dict) -> int:
+    dirs = ctx['noise_dirs']
+    out_dir = scratch_dir(ctx, 'permute')
+    with PNGWriter(out_dir, ctx['workers'], optimize=False, compress_level=ctx['compress_level']) as writer:
+        permute_noises_masks(dirs['bases'], dirs['noises'], ctx['masks_dir'], writer, ctx['alpha'], ctx['block'])
+    return len(writer.entries)
+
+# Generator forward pass and entropy on already decoded images
+def bench_forward(ctx: dict) -> int:
+    batches = torch.split(ctx['tensors'], ctx['batch_size'])
+    for batch in batches:
+        score_batch(ctx['generator'], batch, ctx['device'])
+    return len(ctx['tensors'])
+
+# lightshed_detect.py end to end: DataLoader decoding, forward pass, and checkpointed CSV writes
+def bench_detect(ctx: dict) -> int:
+    csv_path = os.path.join(scratch_dir(ctx, 'detect'), 'detection.csv')
+    count, _ = run_detection(ctx['generator'], ctx['images'], csv_path, ctx['device'], ctx['batch_size'], ctx['loader_workers'])
+    return count
+
+# The t-SNE feature pass with a cold feature cache
+def bench_tsne_features(ctx: dict) -> int:
+    _, kept = reduced_features(scratch_dir(ctx, 'tsne'), ctx['pth'], ctx['generator'], ctx['images'],
+                                 ctx['reduce'], ctx['device'], batch_size=ctx['batch_size'])
+    return len(kept)
+
+# Forward hooks copying the visualized channels of every encoder and the bottleneck
+def bench_activation_hooks(ctx: dict) -> int:
+    for batch in torch.split(ctx['tensors'], ctx['batch_size']):
+        compute_activations(ctx['generator'], batch, ctx['device'])
+    return len(ctx['tensors'])
+
+# Occlusion heatmaps of every perturbed variant against its clean image, as in the notebook
+def bench_occlusion(ctx: dict) -> int:
+    heatmaps = occlusion_groups(find_groups(ctx['training_dir']), workers=ctx['workers'])
+    return sum(len(maps) for maps in heatmaps.values())
+
+# lightshed_analysis.py aggregation of a detection CSV
+def bench_analysis(ctx: dict) -> int:
+    summarize(ctx['results_csv'], ctx['chunksize'])
+    return ctx['rows']
+
+# Stage name -> (function, unit of its items)
+STAGES = {
+    'load_images': (bench_load_images, 'images'),
+    'gamma_masks': (bench_gamma_masks, 'masks'),
+    'composite': (bench_composite, 'composites'),
+    'permute_noises_masks': (bench_permute, 'composites'),
+    'forward': (bench_forward, 'images'),
+    'detect': (bench_detect, 'images'),
+    'tsne_features': (bench_tsne_features, 'images'),
+    'activation_hooks': (bench_activation_hooks, 'images'),
+    'occlusion': (bench_occlusion, 'heatmaps'),
+    'analysis': (bench_analysis, 'rows')
+}
+
+# Runs one stage warmup + repeat times; time, throughput and memory come from the recorded runs
+def run_stage(name: str, ctx: dict, repeat: int, warmup: int) -> dict:
+    function, unit = STAGES[name]
+    for _ in range(warmup):
+        function(ctx)
+    seconds = []
+    peak_rss = 0
+    rss_delta = 0
+    peak_cuda = 0
+    for _ in range(repeat):
+        if ctx['device'] == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+        with MemorySampler() as memory:
+            start = time.perf_counter()
+            items = function(ctx)
+            seconds.append(time.perf_counter() - start)
+        peak_rss = max(peak_rss, memory.peak_rss)
+        rss_delta = max(rss_delta, memory.peak_rss - memory.start_rss)
+        if ctx['device'] == 'cuda':
+            peak_cuda = max(peak_cuda, torch.cuda.max_memory_allocated())
+    median = statistics.median(seconds)
+    return {
+        'items': items,
+        'unit': unit,
+        'seconds': seconds,
+        'median_s': median,
+        'min_s': min(seconds),
+        'throughput': items / median if median > 0 else None,
+        'peak_rss_mb': peak_rss / 2 ** 20,
+        'rss_delta_mb': rss_delta / 2 ** 20,
+        'peak_cuda_mb': peak_cuda / 2 ** 20 if ctx['device'] == 'cuda' else None
+    }
+
+# Commit of the tree being benchmarked and whether tracked files have uncommitted changes
+def git_state() -> tuple[str, bool]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout
+        return commit, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+
+def machine_info(device: str) -> dict:
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'torch': torch.__version__,
+        'torch_threads': torch.get_num_threads(),
+        'device': device,
+        'gpu': torch.cuda.get_device_name() if device == 'cuda' else None
+    }
+
+# Generates the synthetic data set and loads the generator; none of this is timed
+def setup(arg_list, workdir: str, stages: list[str]) -> dict:
+    size = arg_list.size
+    noise_dirs = synthetic.write_noise_data(os.path.join(workdir, 'noise_data'), size, arg_list.bases, arg_list.noises,
+                                            arg_list.procedurals, arg_list.seed)
+    training_dir = os.path.join(workdir, 'training_data')
+    images = synthetic.write_training_data(training_dir, size, arg_list.groups, seed=arg_list.seed)
+    results_csv = os.path.join(workdir, 'results.csv')
+    synthetic.write_results_csv(results_csv, arg_list.rows, arg_list.seed)
+
+    procedural_images = []
+    masks_dir = os.path.join(workdir, 'masks')
+    os.makedirs(masks_dir)
+    for f in sorted(os.listdir(noise_dirs['procedurals'])):
+        img, name = xu.load_image(os.path.join(noise_dirs['procedurals'], f), 'I;16')
+        procedural_images.append(img)
+        for t, mask in zip(arg_list.targets, gamma_masks(img, arg_list.targets)):
+            Image.fromarray(mask).save(os.path.join(masks_dir, f'{name}_{lightness_suffix(t)}.png'))
+
+    ctx = {
+        'workdir': workdir,
+        'scratch': 0,
+        'noise_dirs': noise_dirs,
+        'masks_dir': masks_dir,
+        'training_dir': training_dir,
+        'images': images,
+        'procedural_images': procedural_images,
+        'results_csv': results_csv,
+        'rows': arg_list.rows,
+        'targets': arg_list.targets,
+        'alpha': arg_list.alpha,
+        'block': arg_list.block,
+        'workers': arg_list.workers,
+        'loader_workers': arg_list.loader_workers,
+        'compress_level': arg_list.compress_level,
+        'batch_size': arg_list.batch_size,
+        'reduce': arg_list.reduce,
+        'chunksize': arg_list.chunksize,
+        'device': arg_list.device or xu.get_device(),
+        'pth': arg_list.pth
+    }
+    if MODEL_STAGES & set(stages):
+        if ctx['pth'] is None:
+            ctx['pth'] = os.path.join(workdir, 'standin.pth')
+            write_checkpoint(ctx['pth'], arg_list.width, arg_list.seed)
+        ctx['generator'] = xu.load_generator(ctx['pth'], ctx['device'], arg_list.model_module)
+        ctx['tensors'], _ = collate_images(images)
+    return ctx
+
+# Median time of each stage against a baseline run; a stage regresses when it is slower than tolerance allows,
+# or its memory grew by more than tolerance and at least 32 MB
+def compare(baseline: dict, current: dict, tolerance: float) -> list[str]:
+    if baseline['config'] != current['config']:
+        print('Warning: baseline was run with a different configuration; times are not comparable')
+    if baseline['machine'] != current['machine']:
+        print('Warning: baseline was run on a different machine or software versions')
+    print(f'{"stage":<22} {"baseline":>10} {"current":>10} {"time":>7} {"memory":>7}')
+    regressed = []
+    for name, stage in current['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None:
+            print(f'{name:<22} {"-":>10} {stage["median_s"]:>9.3f}s')
+            continue
+        time_ratio = stage['median_s'] / base['median_s']
+        memory_growth = stage['rss_delta_mb'] - base['rss_delta_mb']
+        memory_ratio = stage['rss_delta_mb'] / max(base['rss_delta_mb'], 1.0)
+        slower = time_ratio > 1 + tolerance
+        heavier = memory_ratio > 1 + tolerance and memory_growth > 32
+        flag = '  REGRESSION' if slower or heavier else ''
+        print(f'{name:<22} {base["median_s"]:>9.3f}s {stage["median_s"]:>9.3f}s {time_ratio:>6.2f}x {memory_ratio:>6.2f}x{flag}')
+        if flag:
+            regressed.append(name)
+    return regressed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=list(STAGES), help='Stages to run (default: all)')
+    parser.add_argument('--out', help='JSON file for the results (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', help='Earlier results JSON; stages slower than --tolerance are reported and the exit status is 1')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='Allowed relative slowdown before a stage counts as a regression')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per stage; the median is reported')
+    parser.add_argument('--warmup', type=int, default=1, help='Untimed runs per stage before the timed ones')
+    parser.add_argument('--size', type=int, default=512, help='Width and height of the synthetic images')
+    parser.add_argument('--bases', type=int, default=1, help='Synthetic base images')
+    parser.add_argument('--noises', type=int, default=6, help='Synthetic noise images')
+    parser.add_argument('--procedurals', type=int, default=6, help='Synthetic 16-bit procedurals')
+    parser.add_argument('--targets', type=float, nargs='+', default=TARGETS, help='Mask lightness targets (default: TARGETS)')
+    parser.add_argument('--groups', type=int, default=8, help='Synthetic clean/glazed/shaded/glazed_shaded groups')
+    parser.add_argument('--rows', type=int, default=200000, help='Rows of the synthetic detection CSV')
+    parser.add_argument('--alpha', type=float, default=0.15, help='Noise opacity for the composite stages')
+    parser.add_argument('--block', type=int, default=32, help='Maximum noise x mask pairs composited at once')
+    parser.add_argument('--workers', type=int, default=None, help='Processes for PNG encoding and occlusion (default: all cores)')
+    parser.add_argument('--loader-workers', type=int, default=0, help='DataLoader processes in the detect stage')
+    parser.add_argument('--compress-level', type=int, default=6, help='PNG compression level in permute_noises_masks')
+    parser.add_argument('--batch-size', type=int, default=16, help='Images per generator batch')
+    parser.add_argument('--reduce', default='none', choices=REDUCTIONS, help='Reduction in the tsne_features stage')
+    parser.add_argument('--chunksize', type=int, default=None, help='Rows per chunk in the analysis stage (default: all at once)')
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op torch threads (default: torch default)')
+    parser.add_argument('--device', help='Device for the generator (default: xai_utils.get_device())')
+    parser.add_argument('--pth', help='Real checkpoint to benchmark with --model-module instead of the stand-in')
+    parser.add_argument('--model-module', default='benchmarks.standin_lightshed', help='Module providing setup_generator and load_checkpoint')
+    parser.add_argument('--width', type=int, default=WIDTH, help='First encoder channels of the stand-in generator')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic data and stand-in weights')
+    parser.add_argument('--workdir', help='Folder for the synthetic data; kept afterwards (default: a temporary folder)')
+    arg_list = parser.parse_args()
+
+    if arg_list.threads:
+        torch.set_num_threads(arg_list.threads)
+    workdir = arg_list.workdir or tempfile.mkdtemp(prefix='lightshed_bench_')
+    if os.path.isdir(os.path.join(workdir, 'scratch')) or os.path.isdir(os.path.join(workdir, 'masks')):
+        raise FileExistsError(f'{workdir} already holds a benchmark run; pass an empty folder')
+    os.makedirs(workdir, exist_ok=True)
+
+    commit, dirty = git_state()
+    config = {k: v for k, v in vars(arg_list).items() if k not in ('stages', 'out', 'compare', 'tolerance', 'workdir')}
+    try:
+        ctx = setup(arg_list, workdir, arg_list.stages)
+        results = {
+            'commit': commit,
+            'dirty': dirty,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'machine': machine_info(ctx['device']),
+            'config': config,
+            'stages': {}
+        }
+        for name in arg_list.stages:
+            stage = run_stage(name, ctx, arg_list.repeat, arg_list.warmup)
+            results['stages'][name] = stage
+            print(f'{name:<22} {stage["median_s"]:>8.3f}s  {stage["throughput"]:>10.1f} {stage["unit"]}/s  '
+                  f'peak {stage["peak_rss_mb"]:>7.0f} MB (+{stage["rss_delta_mb"]:.0f} MB)')
+    finally:
+        if not arg_list.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    out = arg_list.out
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out = os.path.join(RESULTS_DIR, f'{(commit or "unknown")[:12]}{"-dirty" if dirty else ""}.json')
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {out}')
+
+    if arg_list.compare:
+        with open(arg_list.compare) as f:
+            baseline = json.load(f)
+        regressed = compare(baseline, results, arg_list.tolerance)
+        if regressed:
+            print(f'Regressed: {", ".join(regressed)}')
+            sys.exit(1)
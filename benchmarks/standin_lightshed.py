@@ -0,0 +1,88 @@
+import argparse
+import torch
+import torch.nn as nn
+
+# Synthetic stand-in for the private lightshed_model module, with randomly initialized weights
+# Same interface: setup_generator, load_checkpoint, encoder1..4 / bottleneck Sequentials whose [2] is the
+# activation hooked by activation_render.py, and a forward pass returning a poison map the size of the input
+WIDTH = 32
+POISON_SCALE = 0.05
+
+def down(in_ch: int, out_ch: int) -> nn.Sequential:
+    return nn.Sequential(
+        nn.Conv2d(in_ch, out_ch, kernel_size=4, stride=2, padding=1, bias=False),
+        nn.BatchNorm2d(out_ch),
+        nn.LeakyReLU(0.2)
+    )
+
+def up(in_ch: int, out_ch: int) -> nn.Sequential:
+    return nn.Sequential(
+        nn.ConvTranspose2d(in_ch, out_ch, kernel_size=4, stride=2, padding=1, bias=False),
+        nn.BatchNorm2d(out_ch),
+        nn.ReLU()
+    )
+
+# U-Net: four stride-2 encoders (16x downsampling), a bottleneck, and four decoders with skip connections
+class StandInGenerator(nn.Module):
+    def __init__(self, width: int = WIDTH):
+        super().__init__()
+        widths = [width, width * 2, width * 4, width * 8]
+        self.encoder1 = down(3, widths[0])
+        self.encoder2 = down(widths[0], widths[1])
+        self.encoder3 = down(widths[1], widths[2])
+        self.encoder4 = down(widths[2], widths[3])
+        self.bottleneck = nn.Sequential(
+            nn.Conv2d(widths[3], widths[3], kernel_size=3, padding=1, bias=False),
+            nn.BatchNorm2d(widths[3]),
+            nn.ReLU()
+        )
+        self.decoder4 = up(widths[3] * 2, widths[2])
+        self.decoder3 = up(widths[2] * 2, widths[1])
+        self.decoder2 = up(widths[1] * 2, widths[0])
+        self.decoder1 = up(widths[0] * 2, widths[0])
+        self.output = nn.Conv2d(widths[0], 3, kernel_size=1)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        e1 = self.encoder1(x)
+        e2 = self.encoder2(e1)
+        e3 = self.encoder3(e2)
+        e4 = self.encoder4(e3)
+        b = self.bottleneck(e4)
+        d = self.decoder4(torch.cat([b, e4], dim=1))
+        d = self.decoder3(torch.cat([d, e3], dim=1))
+        d = self.decoder2(torch.cat([d, e2], dim=1))
+        d = self.decoder1(torch.cat([d, e1], dim=1))
+        return torch.tanh(self.output(d)) * POISON_SCALE
+
+def setup_generator(width: int = WIDTH) -> tuple[nn.Module, torch.optim.Optimizer]:
+    generator = StandInGenerator(width)
+    optimizer = torch.optim.Adam(generator.parameters(), lr=2e-4, betas=(0.5, 0.999))
+    return generator, optimizer
+
+# Returns (generator, optimizer, epoch, loss) like lightshed_model.load_checkpoint
+def load_checkpoint(checkpoint_path: str, generator: nn.Module, optimizer: torch.optim.Optimizer, device: str):
+    checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=True)
+    if checkpoint['width'] != generator.encoder1[0].out_channels:
+        # setup_generator() is called without arguments by load_generator, so rebuild at the saved width
+        generator = StandInGenerator(checkpoint['width'])
+    generator.load_state_dict(checkpoint['generator'])
+    if optimizer is not None and 'optimizer' in checkpoint:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+    return generator.to(device), optimizer, checkpoint.get('epoch', 0), checkpoint.get('loss', 0.0)
+
+# Writes a checkpoint of a generator initialized from seed, so every run benchmarks the same weights
+def write_checkpoint(checkpoint_path: str, width: int = WIDTH, seed: int = 0) -> None:
+    torch.manual_seed(seed)
+    generator, _ = setup_generator(width)
+    torch.save({'generator': generator.state_dict(), 'width': width, 'epoch': 0, 'loss': 0.0}, checkpoint_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out', default='standin.pth', help='Checkpoint file to write')
+    parser.add_argument('--width', type=int, default=WIDTH, help='Channels of the first encoder; later layers double it')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the random weights')
+    arg_list = parser.parse_args()
+
+    write_checkpoint(arg_list.out, arg_list.width, arg_list.seed)
+    print(f'Stand-in checkpoint written to {arg_list.out}')
@@ -0,0 +1,89 @@
+import os
+import csv
+import numpy as np
+from PIL import Image
+
+VARIANTS = ['clean', 'glazed', 'shaded', 'glazed_shaded']
+# File name suffix of each variant in training_data, e.g. cb_001_shaded_glazed.png
+FILE_SUFFIXES = {'clean': '', 'glazed': '_glazed', 'shaded': '_shaded', 'glazed_shaded': '_shaded_glazed'}
+NOISE_NAMES = ['gauss', 'gauss2x', 'gauss4x', 'glazeHigh', 'shadeHigh', 'shadeGlazeHigh']
+PROCEDURAL_NAMES = ['perlinS08', 'perlinS32', 'cloud2S01', 'cloud2S04', 'voronoiS16', 'waveS08']
+
+# Smooth random field in [0, 1] of shape (size, size, channels): a coarse random grid upsampled bicubically
+def smooth_field(rng: np.random.Generator, size: int, cells: int, channels: int = 1) -> np.ndarray:
+    coarse = rng.random((cells, cells, channels), dtype=np.float32)
+    layers = [np.asarray(Image.fromarray(coarse[:, :, c]).resize((size, size), Image.BICUBIC))
+              for c in range(channels)]
+    return np.clip(np.stack(layers, axis=-1), 0, 1)
+
+# Artwork-like RGB image: smooth colour regions at a few scales plus fine grain, so PNG sizes are realistic
+def synthetic_image(rng: np.random.Generator, size: int = 512) -> np.ndarray:
+    img = 0.6 * smooth_field(rng, size, 4, 3) + 0.3 * smooth_field(rng, size, 16, 3) + 0.1 * smooth_field(rng, size, 64, 3)
+    img += rng.normal(0, 0.01, img.shape).astype(np.float32)
+    return (np.clip(img, 0, 1) * 255).astype(np.uint8)
+
+# Noise image like noise_data/noises: zero-mean Gaussian grain around mid grey, coarser for larger scale
+def synthetic_noise(rng: np.random.Generator, size: int = 512, scale: int = 1, sigma: float = 40) -> np.ndarray:
+    grain = rng.normal(128, sigma, (-(-size // scale), -(-size // scale), 3))
+    grain = np.repeat(np.repeat(grain, scale, axis=0), scale, axis=1)[:size, :size]
+    return np.clip(grain, 0, 255).astype(np.uint8)
+
+# 16-bit procedural like noise_data/procedurals, with feature size set by cells
+def synthetic_procedural(rng: np.random.Generator, size: int = 512, cells: int = 8) -> np.ndarray:
+    return (smooth_field(rng, size, cells)[:, :, 0] * 65535).astype(np.uint16)
+
+# Perturbed variant of an image: glazed adds fine noise, shaded a smooth low-frequency one
+def synthetic_variant(rng: np.random.Generator, image: np.ndarray, variant: str) -> np.ndarray:
+    out = image.astype(np.float32)
+    if 'glazed' in variant:
+        out += rng.normal(0, 6, out.shape)
+    if 'shaded' in variant:
+        out += (smooth_field(rng, image.shape[0], 32, 3) - 0.5) * 24
+    return np.clip(out, 0, 255).astype(np.uint8)
+
+# Writes bases/, noises/ and procedurals/ folders in the layout of noise_data; returns their paths
+def write_noise_data(root: str, size: int = 512, bases: int = 1, noises: int = 6, procedurals: int = 6,
+                     seed: int = 0) -> dict:
+    rng = np.random.default_rng(seed)
+    dirs = {name: os.path.join(root, name) for name in ['bases', 'noises', 'procedurals']}
+    for directory in dirs.values():
+        os.makedirs(directory, exist_ok=True)
+    for i in range(bases):
+        Image.fromarray(synthetic_image(rng, size)).save(os.path.join(dirs['bases'], f'base{i:02d}.png'))
+    for i in range(noises):
+        name = NOISE_NAMES[i % len(NOISE_NAMES)] + (f'{i // len(NOISE_NAMES)}' if i >= len(NOISE_NAMES) else '')
+        Image.fromarray(synthetic_noise(rng, size, 2 ** (i % 3))).save(os.path.join(dirs['noises'], f'{name}.png'))
+    for i in range(procedurals):
+        name = PROCEDURAL_NAMES[i % len(PROCEDURAL_NAMES)] + (f'{i // len(PROCEDURAL_NAMES)}' if i >= len(PROCEDURAL_NAMES) else '')
+        Image.fromarray(synthetic_procedural(rng, size, 4 * 2 ** (i % 4))).save(os.path.join(dirs['procedurals'], f'{name}.png'))
+    return dirs
+
+# Writes groups of clean/glazed/shaded/glazed_shaded images in the style_variant/train layout of training_data
+# Returns the clean and perturbed image paths in a flat list
+def write_training_data(root: str, size: int = 512, groups: int = 8, style: str = 'synthetic', seed: int = 0) -> list[str]:
+    rng = np.random.default_rng(seed)
+    paths = []
+    for variant in VARIANTS:
+        os.makedirs(os.path.join(root, f'{style}_{variant}', 'train'), exist_ok=True)
+    for i in range(groups):
+        clean = synthetic_image(rng, size)
+        for variant in VARIANTS:
+            suffix = FILE_SUFFIXES[variant]
+            path = os.path.join(root, f'{style}_{variant}', 'train', f'sy_{i:03d}{suffix}.png')
+            Image.fromarray(clean if variant == 'clean' else synthetic_variant(rng, clean, variant)).save(path)
+            paths.append(path)
+    return paths
+
+# Writes a detection CSV in the format of detection_analytics.csv with rows results over the usual factors
+def write_results_csv(path: str, rows: int, seed: int = 0) -> None:
+    rng = np.random.default_rng(seed)
+    lightness = [f'L{t:02d}' for t in range(10, 90, 10)]
+    noise = rng.integers(len(NOISE_NAMES), size=rows)
+    mask = rng.integers(len(PROCEDURAL_NAMES), size=rows)
+    light = rng.integers(len(lightness), size=rows)
+    entropy = rng.gamma(1.5, 0.04, size=rows)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['filename', 'entropy', 'is_poisoned'])
+        for n, m, l, e in zip(noise, mask, light, entropy):
+            writer.writerow([f'base_{NOISE_NAMES[n]}_{PROCEDURAL_NAMES[m]}_{lightness[l]}.png', f'{e:.6f}', e > 0.07])
@@ -0,0 +1,162 @@
+import argparse
+import csv
+import os
+import sqlite3
+from PIL import Image
+import xai_utils as xu
+from image_store import variant_of
+
+VARIANTS = ['clean', 'glazed', 'shaded', 'glazed_shaded']
+# Longest suffix first, so cb_002_glazed_shaded loses both parts
+VARIANT_SUFFIXES = ['_glazed_shaded', '_shaded_glazed', '_glazed', '_shaded', '_clean']
+COLUMNS = ['path', 'name', 'base_id', 'style', 'variant', 'caption', 'width', 'height', 'bytes', 'mtime', 'sha256']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    base_id TEXT NOT NULL,
+    style TEXT,
+    variant TEXT NOT NULL,
+    caption TEXT,
+    width INTEGER,
+    height INTEGER,
+    bytes INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_base ON images (base_id, variant);
+CREATE INDEX IF NOT EXISTS images_style_variant ON images (style, variant);
+CREATE INDEX IF NOT EXISTS images_variant ON images (variant);
+CREATE INDEX IF NOT EXISTS images_hash ON images (sha256);
+'''
+
+# Base id of an image file, e.g. cb_002 for cb_002_glazed.jpg
+def base_id(file_name: str) -> str:
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    for suffix in VARIANT_SUFFIXES:
+        if stem.lower().endswith(suffix):
+            return stem[:-len(suffix)]
+    return stem
+
+# Style of an image inside a style_variant/train folder of training_data (comic, materials), else None
+def style_of(path: str) -> str:
+    folder = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(path)))).lower()
+    style, _, variant = folder.partition('_')
+    return style if variant in VARIANTS else None
+
+# Captions from a folder's metadata.csv, keyed by file name
+def read_captions(directory: str) -> dict:
+    meta_path = os.path.join(directory, 'metadata.csv')
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path, newline='', encoding='utf-8') as f:
+        return {row['file_name'].strip(): row['text'].strip() for row in csv.DictReader(f)}
+
+# SQLite index of images with their base id, style, variant, caption, dimensions, mtime and content hash
+# Lookups by base id, style/variant and hash go through indexes
+class Catalogue:
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+
+    # Indexes every image under root; files whose size and mtime are unchanged are not re-read,
+    # and rows for files that disappeared from root are dropped. Returns (added or changed, removed)
+    def scan(self, root: str) -> tuple[int, int]:
+        root = os.path.abspath(root)
+        known = {row['path']: row for row in self.db.execute(
+            'SELECT path, bytes, mtime, caption FROM images WHERE path >= ? AND path < ?', (root + os.sep, root + chr(ord(os.sep) + 1)))}
+        seen = set()
+        rows = []
+        for directory, dirs, files in os.walk(root):
+            dirs.sort()
+            captions = read_captions(directory)
+            for name in sorted(files):
+                if os.path.splitext(name)[1] not in xu.extensions:
+                    continue
+                path = os.path.join(directory, name)
+                seen.add(path)
+                stat = os.stat(path)
+                old = known.get(path)
+                caption = captions.get(name)
+                if old is not None and (old['bytes'], old['mtime'], old['caption']) == (stat.st_size, stat.st_mtime, caption):
+                    continue
+                try:
+                    width, height = Image.open(path).size
+                except Exception as e:
+                    print(f'Error loading {path}')
+                    print(e)
+                    continue
+                rows.append((path, name, base_id(name), style_of(path), variant_of(path), caption, width, height,
+                             stat.st_size, stat.st_mtime, xu.file_hash(path)))
+        removed = [(path,) for path in known.keys() - seen]
+        with self.db:
+            self.db.executemany(f'INSERT OR REPLACE INTO images VALUES ({", ".join("?" * len(COLUMNS))})', rows)
+            self.db.executemany('DELETE FROM images WHERE path = ?', removed)
+        return len(rows), len(removed)
+
+    # Rows matching every given field, e.g. find(style='materials', variant='glazed')
+    def find(self, base_id: str = None, style: str = None, variant: str = None) -> list[dict]:
+        filters = {'base_id': base_id, 'style': style, 'variant': variant}
+        clauses = [f'{column} = ?' for column, value in filters.items() if value is not None]
+        where = f' WHERE {" AND ".join(clauses)}' if clauses else ''
+        query = f'SELECT * FROM images{where} ORDER BY base_id, variant, path'
+        return [dict(row) for row in self.db.execute(query, [v for v in filters.values() if v is not None])]
+
+    # Paths of every variant of one base id, e.g. variants('cb_002') -> {'clean': ..., 'glazed': ...}
+    # Images in style_variant/train folders win over copies of the same base elsewhere
+    def variants(self, base: str) -> dict:
+        rows = sorted(self.find(base_id=base), key=lambda row: row['style'] is not None)
+        return {row['variant']: row['path'] for row in rows}
+
+    # {base_id: {variant: path}} for every base in a style_variant/train folder, the same layout as
+    # occlusion.find_groups; loose copies elsewhere (e.g. tsne_data) are left out
+    def groups(self, style: str = None) -> dict:
+        groups = {}
+        for row in self.find(style=style):
+            if row['style'] is not None:
+                groups.setdefault(row['base_id'], {})[row['variant']] = row['path']
+        return groups
+
+    # Catalogued variant of an image file, found by path or else by content hash; None if it is not catalogued
+    def variant_of(self, path: str) -> str:
+        row = self.db.execute('SELECT variant FROM images WHERE path = ?', (os.path.abspath(path),)).fetchone()
+        if row is None:
+            row = self.db.execute('SELECT variant FROM images WHERE sha256 = ?', (xu.file_hash(path),)).fetchone()
+        return row['variant'] if row is not None else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default=os.path.join(os.getcwd(), 'catalogue.sqlite'), help='SQLite file holding the catalogue')
+    parser.add_argument('--scan', nargs='*', default=[], help='Folders to (re)index, e.g. training_data')
+    parser.add_argument('--base', help="List images with this base id, e.g. 'cb_002'")
+    parser.add_argument('--style', help="List images of this style, e.g. 'materials'")
+    parser.add_argument('--variant', choices=VARIANTS, help='List images of this variant')
+    arg_list = parser.parse_args()
+
+    with Catalogue(arg_list.db) as catalogue:
+        for root in arg_list.scan:
+            if not os.path.isdir(root):
+                raise FileNotFoundError(f'{root} not found or is not directory')
+            changed, removed = catalogue.scan(root)
+            print(f'{root}: {changed} images added or updated, {removed} removed')
+        if arg_list.base or arg_list.style or arg_list.variant:
+            for row in catalogue.find(arg_list.base, arg_list.style, arg_list.variant):
+                print(f'{row["base_id"]:<10} {row["style"] or "-":<10} {row["variant"]:<14} {row["width"]}x{row["height"]}  '
+                      f'{row["path"]}  {row["caption"] or ""}')
+        print(f'{len(catalogue)} images catalogued')
@@ -0,0 +1,104 @@
+import json
+import os
+import numpy as np
+import torch
+import xai_utils as xu
+import instrument
+
+# Persistent store of per-image embeddings, keyed by checkpoint hash, layer name and image content hash
+# Features are kept in .npy shards that are memory-mapped on read, plus an index.json mapping image hashes to (shard, row)
+class FeatureCache:
+    def __init__(self, root: str, checkpoint_path: str, layer: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.hash_memo_path = os.path.join(root, 'hashes.json')
+        self.hash_memo = {}
+        if os.path.exists(self.hash_memo_path):
+            with open(self.hash_memo_path) as f:
+                self.hash_memo = json.load(f)
+        self.dir = os.path.join(root, f'{self.content_hash(checkpoint_path)[:16]}_{layer}')
+        os.makedirs(self.dir, exist_ok=True)
+        self.index_path = os.path.join(self.dir, 'index.json')
+        self.index = {'shards': [], 'entries': {}}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        self.shards = {}
+
+    # Content hash of a file, remembered by path, size and mtime so unchanged files are not re-read
+    def content_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        entry = self.hash_memo.get(key)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': xu.file_hash(path)}
+            self.hash_memo[key] = entry
+        return entry['sha256']
+
+    def save_hashes(self) -> None:
+        tmp_path = f'{self.hash_memo_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.hash_memo, f)
+        os.replace(tmp_path, self.hash_memo_path)
+
+    def __contains__(self, image_hash: str) -> bool:
+        return image_hash in self.index['entries']
+
+    # Read-only memory-mapped view of one image's features
+    def get(self, image_hash: str) -> np.ndarray:
+        shard, row = self.index['entries'][image_hash]
+        if shard not in self.shards:
+            self.shards[shard] = np.load(os.path.join(self.dir, shard), mmap_mode='r')
+        return self.shards[shard][row]
+
+    # Stores a batch of features (one row per hash) as a new shard
+    def add(self, image_hashes: list[str], features: np.ndarray) -> None:
+        shard = f'shard_{len(self.index["shards"]):05d}.npy'
+        np.save(os.path.join(self.dir, shard), np.ascontiguousarray(features, dtype=np.float32))
+        self.index['shards'].append(shard)
+        for row, image_hash in enumerate(image_hashes):
+            self.index['entries'][image_hash] = [shard, row]
+        # Index is replaced atomically, so an interrupted run never points at a missing shard
+        tmp_path = f'{self.index_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+# Returns the content hash of every path, computing features in batches only for images not yet in the cache
+# extract maps a batch of images on device to a batch of features; images that fail to load get None
+# With load, images are read with load(path) instead of as 512x512 tensors and extract gets them as a list
+def update_cache(cache: FeatureCache, paths: list[str], extract, device: str, batch_size: int = 16,
+                 load=None) -> list[str]:
+    from lightshed_xai import load_image
+    with instrument.stage('hash', len(paths)):
+        hashes = [cache.content_hash(p) for p in paths]
+    cache.save_hashes()
+    todo = {}
+    for p, h in zip(paths, hashes):
+        if h not in cache and h not in todo:
+            todo[h] = p
+    if todo:
+        print(f'Computing features for {len(todo)} of {len(paths)} images')
+    todo = list(todo.items())
+    failed = set()
+    for start in range(0, len(todo), batch_size):
+        chunk = []
+        for h, p in todo[start:start + batch_size]:
+            with instrument.stage('decode', 1):
+                img = load(p) if load is not None else load_image(p, unsqueeze=False)
+            if img is None:
+                failed.add(h)
+            else:
+                chunk.append((h, img))
+        if chunk:
+            with instrument.stage('forward', len(chunk)):
+                images = [img for _, img in chunk]
+                features = extract(images if load is not None else torch.stack(images).to(device))
+            with instrument.stage('cache_write', len(chunk)):
+                cache.add([h for h, _ in chunk], features.cpu().reshape(len(chunk), -1).numpy())
+        instrument.step()
+    return [None if h in failed else h for h in hashes]
+
+# Embedding used by t-SNE mode
+def bottleneck_extractor(generator: torch.nn.Module):
+    return lambda images: xu.encode_bottleneck(generator, images)
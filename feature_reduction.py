@@ -0,0 +1,95 @@
+import numpy as np
+import torch
+from sklearn.decomposition import IncrementalPCA
+from sklearn.random_projection import SparseRandomProjection
+import xai_utils as xu
+from feature_cache import FeatureCache, update_cache, bottleneck_extractor
+
+# Valid arguments for --reduce
+REDUCTIONS = ['none', 'avgpool', 'maxpool', 'randproj', 'ipca']
+
+# Bottleneck features as cached for a reduction: pooled over space to one value per channel for avgpool and maxpool,
+# so the cache stores channels instead of channels x H x W
+def cached_features(features: torch.Tensor, method: str) -> torch.Tensor:
+    if method == 'avgpool':
+        return features.mean(dim=(2, 3))
+    if method == 'maxpool':
+        return features.amax(dim=(2, 3))
+    return features
+
+def pooled_extractor(generator: torch.nn.Module, pool: str):
+    return lambda images: cached_features(xu.encode_bottleneck(generator, images), pool)
+
+# Per-channel mean of the bottleneck over whole images at their native resolution, encoded tile by tile
+def tiled_extractor(generator: torch.nn.Module, device: str, tile: int, overlap: int, batch_size: int):
+    from tiled_inference import tiled_embedding
+    return lambda images: torch.stack([tiled_embedding(generator, image, device, tile, overlap, batch_size)[1]
+                                       for image in images])
+
+# Feature cache holding the embeddings a reduction starts from
+def reduction_cache(cache_root: str, checkpoint_path: str, method: str, tile: int = None,
+                    overlap: int = 0) -> FeatureCache:
+    if tile:
+        return FeatureCache(cache_root, checkpoint_path, f'bottleneck0_tiled{tile}o{overlap}')
+    if method in ('avgpool', 'maxpool'):
+        return FeatureCache(cache_root, checkpoint_path, f'bottleneck0_{method}')
+    return FeatureCache(cache_root, checkpoint_path, 'bottleneck0')
+
+# Splits row indices into batches of at least min_rows each (when there are that many rows)
+def split_rows(n_rows: int, batch_size: int, min_rows: int = 1) -> list[np.ndarray]:
+    n_batches = max(1, n_rows // max(batch_size, min_rows))
+    return np.array_split(np.arange(n_rows), n_batches)
+
+# Dense batch of cached features; only this batch is held in memory
+def load_rows(cache: FeatureCache, hashes: list[str], rows: np.ndarray) -> np.ndarray:
+    return np.stack([cache.get(hashes[i]) for i in rows]).astype(np.float32, copy=False)
+
+# Seeded sparse random projection to components dimensions, applied batch by batch
+# Sparse so the projection matrix stays small even for hundreds of thousands of input features
+def random_projection(cache: FeatureCache, hashes: list[str], components: int, seed: int = 0,
+                      batch_size: int = 256) -> np.ndarray:
+    n_features = cache.get(hashes[0]).shape[0]
+    projection = SparseRandomProjection(n_components=min(components, n_features), random_state=seed)
+    projection.fit(np.zeros((1, n_features), dtype=np.float32))
+    return np.concatenate([projection.transform(load_rows(cache, hashes, rows))
+                           for rows in split_rows(len(hashes), batch_size)])
+
+# PCA to components dimensions, fitted and applied in streaming batches
+def incremental_pca(cache: FeatureCache, hashes: list[str], components: int, batch_size: int = 256) -> np.ndarray:
+    components = min(components, len(hashes), cache.get(hashes[0]).shape[0])
+    # partial_fit needs at least components rows per batch
+    batches = split_rows(len(hashes), batch_size, components)
+    pca = IncrementalPCA(n_components=components)
+    for rows in batches:
+        pca.partial_fit(load_rows(cache, hashes, rows))
+    return np.concatenate([pca.transform(load_rows(cache, hashes, rows)) for rows in batches])
+
+# Embeddings of every loadable path after the chosen reduction, and the indices of those paths
+# Peak memory is bounded by the batch size for every method except 'none', which stacks the full feature maps
+# With tile, images are embedded at their native resolution (tiled_inference.tiled_embedding) instead of resized
+# to 512x512; those embeddings are already per-channel means, so avgpool and maxpool add nothing to them
+def reduced_features(cache_root: str, checkpoint_path: str, generator: torch.nn.Module, paths: list[str],
+                     method: str, device: str, components: int = 50, seed: int = 0,
+                     batch_size: int = 16, reduce_batch_size: int = 256, tile: int = None,
+                     overlap: int = 0) -> tuple[np.ndarray, list[int]]:
+    if method not in REDUCTIONS:
+        raise ValueError(f'reduction must be one of {REDUCTIONS}')
+    cache = reduction_cache(cache_root, checkpoint_path, method, tile, overlap)
+    if tile:
+        from tiled_inference import load_full_image
+        # Images are encoded one after another, batch_size tiles per forward pass
+        hashes = update_cache(cache, paths, tiled_extractor(generator, device, tile, overlap, batch_size), device,
+                              batch_size, load_full_image)
+    else:
+        extract = pooled_extractor(generator, method) if method in ('avgpool', 'maxpool') else bottleneck_extractor(generator)
+        hashes = update_cache(cache, paths, extract, device, batch_size)
+    kept = [i for i, h in enumerate(hashes) if h is not None]
+    hashes = [hashes[i] for i in kept]
+    if not hashes:
+        return np.empty((0, 0), dtype=np.float32), kept
+
+    if method == 'randproj':
+        return random_projection(cache, hashes, components, seed, reduce_batch_size), kept
+    if method == 'ipca':
+        return incremental_pca(cache, hashes, components, reduce_batch_size), kept
+    return load_rows(cache, hashes, np.arange(len(hashes))), kept
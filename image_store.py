@@ -0,0 +1,188 @@
+import argparse
+import glob
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+import torch
+from PIL import Image
+import xai_utils as xu
+
+# Images are stored at the resolution the LightShed tools resize to
+IMAGE_SIZE = 512
+SHARD_SIZE = 1024
+INDEX_FILE = 'index.json'
+
+# Variant label of an image: from a training_data style_variant folder if it is in one, else from its name
+def variant_of(path: str) -> str:
+    folder = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(path)))).lower()
+    _, _, variant = folder.partition('_')
+    if variant in ('clean', 'glazed', 'shaded', 'glazed_shaded'):
+        return variant
+    name = os.path.basename(path)
+    if xu.is_shaded_glazed(name):
+        return 'glazed_shaded'
+    elif xu.is_glazed(name):
+        return 'glazed'
+    elif xu.is_shaded(name):
+        return 'shaded'
+    return 'clean'
+
+# Decoded, pre-resized uint8 images in memory-mapped N x 512 x 512 x 3 .npy shards, with an index of
+# paths, content hashes and variant labels. Reads are zero-copy views into the shards
+class ImageStore:
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.index_path = os.path.join(root, INDEX_FILE)
+        self.index = {'size': IMAGE_SIZE, 'shards': [], 'entries': []}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        # Entries in index order; a re-ingested path moves to the end in O(1) instead of a list removal
+        self.by_path = OrderedDict((e['path'], e) for e in self.index['entries'])
+        self.by_hash = {e['sha256']: e for e in self.index['entries']}
+        self.shards = {}
+
+    def __len__(self) -> int:
+        return len(self.by_path)
+
+    # Index entry for a file, or None if it is not stored or has changed on disk since
+    def entry(self, path: str) -> dict:
+        entry = self.by_path.get(os.path.abspath(path))
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if stat.st_size != entry['bytes'] or stat.st_mtime != entry['mtime']:
+            return None
+        return entry
+
+    def _shard(self, name: str) -> np.ndarray:
+        if name not in self.shards:
+            # Copy-on-write so torch.from_numpy accepts the view without copying
+            self.shards[name] = np.load(os.path.join(self.root, name), mmap_mode='c')
+        return self.shards[name]
+
+    # Zero-copy H x W x 3 uint8 view of a stored image, looked up by entry, path or content hash
+    def array(self, key) -> np.ndarray:
+        entry = key if isinstance(key, dict) else self.entry(key) or self.by_hash.get(key)
+        if entry is None:
+            raise KeyError(key)
+        return self._shard(entry['shard'])[entry['row']]
+
+    # uint8 tensor sharing memory with the shard; (3, H, W) if channels_first
+    def uint8_tensor(self, key, channels_first: bool = True) -> torch.Tensor:
+        tensor = torch.from_numpy(self.array(key))
+        return tensor.permute(2, 0, 1) if channels_first else tensor
+
+    # Float tensor in [0, 1] as produced by lightshed_xai.load_image
+    def tensor(self, key) -> torch.Tensor:
+        return self.uint8_tensor(key).float().div_(255)
+
+    # Decodes and stores every path not already stored with the same contents; returns how many were added
+    def ingest(self, paths: list[str], shard_size: int = SHARD_SIZE) -> int:
+        todo = []
+        for path in paths:
+            if os.path.splitext(path)[1] not in xu.extensions or self.entry(path) is not None:
+                continue
+            todo.append(path)
+        added = 0
+        for start in range(0, len(todo), shard_size):
+            added += self._write_shard(todo[start:start + shard_size])
+        return added
+
+    def _write_shard(self, paths: list[str]) -> int:
+        size = self.index['size']
+        name = f'shard_{len(self.index["shards"]):05d}.npy'
+        shard = np.lib.format.open_memmap(os.path.join(self.root, name), mode='w+', dtype=np.uint8,
+                                          shape=(len(paths), size, size, 3))
+        entries = []
+        for path in paths:
+            try:
+                img = Image.open(path)
+                width, height = img.size
+                # Same resampling as transforms.Resize on a PIL image
+                shard[len(entries)] = np.asarray(img.convert('RGB').resize((size, size), Image.BILINEAR))
+            except Exception as e:
+                print(f'Error loading {path}')
+                print(e)
+                continue
+            stat = os.stat(path)
+            entries.append({
+                'path': os.path.abspath(path),
+                'name': os.path.basename(path),
+                'sha256': xu.file_hash(path),
+                'variant': variant_of(path),
+                'width': width,
+                'height': height,
+                'bytes': stat.st_size,
+                'mtime': stat.st_mtime,
+                'shard': name,
+                'row': len(entries)
+            })
+        shard.flush()
+        del shard
+        self.index['shards'].append({'file': name, 'count': len(entries)})
+        for entry in entries:
+            old = self.by_path.get(entry['path'])
+            if old is not None and self.by_hash.get(old['sha256']) is old:
+                del self.by_hash[old['sha256']]
+            self.by_path[entry['path']] = entry
+            self.by_path.move_to_end(entry['path'])
+            self.by_hash[entry['sha256']] = entry
+        self.index['entries'] = list(self.by_path.values())
+        # Index is replaced atomically, so an interrupted ingest never points at a missing shard
+        tmp_path = f'{self.index_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+        return len(entries)
+
+# Store consulted by the image loaders, if any
+_active_store = None
+
+def use_image_store(store) -> None:
+    global _active_store
+    _active_store = ImageStore(store) if isinstance(store, str) else store
+
+def active_store() -> ImageStore:
+    return _active_store
+
+# Stored pixels of path from the active store, or None if there is no store or the file is not in it
+# With native_only, images that had to be resized when stored are treated as missing
+def lookup(path: str, native_only: bool = False) -> np.ndarray:
+    if _active_store is None:
+        return None
+    entry = _active_store.entry(path)
+    if entry is None:
+        return None
+    size = _active_store.index['size']
+    if native_only and (entry['width'], entry['height']) != (size, size):
+        return None
+    return _active_store.array(entry)
+
+# Expands folders and glob patterns (e.g. training_data/*/train) into image paths
+def expand_sources(sources: list[str]) -> list[str]:
+    paths = []
+    for source in sources:
+        for match in sorted(glob.glob(source)) or [source]:
+            if os.path.isdir(match):
+                paths += [os.path.join(match, f) for f in sorted(os.listdir(match))]
+            elif os.path.isfile(match):
+                paths.append(match)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--store', default=os.path.join(os.getcwd(), '.image_store'), help='Directory holding the store')
+    parser.add_argument('--ingest', nargs='+', required=True, help="Folders, files or glob patterns to add, e.g. 'training_data/*/train'")
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE, help='Images per shard file')
+    arg_list = parser.parse_args()
+
+    store = ImageStore(arg_list.store)
+    added = store.ingest(expand_sources(arg_list.ingest), arg_list.shard_size)
+    print(f'Added {added} images; store holds {len(store)}')
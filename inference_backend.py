@@ -0,0 +1,188 @@
+import argparse
+import copy
+import os
+import time
+import torch
+from lightshed_detect import poison_entropy, threshold, use_threshold, add_threshold_argument
+
+# Options that can be combined into a backend spec such as 'channels_last+bf16+compile'
+# 'fp32' on its own is plain eager inference, the reference every other spec is checked against
+# There is no dynamic int8 option: PyTorch's dynamic quantization only covers Linear and recurrent layers,
+# and LightShed's generator is all convolutions, so it would leave the model unchanged
+BACKEND_OPTIONS = ['channels_last', 'bf16', 'compile', 'int8_static']
+
+# Splits a backend spec into its options
+def parse_backend(spec: str) -> set[str]:
+    options = {o for o in spec.split('+') if o and o != 'fp32'}
+    unknown = options - set(BACKEND_OPTIONS)
+    if unknown:
+        raise ValueError(f'Unknown backend option(s) {sorted(unknown)}; choose from fp32, {", ".join(BACKEND_OPTIONS)}')
+    return options
+
+# Intra-op and inter-op thread pools; the inter-op size can only be set before torch runs anything parallel
+def set_threads(threads: int = None, interop_threads: int = None) -> None:
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            print(f'Could not set inter-op threads: {e}')
+
+# Runs a generator with its input in the requested memory format and, optionally, under bf16 autocast
+# Output is always contiguous fp32, so entropy and CSV values are computed the same way as in eager mode
+class BackendGenerator(torch.nn.Module):
+    def __init__(self, model: torch.nn.Module, channels_last: bool = False, bf16: bool = False):
+        super().__init__()
+        self.model = model
+        self.channels_last = channels_last
+        self.bf16 = bf16
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        if self.channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(images.device.type, dtype=torch.bfloat16, enabled=self.bf16):
+            poison = self.model(images)
+        return poison.float().contiguous()
+
+# Post-training static int8 quantization with FX graph mode; needs a few representative images to calibrate
+# activation ranges
+def quantize(generator: torch.nn.Module, calibration: torch.Tensor = None) -> torch.nn.Module:
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    if calibration is None or len(calibration) == 0:
+        raise ValueError('int8_static needs calibration images')
+    prepared = prepare_fx(generator, get_default_qconfig_mapping('x86'), example_inputs=(calibration[:1],))
+    with torch.inference_mode():
+        for start in range(0, len(calibration), 8):
+            prepared(calibration[start:start + 8])
+    return convert_fx(prepared)
+
+# Copy of generator set up for the backend spec; the original generator is left untouched
+# Quantized models only run on the CPU
+def optimize_generator(generator: torch.nn.Module, spec: str, device: str = 'cpu',
+                       calibration: torch.Tensor = None) -> torch.nn.Module:
+    options = parse_backend(spec)
+    if not options:
+        return generator
+    model = copy.deepcopy(generator).eval()
+    if 'int8_static' in options:
+        if device != 'cpu':
+            raise ValueError('int8 backends only run on the CPU')
+        model = quantize(model.cpu(), calibration)
+    if 'channels_last' in options:
+        model = model.to(memory_format=torch.channels_last)
+    model = BackendGenerator(model, 'channels_last' in options, 'bf16' in options)
+    if 'compile' in options:
+        model = torch.compile(model)
+    return model.eval()
+
+# optimize_generator for the scoring CLIs: load_calibration() is only called, and images only decoded, for
+# int8_static, and a backend that cannot be set up (e.g. a model FX cannot trace) falls back to the fp32
+# generator with a warning instead of ending the run
+def backend_generator(generator: torch.nn.Module, spec: str, device: str, load_calibration=None) -> torch.nn.Module:
+    options = parse_backend(spec)
+    if not options:
+        return generator
+    try:
+        calibration = load_calibration() if 'int8_static' in options and load_calibration else None
+        model = optimize_generator(generator, spec, device, calibration)
+    except Exception as e:
+        print(f'Warning: backend {spec} could not be set up, falling back to fp32: {e}')
+        return generator
+    print(f'Backend: {spec}')
+    return model
+
+# Reconstructed poison of images in batches, with the time spent in forward passes
+def reconstruct(generator: torch.nn.Module, images: torch.Tensor, device: str,
+                batch_size: int = 16) -> tuple[torch.Tensor, float]:
+    poison = []
+    seconds = 0.0
+    with torch.inference_mode():
+        for start in range(0, len(images), batch_size):
+            batch = images[start:start + batch_size].to(device)
+            begin = time.perf_counter()
+            out = generator(batch)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            seconds += time.perf_counter() - begin
+            poison.append(out.float().cpu())
+    return torch.cat(poison), seconds
+
+# Compares a backend against the fp32 reference on the same images: poison deviation, entropy deviation,
+# detection decisions that change, and throughput. The first pass is a warm-up (compilation, allocation)
+# and is not timed
+def fidelity(reference: torch.nn.Module, candidate: torch.nn.Module, images: torch.Tensor, device: str,
+             batch_size: int = 16, file_names: list[str] = None, reference_poison: torch.Tensor = None) -> dict:
+    if reference_poison is None:
+        reference_poison, _ = reconstruct(reference, images, device, batch_size)
+    reconstruct(candidate, images[:batch_size], device, batch_size)
+    poison, seconds = reconstruct(candidate, images, device, batch_size)
+
+    deviation = (poison - reference_poison).abs()
+    reference_entropy = poison_entropy(reference_poison)
+    entropy = poison_entropy(poison)
+    flipped = ((entropy > threshold()) != (reference_entropy > threshold())).nonzero().flatten().tolist()
+    file_names = file_names or [str(i) for i in range(len(images))]
+    return {
+        'max_poison_deviation': deviation.max().item(),
+        'mean_poison_deviation': deviation.mean().item(),
+        'max_entropy_deviation': (entropy - reference_entropy).abs().max().item(),
+        'flipped': [file_names[i] for i in flipped],
+        'images_per_second': len(images) / max(seconds, 1e-9)
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pth', required=True, help='The path to the checkpoint file')
+    parser.add_argument('--images', nargs='+', help='The path(s) to the input image(s)')
+    parser.add_argument('--folder', help='The path to the directory containing input images')
+    parser.add_argument('--backends', nargs='+', default=['channels_last', 'bf16', 'channels_last+bf16', 'compile', 'int8_static'],
+                        help=f'Backend specs to compare with fp32, options joined with + from: {", ".join(BACKEND_OPTIONS)}')
+    parser.add_argument('--batch-size', type=int, default=16, help='Images per forward pass')
+    parser.add_argument('--calibration', type=int, default=16, help='Images used to calibrate int8_static')
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op threads (default: torch default)')
+    parser.add_argument('--interop-threads', type=int, default=None, help='Inter-op threads (default: torch default)')
+    parser.add_argument('--model-module', default='lightshed_model', help='Module providing setup_generator and load_checkpoint')
+    add_threshold_argument(parser)
+    arg_list = parser.parse_args()
+    use_threshold(arg_list.threshold)
+
+    if not arg_list.images and not arg_list.folder:
+        raise ValueError('--images or --folder is required')
+    if arg_list.folder and not os.path.isdir(arg_list.folder):
+        raise FileNotFoundError(f'{arg_list.folder} not found or is not directory')
+    for spec in arg_list.backends:
+        parse_backend(spec)
+
+    set_threads(arg_list.threads, arg_list.interop_threads)
+    import xai_utils as xu
+    from lightshed_detect import list_images
+    from lightshed_xai import load_multi_images
+    paths = list(arg_list.images or [])
+    if arg_list.folder:
+        paths += list_images(arg_list.folder)
+
+    device = xu.get_device()
+    print(f'Device: {device}, {torch.get_num_threads()} intra-op / {torch.get_num_interop_threads()} inter-op threads')
+    generator = xu.load_generator(arg_list.pth, device, arg_list.model_module)
+    images, file_names = load_multi_images(paths)
+    if not file_names:
+        raise ValueError('No images could be loaded')
+
+    reconstruct(generator, images[:arg_list.batch_size], device, arg_list.batch_size)
+    reference_poison, seconds = reconstruct(generator, images, device, arg_list.batch_size)
+    print(f'{"backend":<28} {"images/s":>9} {"max dev":>10} {"mean dev":>10} {"max dH":>10}  flips')
+    print(f'{"fp32":<28} {len(images) / max(seconds, 1e-9):>9.1f} {0:>10.3g} {0:>10.3g} {0:>10.3g}  0')
+    for spec in arg_list.backends:
+        try:
+            calibration = images[:arg_list.calibration] if 'int8_static' in parse_backend(spec) else None
+            candidate = optimize_generator(generator, spec, device, calibration)
+            report = fidelity(generator, candidate, images, device, arg_list.batch_size, file_names, reference_poison)
+        except Exception as e:
+            print(f'{spec:<28} failed: {e}')
+            continue
+        print(f'{spec:<28} {report["images_per_second"]:>9.1f} {report["max_poison_deviation"]:>10.3g} '
+              f'{report["mean_poison_deviation"]:>10.3g} {report["max_entropy_deviation"]:>10.3g}  '
+              f'{len(report["flipped"])}{" " + ", ".join(report["flipped"][:5]) if report["flipped"] else ""}')
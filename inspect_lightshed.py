@@ -1,15 +1,175 @@
 import argparse
-import collections
+import json
+import os
+import pickle
+import struct
+import zipfile
 import torch
 
+# Reads only the JSON header of a .safetensors file, never the tensor data
+def read_safetensors_header(path: str) -> dict:
+    with open(path, 'rb') as f:
+        (length,) = struct.unpack('<Q', f.read(8))
+        return json.loads(f.read(length))
+
+def is_safetensors(path: str) -> bool:
+    return os.path.splitext(path)[1] == '.safetensors'
+
+# Memory-maps a .pth checkpoint; tensors are only paged in when their data is touched
+# Legacy (pre-zip) checkpoints cannot be memory-mapped and are read into memory instead
+# unsafe allows arbitrary pickled objects, which can run code: only for checkpoints from a trusted source
+def load_pth(path: str, unsafe: bool = False) -> dict:
+    return torch.load(path, map_location='cpu', mmap=zipfile.is_zipfile(path), weights_only=not unsafe)
+
+# Flat {name: value} entries of a .pth checkpoint, loaded once and shared by describe, iter_tensors and
+# non_tensors; None for .safetensors files, which are read lazily from their header
+def load_entries(path: str, unsafe: bool = False) -> dict:
+    return None if is_safetensors(path) else flatten(load_pth(path, unsafe))
+
+# Flattens nested dicts of a checkpoint into {'outer.inner': value}
+def flatten(tree: dict, prefix: str = '') -> dict:
+    flat = {}
+    for key, value in tree.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{name}.'))
+        else:
+            flat[name] = value
+    return flat
+
+# One row per entry: name, dtype, shape and size in bytes (None for non-tensor values)
+def describe(path: str, unsafe: bool = False, entries: dict = None) -> list[dict]:
+    rows = []
+    if is_safetensors(path):
+        for name, info in read_safetensors_header(path).items():
+            if name == '__metadata__':
+                continue
+            start, end = info['data_offsets']
+            rows.append({'name': name, 'dtype': info['dtype'], 'shape': info['shape'], 'bytes': end - start})
+    else:
+        for name, value in (entries if entries is not None else load_entries(path, unsafe)).items():
+            if isinstance(value, torch.Tensor):
+                rows.append({'name': name, 'dtype': str(value.dtype).replace('torch.', ''),
+                             'shape': list(value.shape), 'bytes': value.numel() * value.element_size()})
+            else:
+                rows.append({'name': name, 'dtype': type(value).__name__, 'shape': None, 'bytes': None})
+    return rows
+
+# Yields (name, tensor) one at a time so only one tensor per file is resident
+def iter_tensors(path: str, names: list[str], unsafe: bool = False, entries: dict = None):
+    if is_safetensors(path):
+        from safetensors import safe_open
+        with safe_open(path, framework='pt') as f:
+            for name in names:
+                yield name, f.get_tensor(name)
+    else:
+        flat = entries if entries is not None else load_entries(path, unsafe)
+        for name in names:
+            yield name, flat[name]
+
+# Non-tensor entries of a .pth checkpoint (epochs, hyperparameters, ...); .safetensors files hold only tensors
+def non_tensors(path: str, unsafe: bool = False, entries: dict = None) -> dict:
+    if is_safetensors(path):
+        return {}
+    flat = entries if entries is not None else load_entries(path, unsafe)
+    return {k: v for k, v in flat.items() if not isinstance(v, torch.Tensor)}
+
+# Compares two checkpoints or LoRA files tensor by tensor; non-tensor entries are compared by value
+# Each .pth file is loaded once
+def diff(path_a: str, path_b: str, unsafe: bool = False) -> list[dict]:
+    entries_a, entries_b = load_entries(path_a, unsafe), load_entries(path_b, unsafe)
+    rows_a = {r['name']: r for r in describe(path_a, unsafe, entries_a)}
+    rows_b = {r['name']: r for r in describe(path_b, unsafe, entries_b)}
+    rows = [{'name': n, 'status': 'only in a'} for n in sorted(rows_a.keys() - rows_b.keys())]
+    rows += [{'name': n, 'status': 'only in b'} for n in sorted(rows_b.keys() - rows_a.keys())]
+
+    both = sorted(rows_a.keys() & rows_b.keys())
+    mixed = [n for n in both if (rows_a[n]['bytes'] is None) != (rows_b[n]['bytes'] is None)]
+    rows += [{'name': n, 'status': f'type {rows_a[n]["dtype"]} vs {rows_b[n]["dtype"]}'} for n in mixed]
+    plain = [n for n in both if rows_a[n]['bytes'] is None and rows_b[n]['bytes'] is None]
+    if plain:
+        values_a, values_b = non_tensors(path_a, unsafe, entries_a), non_tensors(path_b, unsafe, entries_b)
+        for name in plain:
+            a, b = values_a[name], values_b[name]
+            same = type(a) is type(b) and a == b
+            rows.append({'name': name, 'status': 'same' if same else f'value {a!r} vs {b!r}'})
+
+    common = [n for n in both if rows_a[n]['bytes'] is not None and rows_b[n]['bytes'] is not None]
+    for (name, a), (_, b) in zip(iter_tensors(path_a, common, unsafe, entries_a),
+                                 iter_tensors(path_b, common, unsafe, entries_b)):
+        if a.shape != b.shape:
+            rows.append({'name': name, 'status': f'shape {list(a.shape)} vs {list(b.shape)}'})
+            continue
+        a = a.double()
+        b = b.double()
+        delta = (a - b).abs().flatten()
+        max_abs = delta.max().item() if delta.numel() else 0.0
+        norm = a.norm().item()
+        rows.append({
+            'name': name,
+            'status': 'same' if max_abs == 0 else 'changed',
+            'max_abs': max_abs,
+            'mean_abs': delta.mean().item() if delta.numel() else 0.0,
+            'rel_l2': delta.norm().item() / norm if norm else 0.0
+        })
+    return rows
+
+def format_bytes(n: int) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024:
+            return f'{n:.0f} {unit}' if unit == 'B' else f'{n:.1f} {unit}'
+        n /= 1024
+    return f'{n:.1f} TB'
+
+def print_table(rows: list[dict]) -> None:
+    width = max([len(r['name']) for r in rows] + [4])
+    print(f'{"name":<{width}}  {"dtype":<10} {"shape":<22} {"size":>10}')
+    for r in rows:
+        shape = '' if r['shape'] is None else str(tuple(r['shape']))
+        size = '' if r['bytes'] is None else format_bytes(r['bytes'])
+        print(f'{r["name"]:<{width}}  {r["dtype"]:<10} {shape:<22} {size:>10}')
+    total = sum(r['bytes'] for r in rows if r['bytes'] is not None)
+    print(f'{len(rows)} entries, {format_bytes(total)}')
+
+def print_diff(rows: list[dict]) -> None:
+    width = max([len(r['name']) for r in rows] + [4])
+    print(f'{"name":<{width}}  {"status":<10} {"max |a-b|":>12} {"mean |a-b|":>12} {"rel L2":>10}')
+    for r in rows:
+        if 'max_abs' in r:
+            print(f'{r["name"]:<{width}}  {r["status"]:<10} {r["max_abs"]:>12.4g} {r["mean_abs"]:>12.4g} {r["rel_l2"]:>10.4g}')
+        else:
+            print(f'{r["name"]:<{width}}  {r["status"]}')
+    changed = sum(r['status'] != 'same' for r in rows)
+    print(f'{len(rows)} entries, {changed} differ')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--pth_dir', required=True, help='The path to the checkpoint file')
+    parser.add_argument('--pth_dir', required=True, help='The path to the checkpoint (.pth) or LoRA weights (.safetensors) file')
+    parser.add_argument('--diff', help='A second file to compare against tensor by tensor')
+    parser.add_argument('--json', action='store_true', help='Print JSON instead of a table')
+    parser.add_argument('--unsafe', action='store_true',
+                        help='Unpickle arbitrary objects in .pth files; this can run code, so only use it on trusted files')
     arg_list = parser.parse_args()
 
-    checkpoint = torch.load(arg_list.pth_dir, map_location='cpu')
-    for i in checkpoint.keys():
-        print(i)
-        if type(checkpoint[i]) is dict or type(checkpoint[i]) is collections.OrderedDict:
-            for j in checkpoint[i].keys():
-                print(f'    {j}')
\ No newline at end of file
+    for path in (arg_list.pth_dir, arg_list.diff):
+        if path is not None and not os.path.isfile(path):
+            raise FileNotFoundError(f'{path} not found or is not a file')
+
+    try:
+        if arg_list.diff:
+            rows = diff(arg_list.pth_dir, arg_list.diff, arg_list.unsafe)
+        else:
+            rows = describe(arg_list.pth_dir, arg_list.unsafe)
+    except pickle.UnpicklingError as e:
+        # weights_only loading refuses objects other than tensors and plain containers
+        print(e)
+        print('The checkpoint holds objects that weights-only loading refuses. If you trust the file, rerun with --unsafe')
+        quit()
+
+    if arg_list.json:
+        print(json.dumps(rows, indent=2))
+    elif arg_list.diff:
+        print_diff(rows)
+    else:
+        print_table(rows)
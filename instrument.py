@@ -0,0 +1,208 @@
+import atexit
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+import psutil
+
+PROFILERS = ['cprofile', 'torch']
+# Functions or operators listed in a profile record
+PROFILE_TOP = 20
+
+# Per-stage timers, item counters, queue depth gauges and memory samples of one run, written as JSON lines
+# A background thread appends a 'sample' record every interval seconds and close() appends a 'summary'
+# With a profiler, batches profile_skip + 1 to profile_skip + profile_batches (counted by step()) are profiled
+class Instrumentation:
+    def __init__(self, log_path: str, interval: float = 5.0, profiler: str = None, profile_batches: int = 10,
+                 profile_skip: int = 5):
+        if profiler is not None and profiler not in PROFILERS:
+            raise ValueError(f'profiler must be one of {PROFILERS}')
+        self.log_path = log_path
+        self.interval = interval
+        self.profiler = profiler
+        self.profile_batches = profile_batches
+        self.profile_skip = profile_skip
+        self.active_profile = None
+        self.batches = 0
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.process = psutil.Process()
+        self.peak_rss = 0
+        self.start = time.perf_counter()
+        self.log = open(log_path, 'a')
+        self.write({'event': 'start', 'argv': sys.argv, 'pid': os.getpid(), 'time': time.time()})
+        if profiler is not None and profile_skip == 0:
+            self._start_profile()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self._sample, daemon=True)
+        self.sampler.start()
+
+    def write(self, record: dict) -> None:
+        with self.lock:
+            if self.log.closed:
+                return
+            self.log.write(json.dumps({'t': round(time.perf_counter() - self.start, 4), **record}) + '\n')
+            self.log.flush()
+
+    # Times the enclosed block under name; nested stages are timed independently, so their parents include them
+    @contextmanager
+    def stage(self, name: str, items: int = 0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                totals = self.stages.setdefault(name, [0, 0.0, 0])
+                totals[0] += 1
+                totals[1] += elapsed
+                totals[2] += items
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    # Current value of something that rises and falls, e.g. a queue depth; its maximum is kept too
+    def gauge(self, name: str, value: float) -> None:
+        with self.lock:
+            _, peak = self.gauges.get(name, (value, value))
+            self.gauges[name] = (value, max(peak, value))
+
+    # Marks the end of one batch of the run, which opens and closes the profiling window
+    def step(self) -> None:
+        self.batches += 1
+        if self.profiler is None:
+            return
+        if self.batches == self.profile_skip and self.active_profile is None:
+            self._start_profile()
+        elif self.batches == self.profile_skip + self.profile_batches and self.active_profile is not None:
+            self._stop_profile()
+
+    def memory(self) -> dict:
+        rss = self.process.memory_info().rss
+        children = 0
+        for child in self.process.children(recursive=True):
+            try:
+                children += child.memory_info().rss
+            except psutil.Error:
+                # Child exited between listing and reading
+                pass
+        self.peak_rss = max(self.peak_rss, rss + children)
+        return {'rss_mb': rss / 2 ** 20, 'children_rss_mb': children / 2 ** 20, 'peak_rss_mb': self.peak_rss / 2 ** 20}
+
+    def snapshot(self) -> dict:
+        memory = self.memory()
+        with self.lock:
+            return {
+                'batches': self.batches,
+                'stages': {name: {'calls': calls, 'seconds': round(seconds, 6), 'items': items}
+                           for name, (calls, seconds, items) in self.stages.items()},
+                'counters': dict(self.counters),
+                'gauges': {name: {'last': last, 'max': peak} for name, (last, peak) in self.gauges.items()},
+                **memory
+            }
+
+    def _sample(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.write({'event': 'sample', **self.snapshot()})
+
+    def profile_path(self, suffix: str) -> str:
+        return f'{os.path.splitext(self.log_path)[0]}{suffix}'
+
+    def _start_profile(self) -> None:
+        if self.profiler == 'cprofile':
+            self.active_profile = cProfile.Profile()
+            self.active_profile.enable()
+        else:
+            import torch
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.active_profile = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.active_profile.start()
+        self.write({'event': 'profile_start', 'profiler': self.profiler, 'batch': self.batches})
+
+    # Stops the profiler, saves its full output next to the log, and logs the top entries
+    def _stop_profile(self) -> None:
+        profile = self.active_profile
+        self.active_profile = None
+        if self.profiler == 'cprofile':
+            profile.disable()
+            path = self.profile_path('.prof')
+            profile.dump_stats(path)
+            stats = pstats.Stats(profile)
+            top = [{'function': f'{file}:{line}({func})', 'calls': calls, 'tottime': round(tottime, 6), 'cumtime': round(cumtime, 6)}
+                   for (file, line, func), (_, calls, tottime, cumtime, _) in
+                   sorted(stats.stats.items(), key=lambda item: -item[1][3])[:PROFILE_TOP]]
+        else:
+            profile.stop()
+            path = self.profile_path('.trace.json')
+            profile.export_chrome_trace(path)
+            events = sorted(profile.key_averages(), key=lambda e: -e.self_cpu_time_total)[:PROFILE_TOP]
+            top = [{'op': e.key, 'calls': e.count, 'self_cpu_ms': round(e.self_cpu_time_total / 1000, 3),
+                    'cpu_ms': round(e.cpu_time_total / 1000, 3)} for e in events]
+        self.write({'event': 'profile', 'profiler': self.profiler, 'batch': self.batches, 'file': path, 'top': top})
+
+    def close(self) -> None:
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.sampler.join()
+        if self.active_profile is not None:
+            # The run ended inside the profiling window
+            self._stop_profile()
+        self.write({'event': 'summary', 'seconds': round(time.perf_counter() - self.start, 4), **self.snapshot()})
+        with self.lock:
+            self.log.close()
+
+# Instrumentation the pipeline reports to, if any; without it every call below does nothing
+_active = None
+_NO_STAGE = nullcontext()
+
+def use_instrumentation(log_path: str, interval: float = 5.0, profiler: str = None, profile_batches: int = 10,
+                        profile_skip: int = 5) -> Instrumentation:
+    global _active
+    _active = Instrumentation(log_path, interval, profiler, profile_batches, profile_skip)
+    # Scripts leave through quit() in several places, so the summary is written at exit
+    atexit.register(_active.close)
+    return _active
+
+def active() -> Instrumentation:
+    return _active
+
+def stage(name: str, items: int = 0):
+    return _active.stage(name, items) if _active is not None else _NO_STAGE
+
+def count(name: str, n: int = 1) -> None:
+    if _active is not None:
+        _active.count(name, n)
+
+def gauge(name: str, value: float) -> None:
+    if _active is not None:
+        _active.gauge(name, value)
+
+def step() -> None:
+    if _active is not None:
+        _active.step()
+
+# Command line options shared by the instrumented scripts
+def add_arguments(parser) -> None:
+    parser.add_argument('--instrument', help='Append stage timings, counters, queue depths and memory samples to this JSON lines file')
+    parser.add_argument('--sample-interval', type=float, default=5.0, help='Seconds between memory and progress samples (with --instrument)')
+    parser.add_argument('--profile', choices=PROFILERS, help='Profile a window of batches with cProfile or torch.profiler (with --instrument)')
+    parser.add_argument('--profile-batches', type=int, default=10, help='Batches in the profiling window')
+    parser.add_argument('--profile-skip', type=int, default=5, help='Batches run before the profiling window opens')
+
+def from_arguments(arg_list) -> Instrumentation:
+    if arg_list.instrument is None:
+        if arg_list.profile is not None:
+            raise ValueError('--profile requires --instrument')
+        return None
+    return use_instrumentation(arg_list.instrument, arg_list.sample_interval, arg_list.profile,
+                               arg_list.profile_batches, arg_list.profile_skip)
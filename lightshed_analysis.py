@@ -1,58 +1,112 @@
 import os
 import argparse
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from typing import Union
+from typing import Iterator
 from xai_utils import BOX_LEGEND_HANDLES, GENERAL_COLOR_LIST
-
-noise_entropy = {}
-noise_detect_rate = {}
-mask_entropy = {}
-mask_detect_rate = {}
-lightness_entropy = {}
-lightness_detect_rate = {}
-
-color_mapper = {}
-color_index = 0
-color_list = []
-entropies = []
-file_sizes = []
-
-def store_info(struct: dict, key: str, value: Union[int, float]) -> None:
-    if key not in struct:
-        struct[key] = []
-    struct[key].append(value)
-
-def print_entropy(struct: dict) -> None:
-    for key in sorted(struct.keys()):
-        print(f'Average entropy of {key}: {sum(struct[key]) / len(struct[key])}')
-
-def print_detect(struct: dict) -> None:
-    for key in sorted(struct.keys()):
-        print(f'Detection rate of {key}: {sum(struct[key]) / len(struct[key]) * 100}%')
-
-def plot_NML() -> None:
+import instrument
+
+# Labels parsed from sweep file names, e.g. base_gauss_perlinS08_L30.png
+FACTORS = ['noise', 'mask', 'lightness']
+FILENAME_PATTERN = r'^(?P<base>[^_]+)_(?P<noise>[^_]+)_(?P<mask>[^_]+)_(?P<lightness>[^_]+?)(?:\.[^.]*)?$'
+
+# Yields the results in DataFrames of at most chunksize rows (all at once if chunksize is None)
+# Parquet input needs pyarrow
+def read_results(path: str, chunksize: int = None) -> Iterator[pd.DataFrame]:
+    if os.path.splitext(path)[1] == '.parquet':
+        import pyarrow.parquet as pq
+        if chunksize is None:
+            yield pq.read_table(path).to_pandas()
+        else:
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+                yield batch.to_pandas()
+    elif chunksize is None:
+        yield pd.read_csv(path)
+    else:
+        yield from pd.read_csv(path, chunksize=chunksize)
+
+# Adds noise/mask/lightness columns parsed from the first column and a 0/1 detected column
+# is_poisoned may be booleans or the 'tensor(True)' strings of older runs
+def parse_results(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.rename(columns={df.columns[0]: 'filename', df.columns[1]: 'entropy', df.columns[2]: 'is_poisoned'})
+    labels = df['filename'].str.extract(FILENAME_PATTERN)
+    poisoned = df['is_poisoned']
+    if poisoned.dtype != bool:
+        poisoned = poisoned.astype(str).isin(['True', 'true', '1', 'tensor(True)'])
+    if 'alpha' in df.columns:
+        # Merged sweep.py results also vary opacity; labels are strings like the other factors
+        df = df.assign(alpha=df['alpha'].map('{:g}'.format))
+    return df.assign(**{f: labels[f] for f in FACTORS}, detected=poisoned.astype(np.int64))
+
+# Factors present in parsed results: FACTORS, plus alpha for merged sweep.py results
+def factors_of(df: pd.DataFrame) -> list[str]:
+    return FACTORS + ['alpha'] * ('alpha' in df.columns)
+
+# Per (factor, level) sums needed to combine chunks: count, entropy sum, squared entropy sum, detections
+def partial_stats(df: pd.DataFrame) -> pd.DataFrame:
+    long = df.melt(id_vars=['entropy', 'detected'], value_vars=factors_of(df), var_name='factor', value_name='level')
+    long = long.assign(entropy_sq=long['entropy'] ** 2)
+    return long.groupby(['factor', 'level']).agg(
+        count=('entropy', 'size'),
+        entropy_sum=('entropy', 'sum'),
+        entropy_sq_sum=('entropy_sq', 'sum'),
+        detected_sum=('detected', 'sum')
+    )
+
+# Mean/std entropy and detection rate per (factor, level) from summed partial stats
+def finish_stats(sums: pd.DataFrame) -> pd.DataFrame:
+    mean = sums['entropy_sum'] / sums['count']
+    var = (sums['entropy_sq_sum'] / sums['count'] - mean ** 2).clip(lower=0)
+    return pd.DataFrame({
+        'count': sums['count'],
+        'mean_entropy': mean,
+        'std_entropy': np.sqrt(var),
+        'detection_rate': sums['detected_sum'] / sums['count']
+    })
+
+# Aggregate detection table over every chunk; memory depends on the chunk size, not on the file
+def summarize(path: str, chunksize: int = None) -> pd.DataFrame:
+    parts = []
+    chunks = read_results(path, chunksize)
+    while True:
+        with instrument.stage('read'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        with instrument.stage('aggregate', len(chunk)):
+            parts.append(partial_stats(parse_results(chunk)))
+        instrument.count('rows', len(chunk))
+        instrument.step()
+    with instrument.stage('combine'):
+        return finish_stats(pd.concat(parts).groupby(level=['factor', 'level']).sum())
+
+def print_entropy(stats: pd.DataFrame) -> None:
+    for key, value in stats['mean_entropy'].sort_index().items():
+        print(f'Average entropy of {key}: {value}')
+
+def print_detect(stats: pd.DataFrame) -> None:
+    for key, value in stats['detection_rate'].sort_index().items():
+        print(f'Detection rate of {key}: {value * 100}%')
+
+# File size of every distinct mask, read once per mask rather than once per row
+def mask_sizes(df: pd.DataFrame, masks_dir: str) -> pd.Series:
+    names = df['mask'] + '_' + df['lightness']
+    sizes = {name: os.path.getsize(os.path.join(masks_dir, f'{name}.png')) for name in names.unique()}
+    return names.map(sizes)
+
+def plot_NML(df: pd.DataFrame) -> None:
     fig, ax = plt.subplots(1, 3, figsize=(15, 5))
 
     plt.suptitle('Shannon Entropy for Reconstructed Poison')
 
-    ax[0].boxplot([noise_entropy[key] for key in sorted(noise_entropy.keys())],
-                    tick_labels=[key for key in sorted(noise_entropy.keys())],
-                    orientation='horizontal', showmeans=True, meanline=True)
-    ax[0].set_xlabel('Entropy')
-    ax[0].set_ylabel('Noise')
-
-    ax[1].boxplot([mask_entropy[key] for key in sorted(mask_entropy.keys())],
-                    tick_labels=[key for key in sorted(mask_entropy.keys())],
-                    orientation='horizontal', showmeans=True, meanline=True)
-    ax[1].set_xlabel('Entropy')
-    ax[1].set_ylabel('Mask')
-
-    ax[2].boxplot([lightness_entropy[key] for key in sorted(lightness_entropy.keys())],
-                    tick_labels=[key for key in sorted(lightness_entropy.keys())],
-                    orientation='horizontal', showmeans=True, meanline=True)
-    ax[2].set_xlabel('Entropy')
-    ax[2].set_ylabel('Lightness')
+    for i, (factor, label) in enumerate(zip(FACTORS, ['Noise', 'Mask', 'Lightness'])):
+        groups = df.groupby(factor)['entropy']
+        keys = sorted(groups.groups.keys())
+        ax[i].boxplot([groups.get_group(key).to_numpy() for key in keys], tick_labels=keys,
+                      orientation='horizontal', showmeans=True, meanline=True)
+        ax[i].set_xlabel('Entropy')
+        ax[i].set_ylabel(label)
 
     fig.legend(handles=BOX_LEGEND_HANDLES, loc='center left')
 
@@ -60,61 +114,35 @@ def plot_NML() -> None:
     fig.subplots_adjust(left=0.18, wspace=0.4)
     plt.show()
 
-def plot_compressibility() -> None:
-    plt.scatter(file_sizes, entropies, c=color_list)
+def plot_compressibility(df: pd.DataFrame, masks_dir: str) -> None:
+    codes, _ = pd.factorize(df['noise'])
+    plt.scatter(mask_sizes(df, masks_dir), df['entropy'], c=np.array(GENERAL_COLOR_LIST)[codes % len(GENERAL_COLOR_LIST)])
     plt.tight_layout()
     plt.show()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--csv', required=True, help='The path to the csv output of LightShed to analyze')
+    parser.add_argument('--csv', required=True, help='The path to the csv (or parquet) output of LightShed to analyze')
     parser.add_argument('--masks', default=os.path.join(os.getcwd(), 'noise_data', 'masks'), help='Directory containing masks')
+    parser.add_argument('--chunksize', type=int, default=None, help='Read the results this many rows at a time; plots are skipped')
+    parser.add_argument('--no-plot', action='store_true', help='Only print the aggregate tables')
+    instrument.add_arguments(parser)
     arg_list = parser.parse_args()
+    instrument.from_arguments(arg_list)
 
-    if not os.path.exists(arg_list.csv) and not os.path.splitext(arg_list.csv)[1] == '.csv':
-        raise FileNotFoundError(f'{arg_list.csv} not found or is not a CSV')
+    if not os.path.exists(arg_list.csv) or os.path.splitext(arg_list.csv)[1] not in ('.csv', '.parquet'):
+        raise FileNotFoundError(f'{arg_list.csv} not found or is not a CSV or Parquet file')
     if not os.path.exists(arg_list.masks) and not os.path.isdir(arg_list.masks):
         raise FileNotFoundError(f'{arg_list.masks} not found or is not directory')
 
-    if os.path.exists(arg_list.csv) and os.path.splitext(arg_list.csv)[1] == '.csv':
-        info = pd.read_csv(arg_list.csv)
-        for row in info.itertuples(index=False):
-            filename = os.path.splitext(row[0])[0]
-            entropy = row[1]
-            detected = 1 if row[2] == 'tensor(True)' else 0
-            
-            method = filename.split('_')
-            noise = method[1]
-            mask = method[2]
-            lightness = method[3]
-
-            store_info(noise_entropy, noise, entropy)
-            store_info(noise_detect_rate, noise, detected)
-            store_info(mask_entropy, mask, entropy)
-            store_info(mask_detect_rate, mask, detected)
-            store_info(lightness_entropy, lightness, entropy)
-            store_info(lightness_detect_rate, lightness, detected)
-
-            if noise not in color_mapper:
-                color_mapper[noise] = GENERAL_COLOR_LIST[color_index]
-                color_index += 1
-            color_list.append(color_mapper[noise])
-
-            entropies.append(entropy)
-            mask_file = os.path.join(arg_list.masks, f'{mask}_{lightness}.png')
-            file_sizes.append(os.path.getsize(mask_file))
-        
-        print_entropy(noise_entropy)
-        print_detect(noise_detect_rate)
-        print_entropy(mask_entropy)
-        print_detect(mask_detect_rate)
-        print_entropy(lightness_entropy)
-        print_detect(lightness_detect_rate)
-
-        plot_NML()
-        # print(color_mapper)
-        # plot_compressibility()
-        
-
-            
\ No newline at end of file
+    stats = summarize(arg_list.csv, arg_list.chunksize)
+    for factor in [f for f in FACTORS + ['alpha'] if f in stats.index.get_level_values('factor')]:
+        print_entropy(stats.loc[factor])
+        print_detect(stats.loc[factor])
+
+    if arg_list.chunksize is None and not arg_list.no_plot:
+        with instrument.stage('read'):
+            info = parse_results(next(read_results(arg_list.csv)))
+        plot_NML(info)
+        # plot_compressibility(info, arg_list.masks)
@@ -0,0 +1,330 @@
+import argparse
+import csv
+import json
+import os
+import time
+from functools import partial
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+import image_store
+import instrument
+
+# Default cut-off (bits) for poison_entropy. It was picked because it separates every row of detection_analytics.csv,
+# i.e. it is fitted to the grid the pipeline regenerates, so treat verdicts from it as provisional and pass
+# --threshold (see add_threshold_argument) once a cut-off has been calibrated on held-out images
+ENTROPY_THRESHOLD = 0.07
+CSV_HEADER = ['filename', 'entropy', 'is_poisoned']
+
+# Cut-off every verdict below is made with; set from the command line by use_threshold
+_threshold = ENTROPY_THRESHOLD
+
+def use_threshold(value: float) -> None:
+    global _threshold
+    if value < 0:
+        raise ValueError('threshold must be non-negative')
+    _threshold = value
+
+def threshold() -> float:
+    return _threshold
+
+# Command line option shared by the scripts that turn entropies into verdicts
+def add_threshold_argument(parser) -> None:
+    parser.add_argument('--threshold', type=float, default=ENTROPY_THRESHOLD,
+                        help='Entropy (bits) above which an image is reported as poisoned; the default is fitted to detection_analytics.csv')
+
+# Converts a batch of uint8 HxWx3 arrays into the float NCHW tensor the generator expects
+def to_tensor_batch(arrays: np.ndarray) -> torch.Tensor:
+    return torch.from_numpy(np.ascontiguousarray(arrays)).permute(0, 3, 1, 2).contiguous().float().div_(255)
+
+# Approximation of LightShed's detection score, whose code is not published with the model: the Shannon entropy (bits)
+# of each image's reconstructed poison, quantized to 256 levels of magnitude. It is not LightShed's own entropy, so
+# verdicts made with it are this repository's stand-in for LightShed's verdict
+def poison_entropy(poison: torch.Tensor) -> torch.Tensor:
+    n = poison.shape[0]
+    levels = (poison.detach().abs().clamp(0, 1) * 255).round().long().reshape(n, -1)
+    # Offset each image's levels so one bincount builds every histogram
+    offsets = torch.arange(n, device=levels.device).unsqueeze(1) * 256
+    hist = torch.bincount((levels + offsets).view(-1), minlength=n * 256).view(n, 256).float()
+    p = hist / levels.shape[1]
+    return -(p * torch.log2(p.clamp_min(1e-12))).sum(dim=1)
+
+# Runs the generator on a batch and returns its approximate entropy and detection decision per image
+def score_batch(generator: torch.nn.Module, images: torch.Tensor, device: str) -> tuple[torch.Tensor, torch.Tensor]:
+    with torch.inference_mode():
+        poison = generator(images.to(device))
+        entropy = poison_entropy(poison).cpu()
+    return entropy, entropy > _threshold
+
+# Cuts off a last line without a newline, which a crash part-way through a write leaves behind
+# Returns the size of the CSV afterwards
+def drop_partial_line(csv_path: str, block: int = 1 << 16) -> int:
+    with open(csv_path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - block)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            print(f'Dropping a partly written last line of {csv_path}')
+            f.truncate(end)
+    return end
+
+# Filenames already scored in a CSV, so streaming runs can pick up where they stopped
+# A partly written last line is dropped first, so it is neither counted as scored nor appended to
+def completed_files(csv_path: str) -> set[str]:
+    if not os.path.exists(csv_path):
+        return set()
+    drop_partial_line(csv_path)
+    with open(csv_path, newline='') as f:
+        return {row[0] for row in csv.reader(f) if row and row[0] != CSV_HEADER[0]}
+
+# Appends (filename, entropy, is_poisoned) rows, writing the header for a new file
+# Returns the size of the CSV afterwards; with sync the rows are flushed to disk first
+def append_rows(csv_path: str, rows: list[tuple[str, float, bool]], sync: bool = False) -> int:
+    new_file = not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0
+    with open(csv_path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(CSV_HEADER)
+        for file_name, entropy, poisoned in rows:
+            writer.writerow([file_name, f'{entropy:.6f}', bool(poisoned)])
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+        return f.tell()
+
+# Checkpoint recording how much of a CSV was completely flushed
+def checkpoint_path(csv_path: str) -> str:
+    return f'{csv_path}.ckpt.json'
+
+def write_checkpoint(csv_path: str, offset: int, rows: int) -> None:
+    tmp_path = f'{checkpoint_path(csv_path)}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'offset': offset, 'rows': rows}, f)
+    os.replace(tmp_path, checkpoint_path(csv_path))
+
+# Cuts off a partly written row left after the last checkpoint (e.g. by a crash) and returns the rows kept
+# Whole rows past the checkpoint are kept, since runs resume by file name; a CSV without a checkpoint
+# (a crash in the first chunk, or one left by an older run) keeps its whole lines as well
+def restore_checkpoint(csv_path: str) -> int:
+    if not os.path.exists(csv_path):
+        return 0
+    if not os.path.exists(checkpoint_path(csv_path)):
+        drop_partial_line(csv_path)
+        with open(csv_path, newline='') as f:
+            return max(sum(1 for row in csv.reader(f) if row) - 1, 0)
+    with open(checkpoint_path(csv_path)) as f:
+        state = json.load(f)
+    if os.path.getsize(csv_path) <= state['offset']:
+        return state['rows']
+    end = drop_partial_line(csv_path)
+    if end <= state['offset']:
+        return state['rows']
+    with open(csv_path, 'rb') as f:
+        f.seek(state['offset'])
+        extra = sum(1 for line in f if line.strip())
+    write_checkpoint(csv_path, end, state['rows'] + extra)
+    return state['rows'] + extra
+
+# Scores (labels, uint8 array) items in batches and appends a CSV row per item; returns the rows written
+# If writer is given, every item is also saved through it; with client, scoring_service.py scores them instead of generator
+# The CSV's checkpoint is updated after every batch, so lightshed_detect.py can resume the same CSV
+def score_stream(generator: torch.nn.Module, items, csv_path: str, device: str,
+                 batch_size: int = 16, writer=None, client=None) -> int:
+    count = 0
+    rows_done = restore_checkpoint(csv_path)
+    labels = []
+    arrays = []
+
+    def flush() -> None:
+        nonlocal count, rows_done
+        with instrument.stage('forward', len(arrays)):
+            if client is not None:
+                rows = []
+                for label, result in zip(labels, client.score_arrays(np.stack(arrays))):
+                    if 'error' in result:
+                        print(f'Error scoring {label["filename"]}')
+                        print(result['error'])
+                    else:
+                        # Verdicts use this process's threshold, whatever the server was started with
+                        rows.append((label['filename'], result['entropy'], result['entropy'] > _threshold))
+            else:
+                entropy, poisoned = score_batch(generator, to_tensor_batch(np.stack(arrays)), device)
+                rows = [(l['filename'], e, p) for l, e, p in zip(labels, entropy.tolist(), poisoned.tolist())]
+        count += len(rows)
+        rows_done += len(rows)
+        with instrument.stage('csv_write'):
+            write_checkpoint(csv_path, append_rows(csv_path, rows, sync=True), rows_done)
+        instrument.count('scored', len(rows))
+        labels.clear()
+        arrays.clear()
+
+    for label, arr in items:
+        if writer is not None:
+            writer.submit(label['filename'], arr, label['key'])
+        labels.append(label)
+        # Copy, since composites are views into buffers reused by the next block
+        arrays.append(np.array(arr))
+        if len(arrays) == batch_size:
+            flush()
+    if arrays:
+        flush()
+    return count
+
+# Image paths for the DataLoader; decoding happens in collate_images inside the worker processes
+class ImagePaths(Dataset):
+    def __init__(self, paths: list[str]):
+        self.paths = paths
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def __getitem__(self, index: int) -> str:
+        return self.paths[index]
+
+def collate_images(paths: list[str]) -> tuple[torch.Tensor, list[str]]:
+    from lightshed_xai import load_multi_images
+    return load_multi_images(paths)
+
+# Image files in a folder, sorted so runs visit them in the same order
+def list_images(directory: str) -> list[str]:
+    from xai_utils import extensions
+    return [os.path.join(directory, f) for f in sorted(os.listdir(directory)) if os.path.splitext(f)[1] in extensions]
+
+# Yields (file names, entropies, detections) per batch, decoding with DataLoader workers and scoring locally
+def local_batches(generator: torch.nn.Module, paths: list[str], device: str, batch_size: int, workers: int):
+    # Workers started with spawn do not inherit the image store, so reopen it in each
+    store = image_store.active_store()
+    worker_init = partial(image_store.use_image_store, store.root) if store is not None and workers > 0 else None
+    loader = DataLoader(ImagePaths(paths), batch_size=batch_size, num_workers=workers,
+                        collate_fn=collate_images, pin_memory=device == 'cuda',
+                        worker_init_fn=worker_init)
+    batches = iter(loader)
+    while True:
+        # Time spent waiting here means decoding, not the model, is the bottleneck
+        with instrument.stage('load_wait'):
+            batch = next(batches, None)
+        if batch is None:
+            return
+        images, file_names = batch
+        if not file_names:
+            continue
+        with instrument.stage('forward', len(file_names)):
+            entropy, poisoned = score_batch(generator, images, device)
+        yield file_names, entropy.tolist(), poisoned.tolist()
+
+# The same from a scoring_service.py server, which decodes and scores the files itself
+def remote_batches(client, paths: list[str], batch_size: int):
+    for start in range(0, len(paths), batch_size):
+        chunk = paths[start:start + batch_size]
+        with instrument.stage('forward', len(chunk)):
+            results = client.score_paths(chunk)
+        scored = []
+        for path, result in zip(chunk, results):
+            if 'error' in result:
+                print(f'Error loading {path}')
+                print(result['error'])
+            else:
+                scored.append((os.path.basename(path), result['entropy'], result['entropy'] > _threshold))
+        if scored:
+            yield tuple(zip(*scored))
+
+# Scores every image in paths into csv_path in fixed-size batches, resuming from the last checkpoint
+# With client, a scoring_service.py server scores them instead of generator
+# Returns the number of images scored by this call and the seconds it took
+def run_detection(generator: torch.nn.Module, paths: list[str], csv_path: str, device: str,
+                  batch_size: int = 32, workers: int = 4, flush_every: int = 256, client=None) -> tuple[int, float]:
+    rows_done = restore_checkpoint(csv_path)
+    done = completed_files(csv_path)
+    todo = [p for p in paths if os.path.basename(p) not in done]
+    if done:
+        print(f'Resuming: {len(done)} images already scored, {len(todo)} to go')
+
+    if client is not None:
+        batches = remote_batches(client, todo, batch_size)
+    else:
+        batches = local_batches(generator, todo, device, batch_size, workers)
+    pending = []
+    count = 0
+    start = time.perf_counter()
+    for file_names, entropy, poisoned in batches:
+        pending.extend(zip(file_names, entropy, poisoned))
+        count += len(file_names)
+        instrument.count('scored', len(file_names))
+        instrument.step()
+        # Only whole chunks are recorded in the checkpoint
+        if len(pending) >= flush_every:
+            rows_done += len(pending)
+            with instrument.stage('csv_write'):
+                write_checkpoint(csv_path, append_rows(csv_path, pending, sync=True), rows_done)
+            pending.clear()
+            print(f'{count}/{len(todo)} images, {count / (time.perf_counter() - start):.1f} images/s')
+    if pending:
+        rows_done += len(pending)
+        with instrument.stage('csv_write'):
+            write_checkpoint(csv_path, append_rows(csv_path, pending, sync=True), rows_done)
+    return count, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pth', help='The path to the checkpoint file')
+    parser.add_argument('--server', help='Score with a running scoring_service.py at host:port instead of loading --pth')
+    parser.add_argument('--images', nargs='+', help='The path(s) to the input image(s)')
+    parser.add_argument('--folder', help='The path to the directory containing input images')
+    parser.add_argument('--csv', default='detection_analytics.csv', help='CSV to write results to; resumed if it exists')
+    parser.add_argument('--batch-size', type=int, default=32, help='Images per forward pass')
+    parser.add_argument('--workers', type=int, default=4, help='DataLoader processes decoding images')
+    parser.add_argument('--flush-every', type=int, default=256, help='Rows written to the CSV per checkpoint')
+    parser.add_argument('--backend', default='fp32', help="Inference backend spec from inference_backend.py, e.g. 'channels_last+bf16'")
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op threads (default: torch default)')
+    parser.add_argument('--interop-threads', type=int, default=None, help='Inter-op threads (default: torch default)')
+    parser.add_argument('--image-store', help='Read images from this image_store.py store when they are in it')
+    parser.add_argument('--model-module', default='lightshed_model', help='Module providing setup_generator and load_checkpoint')
+    add_threshold_argument(parser)
+    instrument.add_arguments(parser)
+    arg_list = parser.parse_args()
+    instrument.from_arguments(arg_list)
+    use_threshold(arg_list.threshold)
+
+    if not arg_list.pth and not arg_list.server:
+        raise ValueError('--pth or --server is required')
+    if not arg_list.images and not arg_list.folder:
+        raise ValueError('--images or --folder is required')
+    if arg_list.folder and not os.path.isdir(arg_list.folder):
+        raise FileNotFoundError(f'{arg_list.folder} not found or is not directory')
+    paths = list(arg_list.images or [])
+    if arg_list.folder:
+        paths += list_images(arg_list.folder)
+
+    if arg_list.image_store:
+        image_store.use_image_store(arg_list.image_store)
+
+    if arg_list.server:
+        # The server already holds the generator; it reads the image files itself
+        from scoring_service import Client
+        client = Client(arg_list.server)
+        generator, device = None, None
+        print(f'Scoring with {arg_list.server}')
+    else:
+        import xai_utils as xu
+        import inference_backend
+        inference_backend.parse_backend(arg_list.backend)
+        inference_backend.set_threads(arg_list.threads, arg_list.interop_threads)
+        client = None
+        device = xu.get_device()
+        print(f'Device: {device}')
+        generator = xu.load_generator(arg_list.pth, device, arg_list.model_module)
+        # int8_static calibrates on the first images of the run
+        generator = inference_backend.backend_generator(generator, arg_list.backend, device,
+                                                        lambda: collate_images(paths[:16])[0])
+
+    count, seconds = run_detection(generator, paths, arg_list.csv, device, arg_list.batch_size,
+                                   arg_list.workers, arg_list.flush_every, client)
+    print(f'Scored {count} images in {seconds:.1f}s ({count / max(seconds, 1e-9):.1f} images/s)')
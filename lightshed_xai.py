@@ -4,17 +4,31 @@ from PIL import Image
 import os
 from enum import Enum
 import argparse
-from lightshed_model import setup_generator, load_checkpoint
+import sys
+import matplotlib
+# Export renders headlessly; the backend has to be chosen before pyplot is imported
+if any(a.split('=')[0] == '--export' for a in sys.argv[1:]):
+    os.environ['MPLBACKEND'] = 'Agg'
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import mplcursors
 import matplotlib.patches as mpatches
 from sklearn.manifold import TSNE
 import numpy as np
 import xai_utils as xu
+import image_store
+import instrument
+from feature_reduction import REDUCTIONS, reduced_features, reduction_cache
+from activation_render import ActivationPager, CHANNELS
 
 extensions = {'.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG'}
 
 def load_image(img_path: str, unsqueeze: bool = True) -> Image:    
+    # Already decoded and resized in the image store
+    stored = image_store.lookup(img_path)
+    if stored is not None:
+        img = torch.from_numpy(stored).permute(2, 0, 1).float().div_(255)
+        return img.unsqueeze(0) if unsqueeze else img
     if os.path.splitext(img_path)[1] in extensions:
         try:
             img = Image.open(img_path).convert('RGB')
@@ -42,84 +56,141 @@ def load_multi_images(img_paths: list[str]) -> tuple[torch.Tensor, list[str]]:
         if img is not None:
             images.append(img)
             file_names.append(os.path.basename(imgpath))
+    if not images:
+        return torch.empty((0, 3, 512, 512)), file_names
     return torch.stack(images), file_names
 
+# First encoder layer's filters normalized to [0, 1], as (filters, kH, kW, 3) for imshow
+def encoder_filters(generator: torch.nn.Module) -> np.ndarray:
+    filters = generator.encoder1[0].weight.data.clone().cpu()
+
+    # Normalize
+    filters_min = filters.min()
+    filters_max = filters.max()
+    filters = (filters - filters_min) / (filters_max - filters_min)
+    return np.clip(filters.permute(0, 2, 3, 1).numpy(), 0, 1)
+
+# t-SNE colors of image files: their catalogued variant if a catalogue is given and has them, else from their names
+def variant_colors(paths: list[str], catalogue_path: str = None) -> list[xu.Plot_Colors]:
+    if catalogue_path is None:
+        return [xu.plot_color(os.path.basename(p)) for p in paths]
+    from catalogue import Catalogue
+    with Catalogue(catalogue_path) as catalogue:
+        variants = [catalogue.variant_of(p) for p in paths]
+    return [xu.VARIANT_COLORS[v] if v else xu.plot_color(os.path.basename(p)) for p, v in zip(paths, variants)]
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--pth', required=True, help='The path to the checkpoint file')
+    parser.add_argument('--pth', help='The path to the checkpoint file')
+    parser.add_argument('--server', help='Compute t-SNE embeddings with a running scoring_service.py at host:port instead of loading --pth')
     parser.add_argument('--images', nargs='+', help='The path(s) to the input image(s)')
     parser.add_argument('--folder', help='The path to the directory containing input images')
     parser.add_argument('--mode', default='activation', 
-                        help="The XAI method to use. Valid arguments: 'activation', 'tsne', 'filter'")
+                        help="The XAI method to use. Valid arguments: 'activation', 'tsne', 'filter', and 'all' with --export")
+    parser.add_argument('--export', help='Render figures headlessly into this directory instead of showing them')
+    parser.add_argument('--formats', nargs='+', default=['png'], choices=['png', 'svg'], help='File formats for --export')
+    parser.add_argument('--export-workers', type=int, default=None, help='Processes rendering exported figures (default: all cores)')
+    parser.add_argument('--page-cache', type=int, default=8, help='Rendered activation pages kept in memory')
+    parser.add_argument('--cache', default=os.path.join(os.getcwd(), '.feature_cache'), help='Directory for cached t-SNE embeddings')
+    parser.add_argument('--batch-size', type=int, default=16, help='Images per encoder batch in tsne mode')
+    parser.add_argument('--reduce', default='none', choices=REDUCTIONS,
+                        help='Reduction applied to embeddings before t-SNE; all but none keep memory bounded')
+    parser.add_argument('--components', type=int, default=50, help='Output dimensions for randproj and ipca')
+    parser.add_argument('--tiled', action='store_true',
+                        help='Embed images for t-SNE at their native resolution, tile by tile, instead of resized to 512x512')
+    parser.add_argument('--tile', type=int, default=512, help='Tile size in pixels with --tiled')
+    parser.add_argument('--overlap', type=int, default=64, help='Overlap between neighbouring tiles in pixels with --tiled')
+    parser.add_argument('--perplexity', type=float, default=xu.PERPLEXITY, help='t-SNE perplexity')
+    parser.add_argument('--catalogue', help='Color t-SNE points by their variant in this catalogue.py database instead of by file name')
+    parser.add_argument('--image-store', help='Read images from this image_store.py store when they are in it')
+    parser.add_argument('--model-module', default='lightshed_model', help='Module providing setup_generator and load_checkpoint')
+    instrument.add_arguments(parser)
     arg_list = parser.parse_args()
+    instrument.from_arguments(arg_list)
+
+    if arg_list.image_store:
+        image_store.use_image_store(arg_list.image_store)
+
+    if arg_list.server:
+        # Embeddings come from the server's warm generator; the feature cache is keyed by its checkpoint
+        if arg_list.mode != 'tsne':
+            print('--server only supports tsne mode')
+            quit()
+        from scoring_service import Client
+        generator = Client(arg_list.server)
+        checkpoint = generator.info()['checkpoint']
+        device = 'cpu'
+    elif arg_list.pth:
+        # Check for GPU
+        device = xu.get_device()
+        print(f'Device: {device}')
 
-    # Check for GPU
-    device = xu.get_device()
-    print(f'Device: {device}')
-
-    # Load model
-    # Model implementation hidden per LightShed authors' request
-    generator, _ = setup_generator()
-    checkpoint_path = arg_list.pth
-    if os.path.exists(checkpoint_path):
-        generator, _, _, _ = load_checkpoint(checkpoint_path, generator, None, device)
-        print(f"Loaded checkpoint: {checkpoint_path}")
+        # Load model
+        generator = xu.load_generator(arg_list.pth, device, arg_list.model_module)
+        checkpoint = arg_list.pth
     else:
-        raise FileNotFoundError(f"No checkpoint found at {checkpoint_path}")   
-    generator.eval()
+        print('--pth or --server is required')
+        quit()
 
-    if arg_list.mode == 'activation':
+    tile = arg_list.tile if arg_list.tiled else None
+
+    if arg_list.export:
+        # Headless batch export; figures are rendered by worker processes on the Agg backend
+        import xai_export
+        modes = ['activation', 'tsne', 'filter'] if arg_list.mode == 'all' else [arg_list.mode]
+        paths = list(arg_list.images or [])
+        if arg_list.folder:
+            paths += [os.path.join(arg_list.folder, p) for p in sorted(os.listdir(arg_list.folder))]
+        paths = [p for p in paths if os.path.splitext(p)[1] in extensions]
+        if ('activation' in modes or 'tsne' in modes) and not paths:
+            print('export of activation and tsne figures requires --images or --folder')
+            quit()
+
+        with xai_export.FigureExporter(arg_list.export, arg_list.formats, arg_list.export_workers) as exporter:
+            if 'activation' in modes:
+                # With tsne as well, the activation pass also fills the embedding cache so reduced_features
+                # below finds every image cached and runs no second forward pass
+                # Tiled embeddings come from their own native-resolution pass instead
+                cache = reduction_cache(arg_list.cache, checkpoint, arg_list.reduce) if 'tsne' in modes and not arg_list.tiled else None
+                xai_export.export_activations(exporter, generator, paths, device, arg_list.batch_size,
+                                              cache, arg_list.reduce)
+            if 'tsne' in modes:
+                tensors_np, kept = reduced_features(arg_list.cache, checkpoint, generator, paths, arg_list.reduce,
+                                                    device, arg_list.components, batch_size=arg_list.batch_size,
+                                                    tile=tile, overlap=arg_list.overlap)
+                xai_export.export_tsne(exporter, tensors_np, [os.path.basename(paths[i]) for i in kept],
+                                       arg_list.perplexity, variant_colors([paths[i] for i in kept], arg_list.catalogue))
+            if 'filter' in modes:
+                xai_export.export_filters(exporter, generator)
+        print(f'Figures exported to {arg_list.export}')
+
+    elif arg_list.mode == 'activation':
         if not arg_list.images:
             print('activation mode requires --images argument')
             quit()
         
-        # Load image
-        images, file_names = load_multi_images(arg_list.images)
-
-        if len(file_names) < 1:
+        # Images are loaded and passed through the model one at a time, only when their page is needed
+        paths = [p for p in arg_list.images if os.path.splitext(p)[1] in extensions]
+        if len(paths) < 1:
             print('No valid images provided')
             quit()
 
-        # Visualize Activations
-        activations = {}
-
-        def get_activation(layer):
-            def hook(model, input, output):
-                activations[layer] = output.detach()
-            return hook
-        
-        # Register hook
-        generator.encoder1[2].register_forward_hook(get_activation('enc1'))
-        generator.encoder2[2].register_forward_hook(get_activation('enc2'))
-        generator.encoder3[2].register_forward_hook(get_activation('enc3'))
-        generator.encoder4[2].register_forward_hook(get_activation('enc4'))
-        generator.bottleneck[2].register_forward_hook(get_activation('btnk'))
-        
-        # Forward pass
-        with torch.no_grad():
-            images = images.to(device)
-            poison = generator(images)
-        
-        images = images.cpu()
-        poison = poison.cpu()
-        num_layers = len(activations)
+        num_images = len(paths)
+        swipe_instruct = '(Press Left or Right keys to switch images)' if num_images > 1 else ''
+        pager = ActivationPager(generator, paths, device, n=CHANNELS, cache_size=arg_list.page_cache,
+                                subtitle=swipe_instruct)
 
+        # Visualize Activations
         fig = plt.figure(figsize=(15,9))
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.axis('off')
         current_index = 0
+        page_img = ax.imshow(pager.page(current_index))
 
-        def show_feature_maps(n=10):
-            fig.clear()
-            for i, (_, tensor) in enumerate(activations.items()):
-                for j in range(n):
-                    ax = fig.add_subplot(num_layers, n, i * n + j + 1)
-                    fmap = tensor[current_index, j].cpu()
-                    ax.imshow(fmap, cmap='viridis')
-                    ax.axis('off')
-                    ax.set_title(f'L{i+1}, Ch{j+1}', fontsize=10)
-            fig.suptitle(f'Activations per Layer for {file_names[current_index]}\n{swipe_instruct}')
+        def show_feature_maps():
+            page_img.set_data(pager.page(current_index))
             fig.canvas.draw_idle()
-            plt.tight_layout()
 
         def on_key(event):
             global current_index
@@ -130,13 +201,10 @@ if __name__ == '__main__':
                 current_index = (current_index - 1) % num_images
                 show_feature_maps()
 
-        num_images = next(iter(activations.values())).shape[0]
-        swipe_instruct = '(Press Left or Right keys to switch images)' if num_images > 1 else ''
-       
         fig.canvas.mpl_connect('key_press_event', on_key)
-        show_feature_maps()
 
         plt.show()
+        pager.close()
 
     elif arg_list.mode == 'tsne':
         if not arg_list.folder:
@@ -151,38 +219,22 @@ if __name__ == '__main__':
             print(f'{directory} is not a directory')
         else:
             # Prepare data
-            tensors = []
-            colors = []
-            file_names = []
-            for p in os.listdir(directory):
-                img = load_image(f'{directory}/{p}')
-                if img is not None:
-                    file_names.append(p)
-                    # Build color key
-                    if xu.is_shaded_glazed(p):
-                        colors.append(xu.Plot_Colors.NS_GL)
-                    elif xu.is_glazed(p):
-                        colors.append(xu.Plot_Colors.GLAZE)
-                    elif xu.is_shaded(p):
-                        colors.append(xu.Plot_Colors.SHADE)
-                    else:
-                        colors.append(xu.Plot_Colors.CLEAN)
-                    
-                    # Process data / partial forward pass
-                    with torch.no_grad():
-                        img = img.to(device)
-                        img = generator.encoder1(img)
-                        img = generator.encoder2(img)
-                        img = generator.encoder3(img)
-                        img = generator.encoder4(img)
-                        img = generator.bottleneck[0](img)
-                    img = img.cpu()
-                    tensors.append(img.view(-1).numpy())
-            tensors_np = np.stack(tensors)
+            paths = [os.path.join(directory, p) for p in sorted(os.listdir(directory))
+                     if os.path.splitext(p)[1] in extensions]
+
+            # Embeddings come from the on-disk cache; only new or changed images go through the encoder
+            tensors_np, kept = reduced_features(arg_list.cache, checkpoint, generator, paths, arg_list.reduce, device,
+                                                arg_list.components, batch_size=arg_list.batch_size,
+                                                tile=tile, overlap=arg_list.overlap)
+            file_names = [os.path.basename(paths[i]) for i in kept]
+
+            # Build color key
+            colors = variant_colors([paths[i] for i in kept], arg_list.catalogue)
 
             # Visualize
-            tsne = TSNE(n_components=2, perplexity=xu.PERPLEXITY, random_state=0)
-            img_tsne = tsne.fit_transform(tensors_np)
+            with instrument.stage('tsne', len(tensors_np)):
+                tsne = TSNE(n_components=2, perplexity=arg_list.perplexity, random_state=0)
+                img_tsne = tsne.fit_transform(tensors_np)
 
             plt.figure(figsize=(8, 6))
             plot = plt.scatter(img_tsne[:, 0], img_tsne[:, 1], s=60, c=colors)
@@ -196,27 +248,19 @@ if __name__ == '__main__':
                 sel.annotation.set_text(file_names[i])
                 sel.annotation.get_bbox_patch().set(fc='white', alpha=0.8)
 
-            plt.title(f't-SNE Perplexity: {xu.PERPLEXITY}')
+            plt.title(f't-SNE Perplexity: {arg_list.perplexity}')
             plt.legend(title='Legend', handles=xu.MPATCHES, loc='best')
             plt.show()
 
     elif arg_list.mode == 'filter':
-        enc1 = generator.encoder1[0]
-        filters = enc1.weight.data.clone().cpu()
-
-        # Normalize
-        filters_min = filters.min()
-        filters_max = filters.max()
-        filters = (filters - filters_min) / (filters_max - filters_min)
+        filters = encoder_filters(generator)
 
         # Visualize
         num_filters = filters.shape[0]
         fig, axes = plt.subplots(8, num_filters // 8, figsize=(5, 5))
 
         for i, ax in enumerate(axes.flat):
-            f = filters[i].permute(1, 2, 0).numpy()
-            f = np.clip(f, 0, 1)
-            ax.imshow(f)
+            ax.imshow(filters[i])
             ax.axis('off')
 
         plt.tight_layout(rect=[0, 0, 1, 0.95])
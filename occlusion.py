@@ -0,0 +1,157 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from image_store import lookup, use_image_store
+
+VARIANTS = ['clean', 'glazed', 'shaded', 'glazed_shaded']
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+def load_img(path: str) -> np.ndarray:
+    """Load image as float32 numpy array [0,1]."""
+    stored = lookup(path, native_only=True)
+    if stored is not None:
+        return stored.astype(np.float32) / 255.0
+    return np.asarray(Image.open(path).convert('RGB'), dtype=np.float32) / 255.0
+
+def summed_area_table(values: np.ndarray) -> np.ndarray:
+    """
+    Summed-area table with a leading row and column of zeros, so that the sum
+    of values[y0:y1, x0:x1] is S[y1, x1] - S[y0, x1] - S[y1, x0] + S[y0, x0].
+    """
+    table = np.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(values, axis=0, dtype=np.float64), axis=1, out=table[1:, 1:])
+    return table
+
+def window_positions(size: int, window: int, stride: int) -> np.ndarray:
+    """Top/left offsets of every window that fits inside the image, as in the notebook."""
+    return np.arange(0, size - window + 1, stride)
+
+def window_sums(table: np.ndarray, ys: np.ndarray, xs: np.ndarray, wh: int, ww: int) -> np.ndarray:
+    """Sum inside every (y, x) window of size wh x ww, for all positions at once."""
+    y0, x0 = ys[:, None], xs[None, :]
+    y1, x1 = y0 + wh, x0 + ww
+    return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+def occlusion_scores(clean_img: np.ndarray, perturbed_img: np.ndarray, window=16, stride=16,
+                     color=(0, 0, 0)) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Score of every window position: mean |clean_occ - perturbed| over all pixels,
+    where clean_occ is the clean image with that window filled with color.
+
+    Occluding a window only changes that window's share of the total difference, so
+    score = (total(|clean - perturbed|) - window(|clean - perturbed|) + window(|color - perturbed|)) / size,
+    and both window terms come from one summed-area table each.
+    Returns (scores, ys, xs) where scores[i, j] belongs to the window at (ys[i], xs[j]).
+    """
+    wh, ww = (window, window) if np.isscalar(window) else window
+    sh, sw = (stride, stride) if np.isscalar(stride) else stride
+    H, W, _ = clean_img.shape
+
+    base_diff = np.abs(clean_img - perturbed_img).sum(axis=2)
+    occluded_diff = np.abs(np.asarray(color, dtype=np.float32) - perturbed_img).sum(axis=2)
+
+    ys = window_positions(H, wh, sh)
+    xs = window_positions(W, ww, sw)
+    delta = (window_sums(summed_area_table(occluded_diff), ys, xs, wh, ww)
+             - window_sums(summed_area_table(base_diff), ys, xs, wh, ww))
+    scores = (base_diff.sum(dtype=np.float64) + delta) / clean_img.size
+    return scores, ys, xs
+
+def occlusion_map(clean_img: np.ndarray, perturbed_img: np.ndarray, window=16, stride=16,
+                  color=(0, 0, 0)) -> np.ndarray:
+    """
+    Generate a heatmap showing how much the protected image
+    changes when local regions of the CLEAN image are occluded.
+
+    Runs in O(HW) regardless of window size. Where windows overlap (stride < window),
+    each pixel gets the average score of the windows covering it; pixels no window
+    covers stay 0.
+    """
+    wh, ww = (window, window) if np.isscalar(window) else window
+    H, W, _ = clean_img.shape
+    scores, ys, xs = occlusion_scores(clean_img, perturbed_img, window, stride, color)
+    y0 = np.repeat(ys, len(xs))
+    x0 = np.tile(xs, len(ys))
+    windows = np.stack([y0, x0, np.full_like(y0, wh), np.full_like(x0, ww)], axis=1)
+    heatmap, _ = spread_windows(scores.ravel(), windows, (H, W))
+    return heatmap
+
+def spread_windows(values: np.ndarray, windows: np.ndarray, shape: tuple[int, int]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Paint each value over its (y, x, h, w) window, averaging where windows overlap.
+    Uses a 2D difference array, so the cost does not depend on window size.
+    Returns (heatmap, coverage count); uncovered pixels are 0 in both.
+    """
+    H, W = shape
+    total = np.zeros((H + 1, W + 1))
+    count = np.zeros((H + 1, W + 1))
+    y0, x0, wh, ww = (np.asarray(windows)[:, i] for i in range(4))
+    for ys, xs, sign in ((y0, x0, 1), (y0, x0 + ww, -1), (y0 + wh, x0, -1), (y0 + wh, x0 + ww, 1)):
+        np.add.at(total, (ys, xs), sign * np.asarray(values, dtype=np.float64))
+        np.add.at(count, (ys, xs), sign)
+    total = total.cumsum(axis=0).cumsum(axis=1)[:H, :W]
+    count = np.rint(count.cumsum(axis=0).cumsum(axis=1)[:H, :W])
+
+    heatmap = np.zeros((H, W))
+    covered = count > 0
+    heatmap[covered] = total[covered] / count[covered]
+    return heatmap, count
+
+def find_groups(training_data_dir: str) -> dict:
+    """
+    Map every base id (e.g. cb_002) to its variant image paths, using the
+    style_variant/train folder layout of training_data.
+    """
+    groups = {}
+    for folder in sorted(os.listdir(training_data_dir)):
+        style, _, variant = folder.lower().partition('_')
+        train_dir = os.path.join(training_data_dir, folder, 'train')
+        if variant not in VARIANTS or not os.path.isdir(train_dir):
+            continue
+        for fname in sorted(os.listdir(train_dir)):
+            if fname.lower().endswith(IMAGE_EXTENSIONS):
+                base = '_'.join(os.path.splitext(fname)[0].split('_')[:2])
+                groups.setdefault(base, {})[variant] = os.path.join(train_dir, fname)
+    return groups
+
+def group_heatmaps(paths: dict, window=16, stride=16) -> dict:
+    """Heatmaps of every perturbed variant of one group against its clean image."""
+    clean_img = load_img(paths['clean'])
+    return {variant: occlusion_map(clean_img, load_img(paths[variant]), window, stride)
+            for variant in VARIANTS[1:] if variant in paths}
+
+def occlusion_groups(groups: dict, window=16, stride=16, workers: int = None, store: str = None) -> dict:
+    """
+    Heatmaps for every complete group (all four variants present), computed
+    in a process pool. Returns {base: {variant: heatmap}}. Workers read images
+    from the image store at store, if given.
+    """
+    complete = {base: paths for base, paths in groups.items() if all(v in paths for v in VARIANTS)}
+    initializer = (use_image_store, (store,)) if store else (None, ())
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer[0], initargs=initializer[1]) as pool:
+        futures = {base: pool.submit(group_heatmaps, paths, window, stride) for base, paths in complete.items()}
+        return {base: future.result() for base, future in futures.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--training-data', default=os.path.join(os.getcwd(), 'training_data'), help='Folder containing style_variant/train folders')
+    parser.add_argument('--output', default=os.path.join(os.getcwd(), 'occlusion_maps'), help='Folder heatmaps are saved to, one .npz per group')
+    parser.add_argument('--window', type=int, default=16, help='Occlusion window size in pixels')
+    parser.add_argument('--stride', type=int, default=16, help='Distance between windows in pixels')
+    parser.add_argument('--workers', type=int, default=None, help='Processes working on groups in parallel (default: all cores)')
+    parser.add_argument('--image-store', help='Read images from this image_store.py store when they are in it')
+    arg_list = parser.parse_args()
+
+    if not os.path.isdir(arg_list.training_data):
+        raise FileNotFoundError(f'{arg_list.training_data} not found or is not directory')
+    os.makedirs(arg_list.output, exist_ok=True)
+
+    groups = find_groups(arg_list.training_data)
+    results = occlusion_groups(groups, arg_list.window, arg_list.stride, arg_list.workers, arg_list.image_store)
+    for base, heatmaps in results.items():
+        np.savez_compressed(os.path.join(arg_list.output, f'{base}.npz'), **heatmaps)
+    skipped = len(groups) - len(results)
+    print(f'Saved occlusion maps for {len(results)} groups ({skipped} incomplete groups skipped)')
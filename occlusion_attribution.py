@@ -0,0 +1,139 @@
+import argparse
+import os
+import numpy as np
+import torch
+from lightshed_detect import poison_entropy, threshold, use_threshold, add_threshold_argument
+from occlusion import spread_windows
+
+# Rough ratio of a forward pass's peak memory to the size of its input batch
+ACTIVATION_FACTOR = 32
+
+def grid_windows(size: tuple[int, int], window: int, stride: int) -> np.ndarray:
+    """Every (y, x, h, w) window of a regular grid that fits inside the image."""
+    H, W = size
+    ys = np.arange(0, H - window + 1, stride)
+    xs = np.arange(0, W - window + 1, stride)
+    y0 = np.repeat(ys, len(xs))
+    x0 = np.tile(xs, len(ys))
+    return np.stack([y0, x0, np.full_like(y0, window), np.full_like(x0, window)], axis=1)
+
+def max_batch(image: torch.Tensor, memory_mb: float, activation_factor: int = ACTIVATION_FACTOR) -> int:
+    """Largest number of occluded copies whose forward pass should fit in memory_mb."""
+    per_image = image.numel() * image.element_size() * activation_factor
+    return max(1, int(memory_mb * 2**20 // per_image))
+
+def occluded_batch(image: torch.Tensor, windows: np.ndarray, color=(0, 0, 0)) -> torch.Tensor:
+    """One copy of image (3, H, W) per window, with that window filled with color."""
+    batch = image.unsqueeze(0).repeat(len(windows), 1, 1, 1)
+    fill = torch.tensor(color, dtype=image.dtype).view(3, 1, 1)
+    for i, (y, x, h, w) in enumerate(windows):
+        batch[i, :, y:y + h, x:x + w] = fill
+    return batch
+
+def poison_stats(generator: torch.nn.Module, images: torch.Tensor, device: str) -> tuple[np.ndarray, np.ndarray]:
+    """Mean reconstructed-poison magnitude and poison entropy of every image in the batch."""
+    with torch.inference_mode():
+        poison = generator(images.to(device))
+        magnitude = poison.abs().mean(dim=(1, 2, 3)).cpu().numpy()
+        entropy = poison_entropy(poison).cpu().numpy()
+    return magnitude, entropy
+
+def evaluate_windows(generator: torch.nn.Module, image: torch.Tensor, windows: np.ndarray, device: str,
+                     memory_mb: float, color=(0, 0, 0)) -> tuple[np.ndarray, np.ndarray]:
+    """Poison magnitude and entropy with each window occluded, in chunks capped by memory_mb."""
+    chunk = max_batch(image, memory_mb)
+    magnitude = []
+    entropy = []
+    for start in range(0, len(windows), chunk):
+        m, e = poison_stats(generator, occluded_batch(image, windows[start:start + chunk], color), device)
+        magnitude.append(m)
+        entropy.append(e)
+    return np.concatenate(magnitude), np.concatenate(entropy)
+
+def split_windows(windows: np.ndarray) -> np.ndarray:
+    """Split every window into its four quadrants."""
+    y, x, h, w = (windows[:, i] for i in range(4))
+    h2, w2 = h // 2, w // 2
+    parts = [(y, x, h2, w2), (y, x + w2, h2, w - w2), (y + h2, x, h - h2, w2), (y + h2, x + w2, h - h2, w - w2)]
+    return np.concatenate([np.stack(p, axis=1) for p in parts])
+
+def attribute(generator: torch.nn.Module, image: torch.Tensor, device: str, window: int = 32, stride: int = 32,
+              memory_mb: float = 1024, color=(0, 0, 0), coarse_to_fine: bool = False,
+              min_window: int = 8, top_k: int = 16) -> dict:
+    """
+    Heatmaps of how occluding each region of image (3, H, W) changes LightShed's reconstructed poison:
+    'magnitude' and 'entropy' hold (occluded - original) and 'flips' is the share of covering windows that
+    change the detection decision.
+
+    With coarse_to_fine, the grid starts at window and only the top_k windows of each level (by
+    |entropy change|) are split into quadrants, level after level, down to min_window. Finer results
+    replace coarser ones where they exist. 'full_grid_passes' is what a full grid at the finest window
+    reached (stride scaled alike) would have cost, for comparison with 'forward_passes'.
+    """
+    H, W = image.shape[1:]
+    base_magnitude, base_entropy = poison_stats(generator, image.unsqueeze(0), device)
+    base_poisoned = base_entropy[0] > threshold()
+    result = {
+        'magnitude': np.zeros((H, W)),
+        'entropy': np.zeros((H, W)),
+        'flips': np.zeros((H, W)),
+        'baseline_magnitude': float(base_magnitude[0]),
+        'baseline_entropy': float(base_entropy[0]),
+        'baseline_poisoned': bool(base_poisoned),
+        'forward_passes': 1,
+        'full_grid_passes': 1
+    }
+
+    windows = grid_windows((H, W), window, stride)
+    while len(windows):
+        magnitude, entropy = evaluate_windows(generator, image, windows, device, memory_mb, color)
+        result['forward_passes'] += len(windows)
+        flips = (entropy > threshold()) != base_poisoned
+        for key, values in (('magnitude', magnitude - base_magnitude[0]), ('entropy', entropy - base_entropy[0]),
+                            ('flips', flips.astype(float))):
+            heatmap, count = spread_windows(values, windows, (H, W))
+            result[key][count > 0] = heatmap[count > 0]
+
+        finest = int(windows[:, 2:].min())
+        if not coarse_to_fine or finest // 2 < min_window:
+            break
+        windows = split_windows(windows[np.argsort(-np.abs(entropy - base_entropy[0]))[:top_k]])
+    result['full_grid_passes'] += len(grid_windows((H, W), finest, max(1, stride * finest // window)))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pth', required=True, help='The path to the checkpoint file')
+    parser.add_argument('--images', nargs='+', required=True, help='The path(s) to the input image(s)')
+    parser.add_argument('--output', default=os.path.join(os.getcwd(), 'attribution_maps'), help='Folder results are saved to, one .npz per image')
+    parser.add_argument('--window', type=int, default=32, help='Occlusion window size in pixels (coarsest size with --coarse-to-fine)')
+    parser.add_argument('--stride', type=int, default=32, help='Distance between windows in pixels')
+    parser.add_argument('--memory-mb', type=float, default=1024, help='Memory budget for one batch of occluded images')
+    parser.add_argument('--coarse-to-fine', action='store_true', help='Only refine the most sensitive windows')
+    parser.add_argument('--min-window', type=int, default=8, help='Smallest window size with --coarse-to-fine')
+    parser.add_argument('--top-k', type=int, default=16, help='Windows split into quadrants per level with --coarse-to-fine')
+    parser.add_argument('--model-module', default='lightshed_model', help='Module providing setup_generator and load_checkpoint')
+    add_threshold_argument(parser)
+    arg_list = parser.parse_args()
+    use_threshold(arg_list.threshold)
+
+    import xai_utils as xu
+    from lightshed_xai import load_image
+    device = xu.get_device()
+    print(f'Device: {device}')
+    generator = xu.load_generator(arg_list.pth, device, arg_list.model_module)
+    os.makedirs(arg_list.output, exist_ok=True)
+
+    for path in arg_list.images:
+        image = load_image(path, unsqueeze=False)
+        if image is None:
+            continue
+        result = attribute(generator, image, device, arg_list.window, arg_list.stride, arg_list.memory_mb,
+                           coarse_to_fine=arg_list.coarse_to_fine, min_window=arg_list.min_window,
+                           top_k=arg_list.top_k)
+        name = os.path.splitext(os.path.basename(path))[0]
+        np.savez_compressed(os.path.join(arg_list.output, f'{name}.npz'), **result)
+        flipped = (result['flips'] > 0).mean() * 100
+        print(f'{name}: {result["forward_passes"]} forward passes ({result["full_grid_passes"]} for the full grid), baseline entropy {result["baseline_entropy"]:.4f}, '
+              f'{flipped:.1f}% of pixels in windows that flip detection')
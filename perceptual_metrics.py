@@ -0,0 +1,281 @@
+import argparse
+import math
+import os
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from PIL import Image
+import xai_utils as xu
+from occlusion import VARIANTS, find_groups, load_img
+from image_store import use_image_store
+
+# Radial frequency bands (cycles per pixel) of the perturbation's energy; the bands sum to its luminance MSE
+BANDS = {'low': (0.0, 1 / 16), 'mid': (1 / 16, 1 / 8), 'high': (1 / 8, 1 / 4), 'top': (1 / 4, math.inf)}
+METRICS = ['mae', 'psnr', 'ssim', 'ms_ssim'] + [f'energy_{band}' for band in BANDS]
+# Per-scale weights of MS-SSIM (Wang et al. 2003)
+MS_SSIM_WEIGHTS = [0.0448, 0.2856, 0.3001, 0.2363, 0.1333]
+SSIM_WINDOW = 11
+SSIM_SIGMA = 1.5
+# PSNR of identical images, instead of infinity
+MAX_PSNR = 100.0
+LUMA = [0.299, 0.587, 0.114]
+
+# Every metric below takes two float N x 3 x H x W batches in [0, 1] and returns one value per pair
+
+def mae(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    return (a - b).abs().mean(dim=(1, 2, 3))
+
+def psnr(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    mse = (a - b).pow(2).mean(dim=(1, 2, 3))
+    return (-10 * torch.log10(mse.clamp_min(10 ** (-MAX_PSNR / 10))))
+
+def gaussian_kernel(size: int = SSIM_WINDOW, sigma: float = SSIM_SIGMA) -> torch.Tensor:
+    x = torch.arange(size, dtype=torch.float32) - (size - 1) / 2
+    kernel = torch.exp(-x ** 2 / (2 * sigma ** 2))
+    return kernel / kernel.sum()
+
+# Separable Gaussian blur of every channel, without padding
+def blur(x: torch.Tensor, kernel: torch.Tensor) -> torch.Tensor:
+    channels = x.shape[1]
+    x = F.conv2d(x, kernel.view(1, 1, 1, -1).expand(channels, 1, 1, -1), groups=channels)
+    return F.conv2d(x, kernel.view(1, 1, -1, 1).expand(channels, 1, -1, 1), groups=channels)
+
+# Mean SSIM and mean contrast-structure term per pair; all five local statistics are blurred in one pass
+def ssim_terms(a: torch.Tensor, b: torch.Tensor, kernel: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+    mu_a, mu_b, aa, bb, ab = blur(torch.cat([a, b, a * a, b * b, a * b], dim=1), kernel).chunk(5, dim=1)
+    var_a = aa - mu_a ** 2
+    var_b = bb - mu_b ** 2
+    cov = ab - mu_a * mu_b
+    cs = (2 * cov + c2) / (var_a + var_b + c2)
+    luminance = (2 * mu_a * mu_b + c1) / (mu_a ** 2 + mu_b ** 2 + c1)
+    return (luminance * cs).mean(dim=(1, 2, 3)), cs.mean(dim=(1, 2, 3))
+
+def ssim(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    return ssim_terms(a, b, gaussian_kernel())[0]
+
+# Multi-scale SSIM; images too small for all five scales use as many as fit, with the weights renormalized
+def ms_ssim(a: torch.Tensor, b: torch.Tensor, weights: list[float] = MS_SSIM_WEIGHTS) -> torch.Tensor:
+    kernel = gaussian_kernel()
+    side = min(a.shape[-2:])
+    levels = max(1, min(len(weights), 1 + int(math.log2(side / SSIM_WINDOW)))) if side >= SSIM_WINDOW else 1
+    w = torch.tensor(weights[:levels])
+    w = w / w.sum()
+    values = []
+    for level in range(levels):
+        s, cs = ssim_terms(a, b, kernel)
+        if level == levels - 1:
+            values.append(s.clamp_min(0))
+        else:
+            values.append(cs.clamp_min(0))
+            a = F.avg_pool2d(a, 2)
+            b = F.avg_pool2d(b, 2)
+    return torch.stack(values, dim=1).pow(w).prod(dim=1)
+
+# Energy of the luminance difference in each band of BANDS, from one FFT per pair (Parseval)
+def band_energy(a: torch.Tensor, b: torch.Tensor) -> dict:
+    luma = torch.tensor(LUMA).view(1, 3, 1, 1)
+    diff = ((b - a) * luma).sum(dim=1)
+    H, W = diff.shape[-2:]
+    power = torch.fft.fft2(diff).abs().pow(2) / (H * W) ** 2
+    fy = torch.fft.fftfreq(H).view(-1, 1)
+    fx = torch.fft.fftfreq(W).view(1, -1)
+    radius = torch.sqrt(fy ** 2 + fx ** 2)
+    return {f'energy_{band}': (power * ((radius >= lo) & (radius < hi))).sum(dim=(1, 2))
+            for band, (lo, hi) in BANDS.items()}
+
+# Every metric of METRICS for a batch of pairs, as numpy arrays
+def compute_metrics(clean: torch.Tensor, perturbed: torch.Tensor) -> dict:
+    with torch.inference_mode():
+        values = {
+            'mae': mae(clean, perturbed),
+            'psnr': psnr(clean, perturbed),
+            'ssim': ssim(clean, perturbed),
+            'ms_ssim': ms_ssim(clean, perturbed),
+            **band_energy(clean, perturbed)
+        }
+    return {name: values[name].double().numpy() for name in METRICS}
+
+# Clean/perturbed pairs of every group from occlusion.find_groups or catalogue.Catalogue.groups
+def group_pairs(groups: dict) -> list[dict]:
+    return [{'base': base, 'variant': variant, 'clean': paths['clean'], 'perturbed': paths[variant]}
+            for base, paths in sorted(groups.items()) if 'clean' in paths
+            for variant in VARIANTS[1:] if variant in paths]
+
+# RQ3 composites (base_noise_mask_lightness.png) paired with the base image they were made from
+def composite_pairs(results_dir: str, bases_dir: str) -> list[dict]:
+    from lightshed_analysis import FILENAME_PATTERN
+    bases = {os.path.splitext(f)[0]: os.path.join(bases_dir, f) for f in sorted(os.listdir(bases_dir))
+             if os.path.splitext(f)[1] in xu.extensions}
+    pattern = re.compile(FILENAME_PATTERN)
+    pairs = []
+    for f in sorted(os.listdir(results_dir)):
+        match = pattern.match(f)
+        if match is None or match['base'] not in bases or os.path.splitext(f)[1] not in xu.extensions:
+            continue
+        pairs.append({'base': match['base'], 'variant': f'{match["noise"]}_{match["mask"]}_{match["lightness"]}',
+                      'clean': bases[match['base']], 'perturbed': os.path.join(results_dir, f)})
+    return pairs
+
+# SQLite cache of metrics per (clean content hash, perturbed content hash, size), plus a memo of file hashes
+# keyed by path, size and mtime so unchanged files are not re-read
+class MetricsCache:
+    def __init__(self, db_path: str):
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript(f'''
+            CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, bytes INTEGER, mtime REAL, sha256 TEXT);
+            CREATE TABLE IF NOT EXISTS metrics (
+                clean_hash TEXT, perturbed_hash TEXT, size INTEGER, {", ".join(f"{m} REAL" for m in METRICS)},
+                PRIMARY KEY (clean_hash, perturbed_hash, size)
+            );
+        ''')
+        self.hashes = {row[0]: row[1:] for row in self.db.execute('SELECT path, bytes, mtime, sha256 FROM hashes')}
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def content_hash(self, path: str) -> str:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.hashes.get(path)
+        if entry is None or entry[:2] != (stat.st_size, stat.st_mtime):
+            entry = (stat.st_size, stat.st_mtime, xu.file_hash(path))
+            self.hashes[path] = entry
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)', (path, *entry))
+        return entry[2]
+
+    def get(self, keys: list[tuple[str, str, int]]) -> dict:
+        found = {}
+        for key in keys:
+            row = self.db.execute(f'SELECT {", ".join(METRICS)} FROM metrics WHERE clean_hash = ? AND perturbed_hash = ? AND size = ?',
+                                  key).fetchone()
+            if row is not None:
+                found[key] = dict(zip(METRICS, row))
+        return found
+
+    def put(self, results: dict) -> None:
+        with self.db:
+            self.db.executemany(f'INSERT OR REPLACE INTO metrics VALUES ({", ".join("?" * (len(METRICS) + 3))})',
+                                [(*key, *(values[m] for m in METRICS)) for key, values in results.items()])
+
+# Float 3 x H x W tensor of an image, resized to size x size if size is given
+def load_tensor(path: str, size: int = None) -> torch.Tensor:
+    img = torch.from_numpy(load_img(path)).permute(2, 0, 1)
+    if size is not None and tuple(img.shape[1:]) != (size, size):
+        img = F.interpolate(img[None], size=(size, size), mode='bilinear', antialias=True, align_corners=False)[0].clamp(0, 1)
+    return img
+
+# Width and height from the image header, without decoding the pixels
+def image_size(path: str) -> tuple[int, int]:
+    with Image.open(path) as img:
+        return img.size
+
+# Metrics of every pair, computing only pairs whose content-hash key is not cached yet
+# Pairs are decoded by worker threads and batched by image size; size resizes everything to size x size
+# Returns the pairs with their metrics added; pairs whose images differ in size are left out before decoding
+def score_pairs(pairs: list[dict], cache: MetricsCache, batch_size: int = 8, size: int = None, workers: int = 4) -> list[dict]:
+    keys = [(cache.content_hash(p['clean']), cache.content_hash(p['perturbed']), size or 0) for p in pairs]
+    found = cache.get(keys)
+    todo = list({key: pair for key, pair in zip(keys, pairs) if key not in found}.items())
+    if size is None:
+        todo_sized = []
+        for key, pair in todo:
+            clean_size, perturbed_size = image_size(pair['clean']), image_size(pair['perturbed'])
+            if clean_size != perturbed_size:
+                print(f'Skipping {pair["perturbed"]}: {perturbed_size} does not match clean {clean_size}')
+            else:
+                todo_sized.append((key, pair))
+        todo = todo_sized
+    if todo:
+        print(f'Computing metrics for {len(todo)} of {len(pairs)} pairs')
+
+    def load(item):
+        key, pair = item
+        return key, load_tensor(pair['clean'], size), load_tensor(pair['perturbed'], size)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, len(todo), batch_size):
+            by_shape = {}
+            for key, clean, perturbed in pool.map(load, todo[start:start + batch_size]):
+                by_shape.setdefault(tuple(clean.shape), []).append((key, clean, perturbed))
+            results = {}
+            for batch in by_shape.values():
+                values = compute_metrics(torch.stack([c for _, c, _ in batch]), torch.stack([p for _, _, p in batch]))
+                for i, (key, _, _) in enumerate(batch):
+                    results[key] = {m: float(values[m][i]) for m in METRICS}
+            cache.put(results)
+            found.update(results)
+    return [{**pair, **found[key]} for key, pair in zip(keys, pairs) if key in found]
+
+# Joins metrics with a detection CSV by perturbed file name, then prints how each metric relates to detection
+def relate_to_detection(df: pd.DataFrame, detections: str) -> pd.DataFrame:
+    from lightshed_analysis import read_results, parse_results
+    scored = pd.concat([parse_results(chunk)[['filename', 'entropy', 'detected']] for chunk in read_results(detections, 100000)])
+    df = df.assign(filename=df['perturbed'].map(os.path.basename)).merge(scored, on='filename', how='inner')
+    if df.empty:
+        print(f'No perturbed image appears in {detections}')
+        return df
+    print(f'{len(df)} pairs with a detection result')
+    print(f'{"metric":<14} {"spearman(entropy)":>18} {"mean detected":>15} {"mean undetected":>16}')
+    for m in METRICS:
+        rho = df[m].corr(df['entropy'], method='spearman')
+        means = df.groupby('detected')[m].mean()
+        print(f'{m:<14} {rho:>18.3f} {means.get(1, float("nan")):>15.4g} {means.get(0, float("nan")):>16.4g}')
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--training-data', default=os.path.join(os.getcwd(), 'training_data'), help='Folder containing style_variant/train folders')
+    parser.add_argument('--catalogue', help='Take the clean/perturbed groups from this catalogue.py database instead of --training-data')
+    parser.add_argument('--style', help="Only groups of this style, e.g. 'materials' (with --catalogue)")
+    parser.add_argument('--composites', help='Score RQ3 composites in this folder (e.g. noise_data/results) against their base images instead')
+    parser.add_argument('--bases', default=os.path.join(os.getcwd(), 'noise_data', 'bases'), help='Folder containing base images (with --composites)')
+    parser.add_argument('--cache', default=os.path.join(os.getcwd(), 'perceptual_metrics.sqlite'), help='SQLite cache of computed metrics')
+    parser.add_argument('--csv', default='perceptual_metrics.csv', help='CSV to write one row per pair to')
+    parser.add_argument('--detections', help='Detection CSV (e.g. detection_analytics.csv) to relate the metrics to')
+    parser.add_argument('--batch-size', type=int, default=8, help='Pairs per batch')
+    parser.add_argument('--size', type=int, default=None, help='Resize every image to size x size first (default: native size)')
+    parser.add_argument('--workers', type=int, default=4, help='Threads decoding images')
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op torch threads (default: torch default)')
+    parser.add_argument('--image-store', help='Read images from this image_store.py store when they are in it')
+    arg_list = parser.parse_args()
+
+    if arg_list.image_store:
+        use_image_store(arg_list.image_store)
+    if arg_list.threads:
+        torch.set_num_threads(arg_list.threads)
+
+    if arg_list.composites:
+        for directory in (arg_list.composites, arg_list.bases):
+            if not os.path.isdir(directory):
+                raise FileNotFoundError(f'{directory} not found or is not directory')
+        pairs = composite_pairs(arg_list.composites, arg_list.bases)
+    elif arg_list.catalogue:
+        from catalogue import Catalogue
+        with Catalogue(arg_list.catalogue) as catalogue:
+            pairs = group_pairs(catalogue.groups(arg_list.style))
+    else:
+        if not os.path.isdir(arg_list.training_data):
+            raise FileNotFoundError(f'{arg_list.training_data} not found or is not directory')
+        pairs = group_pairs(find_groups(arg_list.training_data))
+
+    with MetricsCache(arg_list.cache) as cache:
+        rows = score_pairs(pairs, cache, arg_list.batch_size, arg_list.size, arg_list.workers)
+    df = pd.DataFrame(rows, columns=['base', 'variant', 'clean', 'perturbed'] + METRICS)
+    df.to_csv(arg_list.csv, index=False, float_format='%.6g')
+    print(f'{len(df)} pairs written to {arg_list.csv}')
+    if not df.empty:
+        print(df.groupby('variant')[METRICS].mean().to_string(float_format='{:.4g}'.format))
+    if arg_list.detections:
+        relate_to_detection(df, arg_list.detections)
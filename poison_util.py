@@ -1,80 +1,310 @@
 import argparse
 import os
+import json
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from PIL import Image
 import numpy as np
-import math
 from xai_utils import load_image
+import instrument
 
 TARGETS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8]
+# Upper bound on noise x mask pairs composited at once (~4 MB per 512x512 pair: 3 MB of float32 scratch plus the uint8 output)
+BLOCK_PAIRS = 32
+# Name of the file recording every finished output of a folder
+MANIFEST = 'manifest.jsonl'
 
-# Returns an Image whose average value over all pixels is target accurate to epsilon   
-def gamma_bin_search(img: Image, target: float = 0.5, epsilon: float = 0.0001, max_iter: int = 50) -> Image:
-    if target < 0.0 or target > 1.0:
+# Encodes one array as PNG; runs in a worker process. Writes to a temporary file first so partial files never look finished
+def encode_png(arr: np.ndarray, path: str, optimize: bool, compress_level: int) -> tuple[str, int]:
+    tmp_path = f'{path}.tmp'
+    Image.fromarray(arr).save(tmp_path, format='PNG', optimize=optimize, compress_level=compress_level)
+    os.replace(tmp_path, path)
+    return path, os.path.getsize(path)
+
+# Encodes and writes PNGs in a process pool, keeping a manifest so interrupted runs can resume
+# optimize=True always uses the strongest compression, so turn it off for compress_level to take effect
+class PNGWriter:
+    def __init__(self, out_dir: str, workers: int = None, optimize: bool = True, compress_level: int = 6):
+        self.out_dir = out_dir
+        self.optimize = optimize
+        self.compress_level = compress_level
+        self.workers = workers or os.cpu_count() or 1
+        # Bound the number of queued images so memory does not grow with the sweep
+        self.max_pending = 2 * self.workers
+        self.manifest_path = os.path.join(out_dir, MANIFEST)
+        self.entries = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line may be cut off by an interrupted run
+                        continue
+                    self.entries[entry['file']] = entry
+        self.pending = {}
+        self.pool = None
+        self.manifest = None
+
+    def __enter__(self):
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        self.manifest = open(self.manifest_path, 'a')
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # True if file_name was already written for the same key
+    def is_done(self, file_name: str, key: str) -> bool:
+        entry = self.entries.get(file_name)
+        if entry is None or entry['key'] != key:
+            return False
+        path = os.path.join(self.out_dir, file_name)
+        return os.path.exists(path) and os.path.getsize(path) == entry['size']
+
+    # Queues arr to be written as file_name unless it is already done; blocks while the queue is full
+    def submit(self, file_name: str, arr: np.ndarray, key: str) -> bool:
+        if self.is_done(file_name, key):
+            return False
+        if len(self.pending) >= self.max_pending:
+            # Time spent here means the encoders cannot keep up
+            with instrument.stage('png_wait'):
+                while len(self.pending) >= self.max_pending:
+                    finished, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+                    self._record(finished)
+        path = os.path.join(self.out_dir, file_name)
+        # Copy, since arguments are pickled later by the pool and callers reuse their buffers
+        future = self.pool.submit(encode_png, np.array(arr), path, self.optimize, self.compress_level)
+        self.pending[future] = (file_name, key)
+        instrument.gauge('png_queue', len(self.pending))
+        return True
+
+    def _record(self, finished) -> None:
+        for future in finished:
+            file_name, key = self.pending.pop(future)
+            _, size = future.result()
+            entry = {'file': file_name, 'key': key, 'size': size}
+            self.entries[file_name] = entry
+            self.manifest.write(json.dumps(entry) + '\n')
+            instrument.count('png_written')
+            instrument.count('png_bytes', size)
+        self.manifest.flush()
+
+    # Waits for every queued image and shuts down the pool
+    def close(self) -> None:
+        if self.pool is None:
+            return
+        try:
+            self._record(wait(self.pending).done)
+        finally:
+            self.pool.shutdown()
+            self.manifest.close()
+            self.pool = None
+
+# Returns the levels present in a grayscale array, how often each occurs, and the largest level of its bit depth
+def level_histogram(img_np: np.ndarray) -> tuple[np.ndarray, np.ndarray, int]:
+    max_value = 65535 if img_np.dtype == np.uint16 else 255
+    counts = np.bincount(img_np.ravel(), minlength=max_value + 1)
+    levels = np.flatnonzero(counts)
+    return levels, counts[levels], max_value
+
+# Bisects the gamma of every target at once so that the mean of (level / max_value) ** (1 / gamma) is target accurate to epsilon
+# The mean is taken over the histogram, so each step costs O(levels) rather than O(pixels)
+def gamma_search(levels: np.ndarray, counts: np.ndarray, max_value: int, targets: list[float],
+                 epsilon: float = 0.0001, max_iter: int = 50) -> np.ndarray:
+    targets = np.asarray(targets, dtype=float)
+    if np.any(targets < 0.0) or np.any(targets > 1.0):
         raise ValueError('target must be between 0.0 and 1.0 inclusive.')
-    
-    high = 9.99
-    low = 0.01
-    gamma = 1.00
-    img_np = np.array(img, dtype=float)
-    img_np /= 255
-    # Clone input in case loop is skipped
-    candidate = np.array(img, dtype=float)
-    candidate /= 255
-
-    mean = np.mean(img_np)
+
+    values = levels / max_value
+    weights = counts / counts.sum()
+    high = np.full(len(targets), 9.99)
+    low = np.full(len(targets), 0.01)
+    gamma = np.ones(len(targets))
+    # Gamma of the last candidate evaluated per target; 1.0 (unchanged image) if no search was needed
+    result = np.ones(len(targets))
+
+    mean = np.full(len(targets), values @ weights)
+    active = np.abs(mean - targets) > epsilon
     iterations = 0
-    while abs(mean - target) > epsilon and iterations < max_iter:
+    while active.any() and iterations < max_iter:
         iterations += 1
         # Apply gamma and check mean brightness
-        candidate = img_np ** (1 / gamma)
-        mean = np.mean(candidate)
+        mean[active] = (values[None, :] ** (1 / gamma[active, None])) @ weights
+        result[active] = gamma[active]
 
-        if mean < target:
-            # Too dark, increase gamma
-            low = gamma
-        else:
-            # Too light, decrease gamma
-            high = gamma
-        gamma = 10 ** ((math.log10(high) + math.log10(low)) / 2)
+        # Too dark, increase gamma; too light, decrease gamma
+        darker = active & (mean < targets)
+        lighter = active & ~(mean < targets)
+        low[darker] = gamma[darker]
+        high[lighter] = gamma[lighter]
+        gamma[active] = 10 ** ((np.log10(high[active]) + np.log10(low[active])) / 2)
+        active &= np.abs(mean - targets) > epsilon
+    return result
+
+# Lookup table mapping every level of the input bit depth to its 8-bit gamma-adjusted value
+def gamma_lut(gamma: float, max_value: int) -> np.ndarray:
+    values = np.arange(max_value + 1) / max_value
+    return (values ** (1 / gamma) * 255).astype('uint8')
 
-    # Convert the candidate to an image
-    img_np = (candidate * 255).astype('uint8')
-    return Image.fromarray(img_np, mode='L')
+# Returns one 8-bit mask per target, searching all targets together and applying each gamma once through a LUT
+def gamma_masks(img: Image, targets: list[float], epsilon: float = 0.0001, max_iter: int = 50) -> list[np.ndarray]:
+    img_np = np.asarray(img)
+    levels, counts, max_value = level_histogram(img_np)
+    gammas = gamma_search(levels, counts, max_value, targets, epsilon, max_iter)
+    return [gamma_lut(g, max_value)[img_np] for g in gammas]
+
+# Returns an Image whose average value over all pixels is target accurate to epsilon   
+def gamma_bin_search(img: Image, target: float = 0.5, epsilon: float = 0.0001, max_iter: int = 50) -> Image:
+    mask = gamma_masks(img, [target], epsilon, max_iter)[0]
+    return Image.fromarray(mask, mode='L')
+
+# File name suffix for a lightness target, e.g. 0.3 -> L30 and 0.125 -> L12p5
+def lightness_suffix(target: float) -> str:
+    percent = round(target * 100, 6)
+    if percent == int(percent):
+        return f'L{int(percent):02d}'
+    return f'L{percent:g}'.replace('.', 'p')
 
 # Permute through TARGETS and Procedurals to generate Masks
-def generate_masks(p_dir: str, m_dir: str) -> None:
+# Procedurals are read at full 16-bit precision; the masks themselves are 8-bit
+def generate_masks(p_dir: str, m_dir: str, writer: PNGWriter, targets: list[float] = TARGETS) -> None:
     for f in os.listdir(p_dir):
-        f_img, f_name = load_image(os.path.join(p_dir, f), mode='L')
+        with instrument.stage('decode', 1):
+            f_img, f_name = load_image(os.path.join(p_dir, f), mode='I;16')
         if f_img is not None:
-            for t in TARGETS:
-                result = gamma_bin_search(f_img, target=t)
-                suffix = int(t * 100)
-                result.save(f'{os.path.join(m_dir, f_name)}_L{suffix:02d}.png', optimize=True)
+            todo = [t for t in targets if not writer.is_done(f'{f_name}_{lightness_suffix(t)}.png', f'{f_name}|{t}')]
+            if todo:
+                with instrument.stage('gamma_masks', len(todo)):
+                    masks = gamma_masks(f_img, todo)
+                for t, mask in zip(todo, masks):
+                    writer.submit(f'{f_name}_{lightness_suffix(t)}.png', mask, f'{f_name}|{t}')
 
-# Permute through base images, noises, and masks
-def permute_noises_masks(b_dir: str, n_dir: str, m_dir: str, out_dir: str, alpha: float) -> None:
-    for base_file in os.listdir(b_dir):
-        base_img, base_name = load_image(os.path.join(b_dir, base_file), 'RGB')
+# Decodes every image in a folder (or only the file names in only) once and stacks them as float32
+def load_stack(directory: str, mode: str, only: list[str] = None) -> tuple[list[str], np.ndarray]:
+    names = []
+    arrays = []
+    for f in sorted(os.listdir(directory)):
+        if only is not None and f not in only:
+            continue
+        with instrument.stage('decode', 1):
+            img, name = load_image(os.path.join(directory, f), mode)
+            if img is not None:
+                arr = np.asarray(img, dtype=np.float32)
+        if img is not None:
+            names.append(name)
+            arrays.append(arr)
+    if not arrays:
+        return names, np.empty((0, 0, 0) if mode == 'L' else (0, 0, 0, 3), dtype=np.float32)
+    return names, np.stack(arrays)
+
+# Decoded noises and masks of a sweep, with the masks scaled by alpha / 255 as iter_sweep composites them
+def load_sweep_stacks(n_dir: str, m_dir: str, alpha: float,
+                      noises: list[str] = None) -> tuple[list[str], np.ndarray, list[str], np.ndarray]:
+    ptrb_names, ptrb_arr = load_stack(n_dir, 'RGB', noises)
+    mask_names, mask_arr = load_stack(m_dir, 'L')
+    mask_arr *= alpha / 255
+    return ptrb_names, ptrb_arr, mask_names, mask_arr
+
+# Yields (noise slice, mask slice) blocks covering every noise x mask pair with at most max_pairs pairs each
+def iter_blocks(n_noises: int, n_masks: int, max_pairs: int):
+    mask_step = max(1, min(n_masks, max_pairs))
+    noise_step = max(1, max_pairs // mask_step)
+    for n in range(0, n_noises, noise_step):
+        for m in range(0, n_masks, mask_step):
+            yield slice(n, min(n + noise_step, n_noises)), slice(m, min(m + mask_step, n_masks))
+
+# Composites a base with every noise x mask pair of the block into out (noises, masks, H, W, 3)
+# Masks must already be scaled by alpha / 255
+def composite_block(base: np.ndarray, noises: np.ndarray, masks: np.ndarray,
+                    out: np.ndarray, scratch: np.ndarray) -> np.ndarray:
+    np.multiply(noises[:, None], masks[None, :, :, :, None], out=scratch)
+    np.add(scratch, base, out=scratch)
+    np.clip(scratch, 0, 255, out=scratch)
+    np.copyto(out, scratch, casting='unsafe')
+    return out
+
+# Yields (noise indices, mask indices, composites) for one base, reusing preallocated buffers between blocks
+# Blocks where skip(noise index, mask index) is true for every pair are not composited
+def iter_composites(base: np.ndarray, noises: np.ndarray, masks: np.ndarray, max_pairs: int = BLOCK_PAIRS,
+                    skip=None):
+    n_noises, n_masks = len(noises), len(masks)
+    if n_noises == 0 or n_masks == 0:
+        return
+    if noises.shape[1:3] != base.shape[:2] or masks.shape[1:3] != base.shape[:2]:
+        raise ValueError('bases, noises, and masks must all have the same dimensions')
+    first_n, first_m = next(iter_blocks(n_noises, n_masks, max_pairs))
+    shape = (first_n.stop - first_n.start, first_m.stop - first_m.start) + base.shape
+    scratch = np.empty(shape, dtype=np.float32)
+    out = np.empty(shape, dtype=np.uint8)
+    for n_slice, m_slice in iter_blocks(n_noises, n_masks, max_pairs):
+        if skip is not None and all(skip(n, m) for n in range(n_slice.start, n_slice.stop)
+                                    for m in range(m_slice.start, m_slice.stop)):
+            continue
+        nn = n_slice.stop - n_slice.start
+        nm = m_slice.stop - m_slice.start
+        with instrument.stage('composite', nn * nm):
+            block = composite_block(base, noises[n_slice], masks[m_slice], out[:nn, :nm], scratch[:nn, :nm])
+        yield range(n_slice.start, n_slice.stop), range(m_slice.start, m_slice.stop), block
+        # One block is one batch of the sweep for the profiling window
+        instrument.step()
+
+# Splits a mask name such as perlinS08_L30 into its procedural and lightness labels
+def split_mask_name(mask_name: str) -> tuple[str, str]:
+    procedural, _, lightness = mask_name.rpartition('_')
+    return procedural, lightness
+
+# Yields (labels, composite) for every base x noise x mask combination without touching the disk
+# labels holds filename, base, noise, mask, lightness, alpha and the manifest key; composites are uint8 views
+# into buffers reused by the next block, so copy them to keep them. Combinations where skip(labels) is true are not composited
+# bases and noises restrict the sweep to those file names
+# stacks are (noise names, noises, mask names, masks scaled by alpha / 255) from load_sweep_stacks; callers that
+# sweep the same folders many times pass them in so the images are not decoded again on every call
+def iter_sweep(b_dir: str, n_dir: str, m_dir: str, alpha: float, max_pairs: int = BLOCK_PAIRS, skip=None,
+               bases: list[str] = None, noises: list[str] = None, stacks: tuple = None):
+    # Noises and masks are decoded once and shared by every base
+    ptrb_names, ptrb_arr, mask_names, mask_arr = stacks or load_sweep_stacks(n_dir, m_dir, alpha, noises)
+    if stacks is not None and noises is not None:
+        wanted = {os.path.splitext(n)[0] for n in noises}
+        keep = [i for i, name in enumerate(ptrb_names) if name in wanted]
+        ptrb_names, ptrb_arr = [ptrb_names[i] for i in keep], ptrb_arr[keep]
+    for base_file in sorted(os.listdir(b_dir)):
+        if bases is not None and base_file not in bases:
+            continue
+        with instrument.stage('decode', 1):
+            base_img, base_name = load_image(os.path.join(b_dir, base_file), 'RGB')
+            if base_img is not None:
+                base_arr = np.asarray(base_img, dtype=np.float32)
         if base_img is not None:
-            for ptrb_file in os.listdir(n_dir):
-                ptrb_img, ptrb_name = load_image(os.path.join(n_dir, ptrb_file), 'RGB')
-                if ptrb_img is not None:
-                    for mask_file in os.listdir(m_dir):
-                        mask_img, mask_name = load_image(os.path.join(m_dir, mask_file), 'L')
-                        if mask_img is not None:
-                            # Convert to NumPy for compositing
-                            base_img_arr = np.array(base_img).astype(float)
-                            ptrb_img_arr = np.array(ptrb_img).astype(float)
-                            mask_img_arr = np.array(mask_img).astype(float) / 255
-                            mask_img_arr = mask_img_arr[:, :, None]
-
-                            # Add masked noise to base and clamp to 0-255
-                            comp_arr = base_img_arr + (ptrb_img_arr * mask_img_arr * alpha)
-                            comp_arr = np.clip(comp_arr, 0, 255).astype(np.uint8)
-
-                            # Save image
-                            comp_img = Image.fromarray(comp_arr, mode='RGB')
-                            comp_img.save(f'{out_dir}/{base_name}_{ptrb_name}_{mask_name}.png', optimize=True)
+            def labels(n: int, m: int) -> dict:
+                procedural, lightness = split_mask_name(mask_names[m])
+                return {
+                    'filename': f'{base_name}_{ptrb_names[n]}_{mask_names[m]}.png',
+                    'base': base_name,
+                    'noise': ptrb_names[n],
+                    'mask': procedural,
+                    'lightness': lightness,
+                    'alpha': alpha,
+                    'key': f'{base_name}|{ptrb_names[n]}|{mask_names[m]}|{alpha}'
+                }
+
+            def skip_pair(n: int, m: int) -> bool:
+                return skip is not None and skip(labels(n, m))
+
+            for n_idx, m_idx, block in iter_composites(base_arr, ptrb_arr, mask_arr, max_pairs, skip_pair):
+                for i, n in enumerate(n_idx):
+                    for j, m in enumerate(m_idx):
+                        if not skip_pair(n, m):
+                            yield labels(n, m), block[i, j]
+
+# Permute through base images, noises, and masks
+def permute_noises_masks(b_dir: str, n_dir: str, m_dir: str, writer: PNGWriter, alpha: float,
+                         max_pairs: int = BLOCK_PAIRS) -> None:
+    # Outputs finished by an earlier run are neither composited nor written again
+    def skip(labels: dict) -> bool:
+        return writer.is_done(labels['filename'], labels['key'])
+
+    for labels, comp_arr in iter_sweep(b_dir, n_dir, m_dir, alpha, max_pairs, skip):
+        writer.submit(labels['filename'], comp_arr, labels['key'])
 
 
 if __name__ == '__main__':
@@ -84,8 +314,25 @@ if __name__ == '__main__':
     parser.add_argument('--noises', default=os.path.join(os.getcwd(), 'noise_data', 'noises'), help='Folder containing noisy images')
     parser.add_argument('--masks', default=os.path.join(os.getcwd(), 'noise_data', 'masks'), help='Folder containing masks')
     parser.add_argument('--alpha', default='0.15', help='Master opacity for noises added to images')
+    parser.add_argument('--targets', type=float, nargs='+', default=TARGETS, help='Mask lightness targets (default: TARGETS)')
     parser.add_argument('--output', default=os.path.join(os.getcwd(), 'noise_data', 'results'), help='Folder containing output images')
+    parser.add_argument('--block', type=int, default=BLOCK_PAIRS, help='Maximum noise x mask pairs composited at once')
+    parser.add_argument('--workers', type=int, default=None, help='Processes used to encode PNGs (default: all cores)')
+    parser.add_argument('--compress-level', type=int, default=6, help='PNG compression level 0-9, used with --no-optimize')
+    parser.add_argument('--no-optimize', action='store_true', help='Skip the slow optimizing PNG encoder for throughput runs')
+    parser.add_argument('--pth', help='LightShed checkpoint; if given, composites are scored in memory instead of only being saved')
+    parser.add_argument('--server', help='Score composites with a running scoring_service.py at host:port instead of loading --pth')
+    parser.add_argument('--csv', default='detection_analytics.csv', help='CSV that scored composites are appended to (with --pth or --server); its checkpoint is kept up to date, so lightshed_detect.py can resume it')
+    parser.add_argument('--batch-size', type=int, default=16, help='Composites per LightShed batch (with --pth or --server)')
+    parser.add_argument('--no-save', action='store_true', help='Do not write composite PNGs (with --pth or --server)')
+    parser.add_argument('--backend', default='fp32', help="Inference backend spec from inference_backend.py, e.g. 'channels_last+bf16' (with --pth)")
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op threads for LightShed (with --pth)')
+    parser.add_argument('--model-module', default='lightshed_model', help='Module providing setup_generator and load_checkpoint')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='Entropy (bits) above which a composite is reported as poisoned (default: lightshed_detect.ENTROPY_THRESHOLD)')
+    instrument.add_arguments(parser)
     arg_list = parser.parse_args()
+    instrument.from_arguments(arg_list)
 
     # Error handling
     if not os.path.exists(arg_list.bases) or not os.path.isdir(arg_list.bases):
@@ -105,7 +352,47 @@ if __name__ == '__main__':
     os.makedirs(arg_list.masks, exist_ok=True)
     os.makedirs(arg_list.output, exist_ok=True)
     
-    generate_masks(arg_list.procedurals, arg_list.masks)
-    permute_noises_masks(arg_list.bases, arg_list.noises, arg_list.masks, arg_list.output, alpha)
+    if not 0 <= arg_list.compress_level <= 9:
+        raise ValueError('compress-level must be between 0 and 9 inclusive')
+    optimize = not arg_list.no_optimize
+
+    # Masks must be on disk before compositing starts
+    with instrument.stage('masks'), PNGWriter(arg_list.masks, arg_list.workers, optimize, arg_list.compress_level) as writer:
+        generate_masks(arg_list.procedurals, arg_list.masks, writer, arg_list.targets)
+    if arg_list.pth or arg_list.server:
+        # Stream composites straight into LightShed, skipping anything already in the CSV
+        import lightshed_detect
+        if arg_list.threshold is not None:
+            lightshed_detect.use_threshold(arg_list.threshold)
+        client = None
+        if arg_list.server:
+            # The generator stays warm in the server; composites are sent as raw pixels
+            from scoring_service import Client
+            client = Client(arg_list.server)
+            generator, device = None, None
+        else:
+            import inference_backend
+            from xai_utils import get_device, load_generator
+            inference_backend.set_threads(arg_list.threads)
+            device = get_device()
+            generator = load_generator(arg_list.pth, device, arg_list.model_module)
+            # int8_static calibrates on the base images
+            generator = inference_backend.backend_generator(
+                generator, arg_list.backend, device,
+                lambda: lightshed_detect.collate_images(lightshed_detect.list_images(arg_list.bases)[:16])[0])
+        done = lightshed_detect.completed_files(arg_list.csv)
+        items = iter_sweep(arg_list.bases, arg_list.noises, arg_list.masks, alpha, arg_list.block,
+                           skip=lambda labels: labels['filename'] in done)
+        if arg_list.no_save:
+            count = lightshed_detect.score_stream(generator, items, arg_list.csv, device, arg_list.batch_size,
+                                                  client=client)
+        else:
+            with PNGWriter(arg_list.output, arg_list.workers, optimize, arg_list.compress_level) as writer:
+                count = lightshed_detect.score_stream(generator, items, arg_list.csv, device, arg_list.batch_size, writer,
+                                                      client)
+        print(f'Scored {count} composites into {arg_list.csv}')
+    else:
+        with PNGWriter(arg_list.output, arg_list.workers, optimize, arg_list.compress_level) as writer:
+            permute_noises_masks(arg_list.bases, arg_list.noises, arg_list.masks, writer, alpha, arg_list.block)
 
     print('Generation complete.')
@@ -0,0 +1,278 @@
+import argparse
+import csv
+import json
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import StratifiedKFold, cross_val_predict
+from sklearn.preprocessing import StandardScaler
+import image_store
+import instrument
+from xai_utils import load_image
+from perceptual_metrics import BANDS, LUMA
+from lightshed_detect import list_images, run_detection, use_threshold, add_threshold_argument
+
+FEATURES = [f'log_energy_{band}' for band in BANDS] + ['log_variance', 'log_highpass_luma', 'log_highpass_chroma', 'compressibility']
+# Share of images the pre-screen may decide differently from LightShed, by default
+DISAGREEMENT = 0.01
+
+# Second difference (discrete Laplacian) of N x C x H x W images; what is left of them after removing smooth content
+def laplacian(x: torch.Tensor) -> torch.Tensor:
+    centre = x[..., 1:-1, 1:-1]
+    return 4 * centre - x[..., :-2, 1:-1] - x[..., 2:, 1:-1] - x[..., 1:-1, :-2] - x[..., 1:-1, 2:]
+
+# zlib-compressed size of an image over its raw size
+def compressibility(img: np.ndarray) -> float:
+    return len(zlib.compress(img.tobytes(), 1)) / img.nbytes
+
+# Spectral features of a batch of uint8 N x H x W x 3 images of one size, one row per image:
+# log energy of the luminance per frequency band of perceptual_metrics.BANDS, log luminance variance,
+# log Laplacian energy in luminance and in colour, and compressibility; pool compresses images in parallel
+def spectral_features(images: np.ndarray, pool: ThreadPoolExecutor = None) -> np.ndarray:
+    ratios = list(pool.map(compressibility, images) if pool is not None else map(compressibility, images))
+    x = torch.from_numpy(np.ascontiguousarray(images)).permute(0, 3, 1, 2).float().div_(255)
+    with torch.inference_mode():
+        luma = (x * torch.tensor(LUMA).view(1, 3, 1, 1)).sum(dim=1, keepdim=True)
+        H, W = luma.shape[-2:]
+        centred = luma[:, 0] - luma.mean(dim=(1, 2, 3)).view(-1, 1, 1)
+        power = torch.fft.fft2(centred).abs().pow(2) / (H * W) ** 2
+        radius = torch.sqrt(torch.fft.fftfreq(H).view(-1, 1) ** 2 + torch.fft.fftfreq(W).view(1, -1) ** 2)
+        bands = [(power * ((radius >= lo) & (radius < hi))).sum(dim=(1, 2)) for lo, hi in BANDS.values()]
+        highpass_luma = laplacian(luma).pow(2).mean(dim=(1, 2, 3))
+        highpass_chroma = laplacian(x - luma).pow(2).mean(dim=(1, 2, 3))
+        logs = torch.log10(torch.stack(bands + [centred.pow(2).mean(dim=(1, 2)), highpass_luma, highpass_chroma], dim=1) + 1e-12)
+    return np.column_stack([logs.double().numpy(), ratios])
+
+def load_array(path: str) -> np.ndarray:
+    img, _ = load_image(path, 'RGB')
+    return None if img is None else np.asarray(img)
+
+# Features of every image in paths, decoded by worker threads and batched by image size
+# Returns the paths that could be read and their features
+def image_features(paths: list[str], batch_size: int = 32, workers: int = 4) -> tuple[list[str], np.ndarray]:
+    kept, rows = [], []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for start in range(0, len(paths), batch_size):
+            chunk = paths[start:start + batch_size]
+            with instrument.stage('decode', len(chunk)):
+                arrays = list(pool.map(load_array, chunk))
+            by_shape = {}
+            for path, arr in zip(chunk, arrays):
+                if arr is not None:
+                    by_shape.setdefault(arr.shape, []).append((path, arr))
+            with instrument.stage('features', len(chunk)):
+                for group in by_shape.values():
+                    kept.extend(p for p, _ in group)
+                    rows.append(spectral_features(np.stack([a for _, a in group]), pool))
+            instrument.step()
+    return kept, np.concatenate(rows) if rows else np.zeros((0, len(FEATURES)))
+
+# Probability cut-offs (low, high) keeping as many images as possible on each side, such that images at or below low
+# are detected at most `disagreement` of the time and images at or above high go undetected at most that often
+def calibrate(p: np.ndarray, detected: np.ndarray, disagreement: float) -> tuple[float, float]:
+    order = np.argsort(p)
+    p, detected = p[order], detected[order]
+    n = np.arange(1, len(p) + 1)
+    below = np.nonzero(np.cumsum(detected) <= disagreement * n)[0]
+    above = np.nonzero(np.cumsum((1 - detected)[::-1]) <= disagreement * n)[0]
+    low = p[below[-1]] if len(below) else -np.inf
+    high = p[::-1][above[-1]] if len(above) else np.inf
+    if low >= high:
+        # The sides overlap, so every image is decided; split them at the midpoint
+        low = (low + high) / 2
+        high = float(np.nextafter(low, np.inf))
+    return float(low), float(high)
+
+# Logistic regression on standardized spectral features predicting LightShed's verdict. Images with a probability
+# strictly between low and high are uncertain and go to the generator; the rest are decided by the pre-screen
+class Prescreen:
+    def __init__(self, mean: np.ndarray, scale: np.ndarray, coef: np.ndarray, intercept: float,
+                 low: float = 0.0, high: float = 1.0):
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.coef = np.asarray(coef, dtype=np.float64)
+        self.intercept = float(intercept)
+        self.low = low
+        self.high = high
+
+    # Fits on features X and LightShed's verdicts; the cut-offs come from cross-validated probabilities,
+    # which are returned too so the expected agreement can be reported
+    @classmethod
+    def fit(cls, X: np.ndarray, detected: np.ndarray, disagreement: float = DISAGREEMENT,
+            folds: int = 5, seed: int = 0) -> tuple['Prescreen', np.ndarray]:
+        if len(np.unique(detected)) < 2:
+            raise ValueError('The results hold only one verdict; the pre-screen needs detected and undetected images')
+        scaler = StandardScaler().fit(X)
+        Z = scaler.transform(X)
+        model = LogisticRegression(C=1.0, max_iter=1000)
+        folds = min(folds, int(np.bincount(detected, minlength=2).min()))
+        if folds >= 2:
+            cv = StratifiedKFold(folds, shuffle=True, random_state=seed)
+            p = cross_val_predict(model, Z, detected, cv=cv, method='predict_proba')[:, 1]
+        else:
+            # Too few of one verdict to cross-validate; the cut-offs come from the training fit
+            p = None
+        model.fit(Z, detected)
+        prescreen = cls(scaler.mean_, scaler.scale_, model.coef_[0], model.intercept_[0])
+        if p is None:
+            p = prescreen.probability(X)
+        prescreen.low, prescreen.high = calibrate(p, detected, disagreement)
+        return prescreen, p
+
+    def probability(self, X: np.ndarray) -> np.ndarray:
+        z = (X - self.mean) / self.scale @ self.coef + self.intercept
+        return 1 / (1 + np.exp(-z))
+
+    # 1 (detected) or 0 (undetected) where the pre-screen is confident, -1 where LightShed has to decide
+    def route(self, p: np.ndarray) -> np.ndarray:
+        return np.where(p <= self.low, 0, np.where(p >= self.high, 1, -1))
+
+    def save(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump({'features': FEATURES, 'mean': self.mean.tolist(), 'scale': self.scale.tolist(),
+                       'coef': self.coef.tolist(), 'intercept': self.intercept, 'low': self.low, 'high': self.high}, f, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> 'Prescreen':
+        with open(path) as f:
+            state = json.load(f)
+        if state['features'] != FEATURES:
+            raise ValueError(f'{path} was fit on different features; fit it again')
+        return cls(state['mean'], state['scale'], state['coef'], state['intercept'], state['low'], state['high'])
+
+# LightShed verdicts of a results CSV by lowercased file name, since older runs lowercased them
+def read_verdicts(csv_path: str) -> dict:
+    from lightshed_analysis import read_results, parse_results
+    verdicts = {}
+    for chunk in read_results(csv_path, 100000):
+        chunk = parse_results(chunk)
+        verdicts.update(zip(chunk['filename'].str.lower(), chunk['detected']))
+    return verdicts
+
+# Share of images the pre-screen decides, and how often its decisions match LightShed's verdicts
+def print_agreement(routes: np.ndarray, detected: np.ndarray) -> None:
+    confident = routes >= 0
+    agree = routes[confident] == detected[confident]
+    print(f'{confident.sum()}/{len(routes)} images ({confident.mean():.1%}) decided without LightShed')
+    if confident.any():
+        print(f'Pre-screen agrees with LightShed on {agree.mean():.2%} of them '
+              f'({(routes == 0).sum()} undetected, {(routes == 1).sum()} detected, {(~agree).sum()} disagreements)')
+    print(f'Verdicts match LightShed on {1 - (~agree).sum() / len(routes):.2%} of all images')
+
+# Writes one row per image: its probability, who decided it, and the verdict
+def write_routes(csv_path: str, rows: list[tuple[str, float, str, bool]]) -> None:
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['filename', 'p_detected', 'decided_by', 'is_poisoned'])
+        for file_name, p, decided_by, poisoned in rows:
+            writer.writerow([file_name, f'{p:.6f}', decided_by, bool(poisoned)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fit', action='store_true', help='Fit the pre-screen on --results for the images in --folder/--images')
+    parser.add_argument('--evaluate', action='store_true', help='Only report how the pre-screen would route the images in --results')
+    parser.add_argument('--results', help='LightShed results CSV (e.g. detection_analytics.csv) of the images, with --fit or --evaluate')
+    parser.add_argument('--model', default='prescreen.json', help='Pre-screen file written by --fit and read otherwise')
+    parser.add_argument('--disagreement', type=float, default=DISAGREEMENT, help='Share of decided images allowed to disagree with LightShed (with --fit)')
+    parser.add_argument('--images', nargs='+', help='The path(s) to the input image(s)')
+    parser.add_argument('--folder', help='The path to the directory containing input images')
+    parser.add_argument('--pth', help='The path to the checkpoint file')
+    parser.add_argument('--server', help='Score uncertain images with a running scoring_service.py at host:port instead of loading --pth')
+    parser.add_argument('--csv', default='detection_analytics.csv', help='CSV LightShed results are written to; resumed if it exists')
+    parser.add_argument('--routes', default='prescreen_routes.csv', help='CSV with the final verdict and who decided it for every image')
+    parser.add_argument('--audit', type=float, default=0.0, help='Share of decided images also sent to LightShed to measure agreement')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for cross-validation folds and the audit sample')
+    parser.add_argument('--batch-size', type=int, default=32, help='Images per feature and LightShed batch')
+    parser.add_argument('--workers', type=int, default=4, help='Threads decoding images for features and DataLoader processes for LightShed')
+    parser.add_argument('--image-store', help='Read images from this image_store.py store when they are in it')
+    parser.add_argument('--model-module', default='lightshed_model', help='Module providing setup_generator and load_checkpoint')
+    add_threshold_argument(parser)
+    instrument.add_arguments(parser)
+    arg_list = parser.parse_args()
+    instrument.from_arguments(arg_list)
+    use_threshold(arg_list.threshold)
+
+    if not arg_list.images and not arg_list.folder:
+        raise ValueError('--images or --folder is required')
+    if arg_list.folder and not os.path.isdir(arg_list.folder):
+        raise FileNotFoundError(f'{arg_list.folder} not found or is not directory')
+    if (arg_list.fit or arg_list.evaluate) and not arg_list.results:
+        raise ValueError('--fit and --evaluate need --results')
+    if not (arg_list.fit or arg_list.evaluate or arg_list.pth or arg_list.server):
+        raise ValueError('--pth or --server is required to score uncertain images')
+    if not 0 <= arg_list.audit <= 1:
+        raise ValueError('--audit must be between 0.0 and 1.0 inclusive')
+    paths = list(arg_list.images or [])
+    if arg_list.folder:
+        paths += list_images(arg_list.folder)
+
+    if arg_list.image_store:
+        image_store.use_image_store(arg_list.image_store)
+
+    if arg_list.fit or arg_list.evaluate:
+        verdicts = read_verdicts(arg_list.results)
+        paths = [path for path in paths if os.path.basename(path).lower() in verdicts]
+        if not paths:
+            raise ValueError(f'No image appears in {arg_list.results}')
+        paths, X = image_features(paths, arg_list.batch_size, arg_list.workers)
+        detected = np.array([verdicts[os.path.basename(path).lower()] for path in paths], dtype=np.int64)
+        if arg_list.fit:
+            prescreen, p = Prescreen.fit(X, detected, arg_list.disagreement, seed=arg_list.seed)
+            prescreen.save(arg_list.model)
+            print(f'Fit on {len(paths)} images ({detected.sum()} detected), saved to {arg_list.model}')
+            print(f'Uncertain between p = {prescreen.low:.4f} and {prescreen.high:.4f}; cross-validated routing:')
+        else:
+            prescreen = Prescreen.load(arg_list.model)
+            p = prescreen.probability(X)
+        print_agreement(prescreen.route(p), detected)
+        quit()
+
+    prescreen = Prescreen.load(arg_list.model)
+    start = time.perf_counter()
+    paths, X = image_features(paths, arg_list.batch_size, arg_list.workers)
+    feature_seconds = time.perf_counter() - start
+    p = prescreen.probability(X)
+    routes = prescreen.route(p)
+    audited = (routes >= 0) & (np.random.default_rng(arg_list.seed).random(len(paths)) < arg_list.audit)
+    to_score = [path for path, r, a in zip(paths, routes, audited) if r < 0 or a]
+    print(f'{len(paths) - len(to_score)}/{len(paths)} images decided by the pre-screen in {feature_seconds:.1f} s; '
+          f'{len(to_score)} go to LightShed ({audited.sum()} of them to audit)')
+
+    if arg_list.server:
+        from scoring_service import Client
+        client = Client(arg_list.server)
+        generator, device = None, None
+    else:
+        import xai_utils as xu
+        client = None
+        device = xu.get_device()
+        generator = xu.load_generator(arg_list.pth, device, arg_list.model_module)
+    count, seconds = run_detection(generator, to_score, arg_list.csv, device, arg_list.batch_size, arg_list.workers, client=client)
+    verdicts = read_verdicts(arg_list.csv)
+
+    rows = []
+    for path, prob, route, a in zip(paths, p, routes, audited):
+        name = os.path.basename(path)
+        if route < 0 or a:
+            if name.lower() in verdicts:
+                rows.append((name, prob, 'lightshed', verdicts[name.lower()]))
+        else:
+            rows.append((name, prob, 'prescreen', route == 1))
+    write_routes(arg_list.routes, rows)
+    print(f'Verdicts written to {arg_list.routes}; LightShed results to {arg_list.csv}')
+
+    audit = [(route, int(verdicts[os.path.basename(path).lower()])) for path, route, a in zip(paths, routes, audited)
+             if a and os.path.basename(path).lower() in verdicts]
+    if audit:
+        agree = sum(route == detected for route, detected in audit)
+        print(f'Audit: the pre-screen agreed with LightShed on {agree}/{len(audit)} decided images ({agree / len(audit):.2%})')
+    if count:
+        per_image = seconds / count
+        skipped = len(paths) - len(to_score)
+        print(f'LightShed took {per_image * 1000:.1f} ms per image; skipping {skipped} images saved about '
+              f'{skipped * per_image - feature_seconds:.1f} s net of the {feature_seconds:.1f} s spent on features')
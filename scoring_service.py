@@ -0,0 +1,370 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import socket
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+import image_store
+import instrument
+
+DEFAULT_ADDRESS = '127.0.0.1:8765'
+# Largest frame header accepted, so a stray connection cannot make the server allocate arbitrary memory
+MAX_HEADER = 1 << 20
+
+# Frames are a 4-byte big-endian header length, a JSON header, then header['size'] bytes of payload
+# Requests: {'id', 'op': 'score', 'path'} or {'id', 'op': 'score', 'shape': [H, W, 3]} with raw uint8 pixels or
+# {'id', 'op': 'score', 'encoded': true} with PNG/JPEG bytes; 'embedding': true also returns the bottleneck
+# embedding as float32 bytes. {'id', 'op': 'info'} describes the server. Responses carry the request id
+def encode_frame(header: dict, payload: bytes = b'') -> bytes:
+    data = json.dumps({**header, 'size': len(payload)}).encode()
+    return struct.pack('>I', len(data)) + data + payload
+
+async def read_frame(reader: asyncio.StreamReader) -> tuple[dict, bytes]:
+    length, = struct.unpack('>I', await reader.readexactly(4))
+    if length > MAX_HEADER:
+        raise ValueError(f'frame header of {length} bytes is too large')
+    header = json.loads(await reader.readexactly(length))
+    return header, await reader.readexactly(header.get('size', 0))
+
+def parse_address(address: str) -> tuple[str, int]:
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+# Encoded image bytes as the float 3 x 512 x 512 tensor lightshed_xai.load_image would produce from the file
+def decode_encoded(data: bytes) -> torch.Tensor:
+    img = Image.open(io.BytesIO(data)).convert('RGB')
+    return transforms.Compose([transforms.Resize((512, 512)), transforms.ToTensor()])(img)
+
+# Raw uint8 H x W x 3 pixels as a float 3 x H x W tensor, like lightshed_detect.to_tensor_batch (no resizing)
+def decode_array(data: bytes, shape: list[int]) -> torch.Tensor:
+    arr = np.frombuffer(data, dtype=np.uint8).reshape(shape)
+    return torch.from_numpy(arr.copy()).permute(2, 0, 1).float().div_(255)
+
+# Coalesces single-image requests from every connection into batches of at most batch_size,
+# waiting at most max_latency seconds after the first image of a batch arrived for more to join
+# Embeddings come from encoder, the plain generator when generator is wrapped by an inference backend
+class MicroBatcher:
+    def __init__(self, generator: torch.nn.Module, device: str, batch_size: int = 16, max_latency: float = 0.01,
+                 encoder: torch.nn.Module = None):
+        self.generator = generator
+        self.encoder = encoder if encoder is not None else generator
+        self.device = device
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.pending = deque()
+        self.arrived = asyncio.Event()
+        # One thread owns the model, so the event loop keeps accepting requests during a forward pass
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stats = {'requests': 0, 'batches': 0, 'items': 0}
+
+    async def submit(self, image: torch.Tensor, embedding) -> tuple[float, bool, np.ndarray]:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((image, embedding, future))
+        self.arrived.set()
+        instrument.gauge('queue', len(self.pending))
+        return await future
+
+    async def next_batch(self) -> list:
+        loop = asyncio.get_running_loop()
+        while not self.pending:
+            self.arrived.clear()
+            await self.arrived.wait()
+        deadline = loop.time() + self.max_latency
+        batch = [self.pending.popleft()]
+        while len(batch) < self.batch_size:
+            if self.pending:
+                batch.append(self.pending.popleft())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            try:
+                results = await loop.run_in_executor(self.executor, self.score, [b[0] for b in batch], [b[1] for b in batch])
+            except Exception as e:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.stats['batches'] += 1
+            self.stats['items'] += len(batch)
+            for (*_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    # Runs on the model thread; images of different sizes are batched separately
+    # embedding is False, True, or 'only' for requests that want the embedding without a score
+    # With the plain generator, embeddings of scored images are taken from the scoring pass by a bottleneck hook;
+    # only embeddings the pass did not produce (embedding-only requests, or a backend-wrapped generator) run the encoder
+    def score(self, images: list[torch.Tensor], embedding: list) -> list[tuple[float, bool, np.ndarray]]:
+        from lightshed_detect import score_batch
+        from xai_utils import encode_bottleneck
+        results = [None] * len(images)
+        groups = {}
+        for i, image in enumerate(images):
+            groups.setdefault(tuple(image.shape), []).append(i)
+        for rows in groups.values():
+            scored = [i for i in rows if embedding[i] != 'only']
+            wanted = [i for i in rows if embedding[i]]
+            scores = {}
+            embeddings = {}
+            if scored:
+                store = {}
+                hook = None
+                if self.encoder is self.generator and any(embedding[i] for i in scored):
+                    hook = self.generator.bottleneck[0].register_forward_hook(
+                        lambda model, input, output: store.__setitem__('embedding', output.detach()))
+                try:
+                    with instrument.stage('forward', len(scored)):
+                        entropy, poisoned = score_batch(self.generator, torch.stack([images[i] for i in scored]), self.device)
+                finally:
+                    if hook is not None:
+                        hook.remove()
+                scores = {i: (e, p) for i, e, p in zip(scored, entropy.tolist(), poisoned.tolist())}
+                if 'embedding' in store:
+                    features = store['embedding'].float().cpu().numpy()
+                    embeddings = {i: features[j] for j, i in enumerate(scored) if embedding[i]}
+            rest = [i for i in wanted if i not in embeddings]
+            if rest:
+                with instrument.stage('embedding', len(rest)):
+                    features = encode_bottleneck(self.encoder, torch.stack([images[i] for i in rest]).to(self.device))
+                embeddings.update(zip(rest, features.float().cpu().numpy()))
+            for i in rows:
+                results[i] = (*scores.get(i, (None, None)), embeddings.get(i))
+        instrument.step()
+        return results
+
+# Asyncio server holding one warm generator; every connection may pipeline any number of requests
+class ScoringServer:
+    def __init__(self, generator: torch.nn.Module, device: str, checkpoint: str, batch_size: int = 16,
+                 max_latency: float = 0.01, decode_workers: int = 4, encoder: torch.nn.Module = None):
+        self.batcher = MicroBatcher(generator, device, batch_size, max_latency, encoder)
+        self.checkpoint = os.path.abspath(checkpoint)
+        self.device = device
+        # Decoding runs off the event loop, in parallel with the model thread
+        self.decoder = ThreadPoolExecutor(max_workers=decode_workers)
+
+    def info(self) -> dict:
+        from lightshed_detect import threshold
+        return {
+            'checkpoint': self.checkpoint,
+            'device': self.device,
+            'threshold': threshold(),
+            'batch_size': self.batcher.batch_size,
+            'max_latency_ms': self.batcher.max_latency * 1000,
+            **self.batcher.stats
+        }
+
+    async def decode(self, header: dict, payload: bytes) -> torch.Tensor:
+        loop = asyncio.get_running_loop()
+        if 'path' in header:
+            from lightshed_xai import load_image
+            image = await loop.run_in_executor(self.decoder, load_image, header['path'], False)
+            if image is None:
+                raise ValueError(f'could not load {header["path"]}')
+            return image
+        if header.get('encoded'):
+            return await loop.run_in_executor(self.decoder, decode_encoded, payload)
+        if 'shape' in header:
+            return decode_array(payload, header['shape'])
+        raise ValueError('score requests need a path, encoded bytes, or a shape with raw pixels')
+
+    async def process(self, header: dict, payload: bytes) -> tuple[dict, bytes]:
+        op = header.get('op')
+        if op == 'info':
+            return self.info(), b''
+        if op != 'score':
+            raise ValueError(f'unknown op {op}')
+        self.batcher.stats['requests'] += 1
+        instrument.count('requests')
+        with instrument.stage('decode', 1):
+            image = await self.decode(header, payload)
+        wants = header.get('embedding')
+        entropy, poisoned, embedding = await self.batcher.submit(image, 'only' if wants == 'only' else bool(wants))
+        response = {} if entropy is None else {'entropy': entropy, 'is_poisoned': poisoned}
+        if embedding is None:
+            return response, b''
+        return {**response, 'embedding_shape': list(embedding.shape)}, np.ascontiguousarray(embedding, dtype=np.float32).tobytes()
+
+    async def respond(self, header: dict, payload: bytes, writer: asyncio.StreamWriter, lock: asyncio.Lock) -> None:
+        try:
+            response, data = await self.process(header, payload)
+        except Exception as e:
+            response, data = {'error': str(e)}, b''
+        async with lock:
+            writer.write(encode_frame({'id': header.get('id'), **response}, data))
+            await writer.drain()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                try:
+                    header, payload = await read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                task = asyncio.create_task(self.respond(header, payload, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except ValueError as e:
+            print(f'Dropping connection: {e}')
+        finally:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+    async def serve(self, address: str) -> None:
+        host, port = parse_address(address)
+        batching = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f'Scoring on {host}:{port} (batch size {self.batcher.batch_size}, '
+              f'max latency {self.batcher.max_latency * 1000:g} ms)')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batching.cancel()
+
+# Blocking client for a ScoringServer; requests are pipelined with at most window awaiting a response
+# Results are dicts with entropy, is_poisoned and, if requested, embedding (float32 array), or with error
+# embedding='only' asks for the embedding alone, which spares the server the scoring pass
+class Client:
+    def __init__(self, address: str = DEFAULT_ADDRESS, window: int = 64, timeout: float = None):
+        self.address = address
+        self.window = window
+        self.sock = socket.create_connection(parse_address(address), timeout)
+        self.reader = self.sock.makefile('rb')
+        self.next_id = 0
+
+    def close(self) -> None:
+        self.reader.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _receive(self) -> tuple[dict, bytes]:
+        head = self.reader.read(4)
+        if len(head) < 4:
+            raise ConnectionError(f'scoring service at {self.address} closed the connection')
+        length, = struct.unpack('>I', head)
+        header = json.loads(self.reader.read(length))
+        return header, self.reader.read(header['size'])
+
+    # Sends every request and returns the responses in request order
+    def _call(self, requests: list[tuple[dict, bytes]]) -> list[tuple[dict, bytes]]:
+        responses = {}
+        ids = []
+        for header, payload in requests:
+            ids.append(self.next_id)
+            self.sock.sendall(encode_frame({**header, 'id': self.next_id}, payload))
+            self.next_id += 1
+            while len(ids) - len(responses) >= self.window:
+                header, data = self._receive()
+                responses[header['id']] = (header, data)
+        while len(responses) < len(ids):
+            header, data = self._receive()
+            responses[header['id']] = (header, data)
+        return [responses[i] for i in ids]
+
+    def _results(self, requests: list[tuple[dict, bytes]]) -> list[dict]:
+        results = []
+        for header, data in self._call(requests):
+            result = {k: header[k] for k in ('entropy', 'is_poisoned', 'error') if k in header}
+            if 'embedding_shape' in header:
+                result['embedding'] = np.frombuffer(data, dtype=np.float32).reshape(header['embedding_shape'])
+            results.append(result)
+        return results
+
+    def info(self) -> dict:
+        header, _ = self._call([({'op': 'info'}, b'')])[0]
+        return {k: v for k, v in header.items() if k not in ('id', 'size')}
+
+    # Image files read by the server itself, so they must be visible to it under the same paths
+    def score_paths(self, paths: list[str], embedding: bool = False) -> list[dict]:
+        return self._results([({'op': 'score', 'path': os.path.abspath(p), 'embedding': embedding}, b'') for p in paths])
+
+    # uint8 N x H x W x 3 pixels, scored at their own size like lightshed_detect.score_stream does
+    def score_arrays(self, arrays: np.ndarray, embedding: bool = False) -> list[dict]:
+        return self._results([({'op': 'score', 'shape': list(arr.shape), 'embedding': embedding},
+                               np.ascontiguousarray(arr, dtype=np.uint8).tobytes()) for arr in arrays])
+
+    # PNG/JPEG file contents, resized to 512x512 by the server
+    def score_encoded(self, blobs: list[bytes], embedding: bool = False) -> list[dict]:
+        return self._results([({'op': 'score', 'encoded': True, 'embedding': embedding}, blob) for blob in blobs])
+
+    # Stands in for the generator in xai_utils.encode_bottleneck; images are float [0, 1] tensors of 8-bit pixels
+    def encode_bottleneck(self, images: torch.Tensor) -> torch.Tensor:
+        arrays = (images.detach().cpu().clamp(0, 1) * 255).round().byte().permute(0, 2, 3, 1).numpy()
+        results = self.score_arrays(arrays, embedding='only')
+        return torch.from_numpy(np.stack([r['embedding'] for r in results]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pth', help='The path to the checkpoint file')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, help='host:port to listen on, or of the server with --info')
+    parser.add_argument('--batch-size', type=int, default=16, help='Largest micro-batch')
+    parser.add_argument('--max-latency-ms', type=float, default=10, help='Longest a request waits for others to join its batch')
+    parser.add_argument('--decode-workers', type=int, default=4, help='Threads decoding images')
+    parser.add_argument('--info', action='store_true', help='Print the state of a running server and exit')
+    parser.add_argument('--backend', default='fp32', help="Inference backend spec from inference_backend.py, e.g. 'channels_last+bf16'")
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op threads (default: torch default)')
+    parser.add_argument('--image-store', help='Read images from this image_store.py store when they are in it')
+    parser.add_argument('--model-module', default='lightshed_model', help='Module providing setup_generator and load_checkpoint')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='Entropy (bits) above which is_poisoned is true (default: lightshed_detect.ENTROPY_THRESHOLD)')
+    instrument.add_arguments(parser)
+    arg_list = parser.parse_args()
+
+    if arg_list.info:
+        with Client(arg_list.address) as client:
+            print(json.dumps(client.info(), indent=2))
+        quit()
+    if not arg_list.pth:
+        raise ValueError('--pth is required to start the server')
+    instrument.from_arguments(arg_list)
+    if arg_list.image_store:
+        image_store.use_image_store(arg_list.image_store)
+
+    import xai_utils as xu
+    import inference_backend
+    import lightshed_detect
+    if arg_list.threshold is not None:
+        lightshed_detect.use_threshold(arg_list.threshold)
+    inference_backend.parse_backend(arg_list.backend)
+    inference_backend.set_threads(arg_list.threads)
+    device = xu.get_device()
+    print(f'Device: {device}')
+    generator = xu.load_generator(arg_list.pth, device, arg_list.model_module)
+    encoder = generator
+    if 'int8_static' in inference_backend.parse_backend(arg_list.backend):
+        raise ValueError('int8_static needs calibration images; use it with lightshed_detect.py instead')
+    generator = inference_backend.backend_generator(generator, arg_list.backend, device)
+
+    server = ScoringServer(generator, device, arg_list.pth, arg_list.batch_size, arg_list.max_latency_ms / 1000,
+                           arg_list.decode_workers, encoder)
+    try:
+        asyncio.run(server.serve(arg_list.address))
+    except KeyboardInterrupt:
+        print('Stopped')
@@ -0,0 +1,292 @@
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from xai_utils import extensions
+from poison_util import PNGWriter, TARGETS, BLOCK_PAIRS, MANIFEST, generate_masks, iter_sweep, load_sweep_stacks
+import lightshed_detect
+
+# Files of a sweep folder: the resolved grid, the work units, and one marker per finished unit
+GRID_FILE = 'grid.json'
+UNITS_FILE = 'units.jsonl'
+DONE_DIR = 'done'
+RESULTS_CSV = 'detection_analytics.csv'
+
+# Defaults for keys a grid file leaves out
+GRID_DEFAULTS = {
+    'bases': os.path.join('noise_data', 'bases'),
+    'noises': os.path.join('noise_data', 'noises'),
+    'procedurals': os.path.join('noise_data', 'procedurals'),
+    'targets': TARGETS,
+    'alphas': [0.15],
+    'shards': 1,
+    'block': BLOCK_PAIRS
+}
+
+# Reads a grid file such as {"alphas": [0.1, 0.15, 0.2], "shards": 4}, filling in defaults and absolute folders
+def load_grid(path: str) -> dict:
+    with open(path) as f:
+        grid = {**GRID_DEFAULTS, **json.load(f)}
+    for key in ('bases', 'noises', 'procedurals'):
+        grid[key] = os.path.abspath(grid[key])
+        if not os.path.isdir(grid[key]):
+            raise FileNotFoundError(f'{grid[key]} not found or is not directory')
+    if not all(0 <= a <= 1 for a in grid['alphas']):
+        raise ValueError('alpha must be between 0.0 and 1.0 inclusive')
+    if grid['shards'] < 1:
+        raise ValueError('shards must be at least 1')
+    return grid
+
+def image_files(directory: str) -> list[str]:
+    return [f for f in sorted(os.listdir(directory)) if os.path.splitext(f)[1] in extensions]
+
+# Work units are one alpha x base x noise each, covering every mask
+def unit_key(alpha: float, base: str, noise: str) -> str:
+    return f'{alpha:g}|{base}|{noise}'
+
+def alpha_folder(alpha: float) -> str:
+    return f'alpha_{alpha:g}'
+
+def shard_folder(out_dir: str, shard: int, alpha: float) -> str:
+    return os.path.join(out_dir, 'shards', f'{shard:03d}', alpha_folder(alpha))
+
+def done_path(out_dir: str, key: str) -> str:
+    return os.path.join(out_dir, DONE_DIR, f'{hashlib.sha1(key.encode()).hexdigest()[:16]}.json')
+
+# What a run produces for each unit: composite PNGs (saved) and LightShed scores in the shard CSV (scored)
+def run_mode(scored: bool, save: bool = True) -> dict:
+    return {'saved': save or not scored, 'scored': scored}
+
+def read_marker(out_dir: str, unit: dict) -> dict:
+    try:
+        with open(done_path(out_dir, unit['key'])) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+# A unit is done for a mode when its marker covers everything the mode produces; without a mode, any marker counts
+# Markers written before modes were recorded are taken as unscored runs that saved PNGs
+def is_done(out_dir: str, unit: dict, mode: dict = None) -> bool:
+    marker = read_marker(out_dir, unit)
+    if marker is None or mode is None:
+        return marker is not None
+    done = marker.get('mode', run_mode(False))
+    return all(done.get(k) or not v for k, v in mode.items())
+
+# Done markers are single files created atomically, so shards on other machines never write to the same file
+# The mode adds to what earlier runs of the unit produced, so scoring a composited unit later keeps its PNGs counted
+def mark_done(out_dir: str, unit: dict, count: int, mode: dict = None) -> None:
+    path = done_path(out_dir, unit['key'])
+    old = read_marker(out_dir, unit)
+    mode = mode or run_mode(False)
+    if old is not None:
+        old_mode = old.get('mode', run_mode(False))
+        mode = {k: bool(v or old_mode.get(k)) for k, v in mode.items()}
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({**unit, 'count': count, 'mode': mode, 'finished': time.time()}, f)
+    os.replace(tmp_path, path)
+
+# Expands the grid into work units and generates its masks once, so shards only composite
+# Units are dealt to shards round-robin in a fixed order, so every machine derives the same assignment
+def plan(grid: dict, out_dir: str, workers: int = None) -> list[dict]:
+    os.makedirs(os.path.join(out_dir, DONE_DIR), exist_ok=True)
+    with open(os.path.join(out_dir, GRID_FILE), 'w') as f:
+        json.dump(grid, f, indent=2)
+
+    masks_dir = os.path.join(out_dir, 'masks')
+    os.makedirs(masks_dir, exist_ok=True)
+    with PNGWriter(masks_dir, workers) as writer:
+        generate_masks(grid['procedurals'], masks_dir, writer, grid['targets'])
+
+    units = [{'key': unit_key(a, b, n), 'alpha': a, 'base': b, 'noise': n}
+             for a in grid['alphas'] for b in image_files(grid['bases']) for n in image_files(grid['noises'])]
+    for i, unit in enumerate(units):
+        unit['shard'] = i % grid['shards']
+    tmp_path = os.path.join(out_dir, f'{UNITS_FILE}.tmp')
+    with open(tmp_path, 'w') as f:
+        for unit in units:
+            f.write(json.dumps(unit) + '\n')
+    os.replace(tmp_path, os.path.join(out_dir, UNITS_FILE))
+    return units
+
+def load_plan(out_dir: str) -> tuple[dict, list[dict]]:
+    if not os.path.exists(os.path.join(out_dir, UNITS_FILE)):
+        raise FileNotFoundError(f'{out_dir} has no {UNITS_FILE}; run with --grid and --plan first')
+    with open(os.path.join(out_dir, GRID_FILE)) as f:
+        grid = json.load(f)
+    with open(os.path.join(out_dir, UNITS_FILE)) as f:
+        units = [json.loads(line) for line in f if line.strip()]
+    return grid, units
+
+# Runs every unit of one shard not yet done in this mode. Composites are written as PNGs and, with a generator,
+# scored into the shard's CSV; both skip outputs an interrupted run already finished
+# Noises and masks are decoded once per alpha for the whole shard rather than once per unit, one alpha at a time
+def run_shard(out_dir: str, shard: int, workers: int = None, optimize: bool = True, compress_level: int = 6,
+              generator=None, device: str = 'cpu', batch_size: int = 16, save: bool = True) -> int:
+    grid, units = load_plan(out_dir)
+    masks_dir = os.path.join(out_dir, 'masks')
+    mode = run_mode(generator is not None, save)
+    todo = [u for u in units if u['shard'] == shard and not is_done(out_dir, u, mode)]
+    # Only the current alpha's stacks are held; units are ordered by alpha, so each alpha is decoded once
+    stacks_alpha, stacks = None, None
+    for i, unit in enumerate(todo):
+        unit_dir = shard_folder(out_dir, shard, unit['alpha'])
+        os.makedirs(unit_dir, exist_ok=True)
+        if unit['alpha'] != stacks_alpha:
+            # Released before the next alpha is decoded, so two alphas' stacks are never held together
+            stacks = None
+            stacks = load_sweep_stacks(grid['noises'], masks_dir, unit['alpha'])
+            stacks_alpha = unit['alpha']
+        sweep_args = (grid['bases'], grid['noises'], masks_dir, unit['alpha'], grid['block'])
+        subset = {'bases': [unit['base']], 'noises': [unit['noise']], 'stacks': stacks}
+        if generator is not None:
+            csv_path = os.path.join(unit_dir, RESULTS_CSV)
+            scored = lightshed_detect.completed_files(csv_path)
+            items = iter_sweep(*sweep_args, skip=lambda labels: labels['filename'] in scored, **subset)
+            if save:
+                with PNGWriter(unit_dir, workers, optimize, compress_level) as writer:
+                    count = lightshed_detect.score_stream(generator, items, csv_path, device, batch_size, writer)
+            else:
+                count = lightshed_detect.score_stream(generator, items, csv_path, device, batch_size)
+        else:
+            count = 0
+            with PNGWriter(unit_dir, workers, optimize, compress_level) as writer:
+                skip = lambda labels: writer.is_done(labels['filename'], labels['key'])
+                for labels, arr in iter_sweep(*sweep_args, skip=skip, **subset):
+                    count += writer.submit(labels['filename'], arr, labels['key'])
+        mark_done(out_dir, unit, count, mode)
+        print(f'Shard {shard}: unit {i + 1}/{len(todo)} ({unit["key"]}) done, {count} composites')
+    return len(todo)
+
+# Runs shards as separate local processes, at most processes at a time; extra_args are passed to every shard
+def run_local(out_dir: str, shards: list[int], processes: int, extra_args: list[str]) -> None:
+    queue = list(shards)
+    running = []
+    while queue or running:
+        while queue and len(running) < processes:
+            shard = queue.pop(0)
+            command = [sys.executable, os.path.abspath(__file__), '--output', out_dir, '--shard', str(shard)] + extra_args
+            running.append((shard, subprocess.Popen(command)))
+        time.sleep(0.5)
+        for shard, process in list(running):
+            if process.poll() is not None:
+                running.remove((shard, process))
+                if process.returncode != 0:
+                    print(f'Shard {shard} exited with code {process.returncode}')
+
+# Finished and total units per shard, counting only units done in mode if given
+def status(out_dir: str, mode: dict = None) -> dict:
+    _, units = load_plan(out_dir)
+    counts = {}
+    for unit in units:
+        done, total = counts.get(unit['shard'], (0, 0))
+        counts[unit['shard']] = (done + is_done(out_dir, unit, mode), total + 1)
+    return counts
+
+# Moves the PNGs of finished units from the shard folders into one alpha_<alpha> folder per alpha, with a
+# manifest poison_util.py can resume from, and combines every shard CSV into one CSV with an alpha column
+# Safe to run while shards are still working and to run again later
+def merge(out_dir: str) -> tuple[int, int]:
+    _, units = load_plan(out_dir)
+    moved = 0
+    rows = {}
+    for alpha in sorted({u['alpha'] for u in units}):
+        done = {(os.path.splitext(u['base'])[0], os.path.splitext(u['noise'])[0])
+                for u in units if u['alpha'] == alpha and is_done(out_dir, u)}
+        dest_dir = os.path.join(out_dir, alpha_folder(alpha))
+        os.makedirs(dest_dir, exist_ok=True)
+        with open(os.path.join(dest_dir, MANIFEST), 'a') as manifest:
+            for unit_dir in sorted(glob.glob(os.path.join(out_dir, 'shards', '*', alpha_folder(alpha)))):
+                for entry in PNGWriter(unit_dir).entries.values():
+                    base, noise = entry['key'].split('|')[:2]
+                    src = os.path.join(unit_dir, entry['file'])
+                    if (base, noise) not in done or not os.path.exists(src):
+                        continue
+                    os.replace(src, os.path.join(dest_dir, entry['file']))
+                    manifest.write(json.dumps(entry) + '\n')
+                    moved += 1
+
+                csv_path = os.path.join(unit_dir, RESULTS_CSV)
+                if os.path.exists(csv_path):
+                    with open(csv_path, newline='') as f:
+                        for row in csv.DictReader(f):
+                            rows[(alpha, row['filename'])] = [row['filename'], row['entropy'], row['is_poisoned'], f'{alpha:g}']
+
+    if rows:
+        tmp_path = os.path.join(out_dir, f'{RESULTS_CSV}.tmp')
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(lightshed_detect.CSV_HEADER + ['alpha'])
+            writer.writerows(rows[key] for key in sorted(rows))
+        os.replace(tmp_path, os.path.join(out_dir, RESULTS_CSV))
+    return moved, len(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', required=True, help='Sweep folder shared by every shard')
+    parser.add_argument('--grid', help='JSON grid file with bases, noises, procedurals, targets, alphas, shards and block')
+    parser.add_argument('--plan', action='store_true', help='Expand --grid into work units and generate masks')
+    parser.add_argument('--shard', type=int, help='Run the unfinished units of this shard')
+    parser.add_argument('--local', type=int, metavar='N', help='Run every unfinished shard as local processes, N at a time')
+    parser.add_argument('--merge', action='store_true', help='Collect finished outputs and CSVs of all shards')
+    parser.add_argument('--status', action='store_true', help='Print finished units per shard')
+    parser.add_argument('--workers', type=int, default=None, help='Processes used to encode PNGs per shard (default: all cores)')
+    parser.add_argument('--compress-level', type=int, default=6, help='PNG compression level 0-9, used with --no-optimize')
+    parser.add_argument('--no-optimize', action='store_true', help='Skip the slow optimizing PNG encoder for throughput runs')
+    parser.add_argument('--pth', help='LightShed checkpoint; if given, composites are also scored')
+    parser.add_argument('--batch-size', type=int, default=16, help='Composites per LightShed batch (with --pth)')
+    parser.add_argument('--no-save', action='store_true', help='Do not write composite PNGs (with --pth)')
+    parser.add_argument('--model-module', default='lightshed_model', help='Module providing setup_generator and load_checkpoint')
+    lightshed_detect.add_threshold_argument(parser)
+    arg_list = parser.parse_args()
+    lightshed_detect.use_threshold(arg_list.threshold)
+
+    if not 0 <= arg_list.compress_level <= 9:
+        raise ValueError('compress-level must be between 0 and 9 inclusive')
+    out_dir = os.path.abspath(arg_list.output)
+
+    if arg_list.plan:
+        if not arg_list.grid:
+            raise ValueError('--plan requires --grid')
+        units = plan(load_grid(arg_list.grid), out_dir, arg_list.workers)
+        print(f'Planned {len(units)} units in {out_dir}')
+
+    if arg_list.shard is not None:
+        generator = None
+        device = 'cpu'
+        if arg_list.pth:
+            from xai_utils import get_device, load_generator
+            device = get_device()
+            generator = load_generator(arg_list.pth, device, arg_list.model_module)
+        count = run_shard(out_dir, arg_list.shard, arg_list.workers, not arg_list.no_optimize, arg_list.compress_level,
+                          generator, device, arg_list.batch_size, not arg_list.no_save)
+        print(f'Shard {arg_list.shard}: {count} units run')
+
+    if arg_list.local:
+        # Shard processes split the cores between them unless --workers says otherwise
+        workers = arg_list.workers or max(1, (os.cpu_count() or 1) // arg_list.local)
+        extra_args = ['--workers', str(workers), '--compress-level', str(arg_list.compress_level),
+                      '--batch-size', str(arg_list.batch_size), '--model-module', arg_list.model_module,
+                      '--threshold', repr(arg_list.threshold)]
+        extra_args += ['--no-optimize'] * arg_list.no_optimize + ['--no-save'] * arg_list.no_save
+        extra_args += ['--pth', arg_list.pth] if arg_list.pth else []
+        mode = run_mode(arg_list.pth is not None, not arg_list.no_save)
+        pending = [shard for shard, (done, total) in sorted(status(out_dir, mode).items()) if done < total]
+        run_local(out_dir, pending, arg_list.local, extra_args)
+
+    if arg_list.merge:
+        moved, rows = merge(out_dir)
+        print(f'Merged {moved} images and {rows} CSV rows into {out_dir}')
+
+    if arg_list.status or not (arg_list.plan or arg_list.shard is not None or arg_list.local or arg_list.merge):
+        counts = status(out_dir)
+        for shard, (done, total) in sorted(counts.items()):
+            print(f'Shard {shard}: {done}/{total} units done')
+        print(f'{sum(d for d, _ in counts.values())}/{sum(t for _, t in counts.values())} units done')
@@ -0,0 +1,193 @@
+import argparse
+import csv
+import os
+import numpy as np
+import torch
+from PIL import Image
+import image_store
+from lightshed_detect import poison_entropy, to_tensor_batch, list_images, threshold, use_threshold, add_threshold_argument
+
+TILE = 512
+OVERLAP = 64
+# How tile entropies become one image score; the image is poisoned if the score exceeds the threshold
+# 'any' = max over tiles, 'median' = median, 'mean' = mean
+SCORES = {'any': np.max, 'median': np.median, 'mean': np.mean}
+# 'majority' is a vote instead: poisoned when more than half of the tiles are, scored by the median
+VERDICTS = [*SCORES, 'majority']
+CSV_HEADER = ['filename', 'entropy', 'is_poisoned', 'tiles', 'poisoned_tiles', 'max_tile_entropy']
+
+# Image at its native resolution as uint8 H x W x 3, or None if it cannot be read
+def load_full_image(path: str) -> np.ndarray:
+    stored = image_store.lookup(path, native_only=True)
+    if stored is not None:
+        return stored
+    try:
+        return np.asarray(Image.open(path).convert('RGB'))
+    except Exception as e:
+        print(f'Error loading {path}')
+        print(e)
+        return None
+
+# Offsets of tiles covering [0, size); the last tile is aligned to the end so no edge is left out
+def tile_offsets(size: int, tile: int, stride: int) -> list[int]:
+    if size <= tile:
+        return [0]
+    offsets = list(range(0, size - tile, stride))
+    return offsets + [size - tile]
+
+# Every (y, x) tile position of an image of size (H, W)
+def tile_grid(size: tuple[int, int], tile: int = TILE, overlap: int = OVERLAP) -> np.ndarray:
+    stride = tile - overlap
+    if stride <= 0:
+        raise ValueError('overlap must be smaller than the tile size')
+    ys = tile_offsets(size[0], tile, stride)
+    xs = tile_offsets(size[1], tile, stride)
+    return np.array([(y, x) for y in ys for x in xs])
+
+# Pads images smaller than one tile by repeating their edges, so every tile is full size
+def pad_to_tile(image: np.ndarray, tile: int) -> np.ndarray:
+    pad_h = max(0, tile - image.shape[0])
+    pad_w = max(0, tile - image.shape[1])
+    if pad_h or pad_w:
+        image = np.pad(image, ((0, pad_h), (0, pad_w), (0, 0)), mode='edge')
+    return image
+
+# Yields (positions, float NCHW batch) of at most batch_size tiles; only one batch is converted at a time
+def iter_tiles(image: np.ndarray, positions: np.ndarray, tile: int, batch_size: int):
+    for start in range(0, len(positions), batch_size):
+        chunk = positions[start:start + batch_size]
+        yield chunk, to_tensor_batch(np.stack([image[y:y + tile, x:x + tile] for y, x in chunk]))
+
+# 2D Hann window without the zero edges, so every covered pixel keeps some weight
+def blend_window(size: int) -> torch.Tensor:
+    w = torch.hann_window(size + 2, periodic=False)[1:-1]
+    return torch.outer(w, w)
+
+# Accumulates overlapping tile outputs into one map, weighting each tile by a Hann window
+# scale maps image coordinates to output coordinates (e.g. 16 for a bottleneck that downsamples 16x)
+class TileBlender:
+    def __init__(self, channels: int, size: tuple[int, int], tile: int, scale: int = 1):
+        self.scale = scale
+        self.tile = tile // scale
+        self.size = (-(-size[0] // scale), -(-size[1] // scale))
+        self.total = torch.zeros((channels, max(self.size[0], self.tile), max(self.size[1], self.tile)))
+        self.weight = torch.zeros(self.total.shape[1:])
+        self.window = blend_window(self.tile)
+
+    def add(self, outputs: torch.Tensor, positions: np.ndarray) -> None:
+        outputs = outputs.float().cpu()
+        for out, (y, x) in zip(outputs, positions):
+            # Offsets that do not fall on the output grid are rounded to the nearest cell
+            y = min(int(round(y / self.scale)), self.total.shape[1] - self.tile)
+            x = min(int(round(x / self.scale)), self.total.shape[2] - self.tile)
+            self.total[:, y:y + self.tile, x:x + self.tile] += out * self.window
+            self.weight[y:y + self.tile, x:x + self.tile] += self.window
+
+    def result(self) -> torch.Tensor:
+        blended = self.total / self.weight.clamp_min(1e-12)
+        return blended[:, :self.size[0], :self.size[1]]
+
+# Image-level score and verdict from per-tile entropies
+def aggregate(tile_entropy: np.ndarray, verdict: str = 'median') -> tuple[float, bool]:
+    if verdict == 'majority':
+        return float(np.median(tile_entropy)), bool((tile_entropy > threshold()).sum() * 2 > len(tile_entropy))
+    score = float(SCORES[verdict](tile_entropy))
+    return score, score > threshold()
+
+# Runs every tile of an image through the generator, batch_size tiles at a time
+# Returns per-tile entropies and detections, the image verdict, and, with blend, the reconstructed poison
+# of the whole image (3 x H x W); without blend, memory only depends on the batch size
+def tiled_poison(generator: torch.nn.Module, image: np.ndarray, device: str, tile: int = TILE,
+                 overlap: int = OVERLAP, batch_size: int = 8, verdict: str = 'median', blend: bool = False) -> dict:
+    H, W, _ = image.shape
+    image = pad_to_tile(image, tile)
+    positions = tile_grid((H, W), tile, overlap)
+    blender = TileBlender(3, (H, W), tile) if blend else None
+    entropy = []
+    with torch.inference_mode():
+        for chunk, batch in iter_tiles(image, positions, tile, batch_size):
+            poison = generator(batch.to(device))
+            entropy.append(poison_entropy(poison).cpu().numpy())
+            if blender is not None:
+                blender.add(poison, chunk)
+    entropy = np.concatenate(entropy)
+    score, poisoned = aggregate(entropy, verdict)
+    return {
+        'positions': positions,
+        'tile_entropy': entropy,
+        'tile_poisoned': entropy > threshold(),
+        'entropy': score,
+        'is_poisoned': poisoned,
+        'poison': blender.result().numpy() if blender is not None else None
+    }
+
+# Bottleneck embedding of a full-resolution image: tiles are encoded in batches and their feature maps
+# blended into one map at the bottleneck's resolution. Returns (blended map, per-channel mean over it)
+def tiled_embedding(generator: torch.nn.Module, image: np.ndarray, device: str, tile: int = TILE,
+                    overlap: int = OVERLAP, batch_size: int = 8) -> tuple[torch.Tensor, torch.Tensor]:
+    from xai_utils import encode_bottleneck
+    H, W, _ = image.shape
+    image = pad_to_tile(image, tile)
+    positions = tile_grid((H, W), tile, overlap)
+    blender = None
+    for chunk, batch in iter_tiles(image, positions, tile, batch_size):
+        features = encode_bottleneck(generator, batch.to(device))
+        if blender is None:
+            blender = TileBlender(features.shape[1], (H, W), tile, tile // features.shape[-1])
+        blender.add(features, chunk)
+    features = blender.result()
+    return features, features.mean(dim=(1, 2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pth', required=True, help='The path to the checkpoint file')
+    parser.add_argument('--images', nargs='+', help='The path(s) to the input image(s)')
+    parser.add_argument('--folder', help='The path to the directory containing input images')
+    parser.add_argument('--csv', default='tiled_detection.csv', help='CSV to write one row per image to')
+    parser.add_argument('--tile', type=int, default=TILE, help='Tile size in pixels')
+    parser.add_argument('--overlap', type=int, default=OVERLAP, help='Overlap between neighbouring tiles in pixels')
+    parser.add_argument('--batch-size', type=int, default=8, help='Tiles per forward pass')
+    parser.add_argument('--verdict', choices=VERDICTS, default='median',
+                        help='How tile entropies are combined into the image score; majority votes on the tile verdicts')
+    parser.add_argument('--save-poison', help='Folder to save the blended full-resolution poison of each image to (.npy, float16)')
+    parser.add_argument('--image-store', help='Read images from this image_store.py store when they are in it')
+    parser.add_argument('--model-module', default='lightshed_model', help='Module providing setup_generator and load_checkpoint')
+    add_threshold_argument(parser)
+    arg_list = parser.parse_args()
+    use_threshold(arg_list.threshold)
+
+    if not arg_list.images and not arg_list.folder:
+        raise ValueError('--images or --folder is required')
+    if arg_list.folder and not os.path.isdir(arg_list.folder):
+        raise FileNotFoundError(f'{arg_list.folder} not found or is not directory')
+    paths = list(arg_list.images or [])
+    if arg_list.folder:
+        paths += list_images(arg_list.folder)
+    if arg_list.image_store:
+        image_store.use_image_store(arg_list.image_store)
+    if arg_list.save_poison:
+        os.makedirs(arg_list.save_poison, exist_ok=True)
+
+    import xai_utils as xu
+    device = xu.get_device()
+    print(f'Device: {device}')
+    generator = xu.load_generator(arg_list.pth, device, arg_list.model_module)
+
+    with open(arg_list.csv, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        for path in paths:
+            image = load_full_image(path)
+            if image is None:
+                continue
+            result = tiled_poison(generator, image, device, arg_list.tile, arg_list.overlap, arg_list.batch_size,
+                                  arg_list.verdict, blend=arg_list.save_poison is not None)
+            name = os.path.basename(path)
+            writer.writerow([name, f'{result["entropy"]:.6f}', result['is_poisoned'], len(result['positions']),
+                             int(result['tile_poisoned'].sum()), f'{result["tile_entropy"].max():.6f}'])
+            if result['poison'] is not None:
+                np.save(os.path.join(arg_list.save_poison, f'{os.path.splitext(name)[0]}.npy'),
+                        result['poison'].astype(np.float16))
+            print(f'{name}: {image.shape[1]}x{image.shape[0]}, {len(result["positions"])} tiles, '
+                  f'{int(result["tile_poisoned"].sum())} poisoned, verdict {"poisoned" if result["is_poisoned"] else "clean"}')
@@ -0,0 +1,168 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import matplotlib
+from matplotlib.figure import Figure
+import matplotlib.patches as mpatches
+import numpy as np
+import torch
+from activation_render import CHANNELS, LAYERS, draw_feature_maps, register_slice_hooks
+from feature_cache import FeatureCache
+from feature_reduction import cached_features
+import xai_utils as xu
+import instrument
+
+INDEX_FILE = 'index.json'
+
+# Worker initializer: figures are drawn on Agg whatever backend the parent process picked
+def headless() -> None:
+    os.environ['MPLBACKEND'] = 'Agg'
+    matplotlib.use('Agg')
+
+# Saves fig once per format and returns the file names written
+def save_figure(fig: Figure, out_dir: str, stem: str, formats: list[str]) -> list[str]:
+    files = []
+    for fmt in formats:
+        file_name = f'{stem}.{fmt}'
+        fig.savefig(os.path.join(out_dir, file_name), format=fmt)
+        files.append(file_name)
+    return files
+
+# Worker: activation grid for one image
+def plot_activations(activations: dict, title: str, out_dir: str, stem: str, formats: list[str]) -> list[str]:
+    fig = Figure(figsize=(15, 9))
+    draw_feature_maps(fig, activations, title, CHANNELS)
+    return save_figure(fig, out_dir, stem, formats)
+
+# Worker: t-SNE scatter plot colored by poisoning technique
+def plot_tsne(points: np.ndarray, colors: list[str], perplexity: float, out_dir: str, stem: str,
+              formats: list[str]) -> list[str]:
+    fig = Figure(figsize=(8, 6))
+    ax = fig.add_subplot()
+    ax.scatter(points[:, 0], points[:, 1], s=60, c=colors)
+    ax.set_title(f't-SNE Perplexity: {perplexity}')
+    handles = [mpatches.Patch(color=p.get_facecolor(), label=p.get_label()) for p in xu.MPATCHES]
+    ax.legend(title='Legend', handles=handles, loc='best')
+    fig.tight_layout()
+    return save_figure(fig, out_dir, stem, formats)
+
+# Worker: grid of encoder filters
+def plot_filters(filters: np.ndarray, out_dir: str, stem: str, formats: list[str]) -> list[str]:
+    fig = Figure(figsize=(5, 5))
+    axes = fig.subplots(8, filters.shape[0] // 8)
+    for i, ax in enumerate(axes.flat):
+        ax.imshow(filters[i])
+        ax.axis('off')
+    fig.tight_layout(rect=[0, 0, 1, 0.95])
+    fig.suptitle('Encoder Layer Filters')
+    return save_figure(fig, out_dir, stem, formats)
+
+# Renders figures in a process pool while the caller keeps running inference
+# Pending figures are bounded so inference results do not pile up in memory
+class FigureExporter:
+    def __init__(self, out_dir: str, formats: list[str], workers: int = None):
+        self.out_dir = out_dir
+        self.formats = formats
+        os.makedirs(out_dir, exist_ok=True)
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = 2 * self.workers
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=headless)
+        self.pending = {}
+        self.entries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Queues plot(*args, out_dir, stem, formats); entry describes the figure in the index
+    def submit(self, plot, args: tuple, stem: str, entry: dict) -> None:
+        if len(self.pending) >= self.max_pending:
+            # Time spent here means plotting cannot keep up with inference
+            with instrument.stage('plot_wait'):
+                while len(self.pending) >= self.max_pending:
+                    finished, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+                    self._record(finished)
+        future = self.pool.submit(plot, *args, self.out_dir, stem, self.formats)
+        self.pending[future] = entry
+        instrument.gauge('plot_queue', len(self.pending))
+
+    def _record(self, finished) -> None:
+        for future in finished:
+            entry = self.pending.pop(future)
+            entry['files'] = future.result()
+            self.entries.append(entry)
+            instrument.count('figures')
+
+    # Waits for every figure, then writes the JSON index
+    def close(self) -> None:
+        if self.pool is None:
+            return
+        self._record(wait(self.pending).done)
+        self.pool.shutdown()
+        self.pool = None
+        with open(os.path.join(self.out_dir, INDEX_FILE), 'w') as f:
+            json.dump({'figures': sorted(self.entries, key=lambda e: e['file'])}, f, indent=2)
+
+# Activation grids for every image from one forward pass per batch, with inference batched ahead of plotting
+# With cache, the same pass stores the bottleneck embeddings t-SNE needs for images not cached yet,
+# so exporting both figure kinds decodes and runs each image once
+def export_activations(exporter: FigureExporter, generator: torch.nn.Module, paths: list[str], device: str,
+                       batch_size: int = 16, cache: FeatureCache = None, method: str = 'none') -> None:
+    from lightshed_xai import load_image
+    store = {}
+    handles = register_slice_hooks(generator, store, CHANNELS)
+    if cache is not None:
+        with instrument.stage('hash', len(paths)):
+            hashes = [cache.content_hash(p) for p in paths]
+        cache.save_hashes()
+        handles.append(generator.bottleneck[0].register_forward_hook(
+            lambda model, input, output: store.__setitem__('embedding', output.detach())))
+    try:
+        for start in range(0, len(paths), batch_size):
+            images, file_names, image_hashes = [], [], []
+            for i in range(start, min(start + batch_size, len(paths))):
+                with instrument.stage('decode', 1):
+                    img = load_image(paths[i], unsqueeze=False)
+                if img is not None:
+                    images.append(img)
+                    file_names.append(os.path.basename(paths[i]))
+                    image_hashes.append(hashes[i] if cache is not None else None)
+            if not images:
+                continue
+            with instrument.stage('forward', len(images)):
+                with torch.no_grad():
+                    generator(torch.stack(images).to(device))
+            if cache is not None:
+                todo = [j for j, h in enumerate(image_hashes) if h not in cache and h not in image_hashes[:j]]
+                if todo:
+                    with instrument.stage('cache_write', len(todo)):
+                        features = cached_features(store['embedding'][todo], method)
+                        cache.add([image_hashes[j] for j in todo], features.cpu().reshape(len(todo), -1).numpy())
+            activations = {layer: store[layer].numpy() for layer in LAYERS}
+            for i, name in enumerate(file_names):
+                stem = f'activation_{os.path.splitext(name)[0]}'
+                per_image = {layer: fmaps[i] for layer, fmaps in activations.items()}
+                exporter.submit(plot_activations, (per_image, f'Activations per Layer for {name}'), stem,
+                                {'mode': 'activation', 'file': stem, 'source': name})
+            instrument.step()
+    finally:
+        for handle in handles:
+            handle.remove()
+
+# One t-SNE plot from precomputed embeddings
+def export_tsne(exporter: FigureExporter, features: np.ndarray, file_names: list[str], perplexity: float,
+                colors: list[str] = None) -> None:
+    from sklearn.manifold import TSNE
+    with instrument.stage('tsne', len(features)):
+        points = TSNE(n_components=2, perplexity=perplexity, random_state=0).fit_transform(features)
+    colors = [c.value for c in colors or [xu.plot_color(p) for p in file_names]]
+    stem = f'tsne_p{perplexity:g}'
+    exporter.submit(plot_tsne, (points, colors, perplexity), stem,
+                    {'mode': 'tsne', 'file': stem, 'sources': file_names,
+                     'points': points.tolist()})
+
+def export_filters(exporter: FigureExporter, generator: torch.nn.Module) -> None:
+    from lightshed_xai import encoder_filters
+    exporter.submit(plot_filters, (encoder_filters(generator),), 'filters', {'mode': 'filter', 'file': 'filters'})
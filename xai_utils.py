@@ -1,4 +1,6 @@
 import torch
+import hashlib
+import importlib
 from enum import Enum
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
@@ -11,10 +13,23 @@ extensions = {'.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG'}
 def load_image(img_path: str, mode: str) -> tuple[Image, str]: 
     if os.path.splitext(img_path)[1] in extensions:
         name = os.path.splitext(os.path.basename(img_path))[0]
+        if mode == 'RGB':
+            # Already decoded in the image store (only if it was not resized there)
+            from image_store import lookup
+            stored = lookup(img_path, native_only=True)
+            if stored is not None:
+                return Image.fromarray(stored), name
         try:
             img = Image.open(img_path)
             if mode == 'RGB':
                 img = img.convert('RGB')
+            elif mode == 'I;16':
+                # Keep 16-bit precision, widening 8-bit images so levels line up
+                if img.mode in ('I;16', 'I'):
+                    bit16 = np.clip(np.array(img), 0, 65535).astype(np.uint16)
+                else:
+                    bit16 = np.array(img.convert('L'), dtype=np.uint16) * 257
+                img = Image.fromarray(bit16)
             elif mode == 'L':
                 # Convert 16-bit to 8-bit if needed
                 if img.mode == 'I;16':
@@ -39,6 +54,40 @@ def get_device():
     else:
         return 'cpu'
 
+# Builds the LightShed generator and loads a checkpoint into it
+# module names the file providing setup_generator and load_checkpoint, so a stand-in can replace lightshed_model
+def load_generator(checkpoint_path: str, device: str, module: str = 'lightshed_model') -> torch.nn.Module:
+    # Model implementation hidden per LightShed authors' request
+    model = importlib.import_module(module)
+    generator, _ = model.setup_generator()
+    if os.path.exists(checkpoint_path):
+        generator, _, _, _ = model.load_checkpoint(checkpoint_path, generator, None, device)
+        print(f'Loaded checkpoint: {checkpoint_path}')
+    else:
+        raise FileNotFoundError(f'No checkpoint found at {checkpoint_path}')
+    generator.eval()
+    return generator
+
+# SHA-256 of a file's contents, read in chunks so large checkpoints do not need to fit in memory
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Partial forward pass up to the first bottleneck layer, used as the image embedding
+# generator may also be a scoring_service.Client, which runs the pass on the service's warm generator
+def encode_bottleneck(generator: torch.nn.Module, images: torch.Tensor) -> torch.Tensor:
+    if not isinstance(generator, torch.nn.Module):
+        return generator.encode_bottleneck(images)
+    with torch.no_grad():
+        x = generator.encoder1(images)
+        x = generator.encoder2(x)
+        x = generator.encoder3(x)
+        x = generator.encoder4(x)
+        return generator.bottleneck[0](x)
+
 # Color coding for t-SNE
 class Plot_Colors(str, Enum):
     CLEAN = 'xkcd:goldenrod'
@@ -56,6 +105,24 @@ def is_glazed(file_name: str) -> bool:
 def is_shaded(file_name: str) -> bool:
     return 'shaded' in file_name
 
+# t-SNE color for a file based on the poisoning techniques in its name
+def plot_color(file_name: str) -> Plot_Colors:
+    if is_shaded_glazed(file_name):
+        return Plot_Colors.NS_GL
+    elif is_glazed(file_name):
+        return Plot_Colors.GLAZE
+    elif is_shaded(file_name):
+        return Plot_Colors.SHADE
+    return Plot_Colors.CLEAN
+
+# t-SNE color for a variant label, e.g. from catalogue.py
+VARIANT_COLORS = {
+    'clean': Plot_Colors.CLEAN,
+    'glazed': Plot_Colors.GLAZE,
+    'shaded': Plot_Colors.SHADE,
+    'glazed_shaded': Plot_Colors.NS_GL
+}
+
 MPATCHES = [
     mpatches.Patch(color=Plot_Colors.CLEAN, label='Clean'),
     mpatches.Patch(color=Plot_Colors.GLAZE, label='Glazed'),